@@ -1,226 +1,254 @@
-from flask import Flask, request, jsonify, send_file
+"""
+The Flask app serving /api/*, built by create_app()
+
+    gunicorn 'app:create_app()' --preload --workers 4
+
+create_app() opens the stores and runs the cipher once before returning
+(WARM_UP_ON_START), so with --preload that is done in the master and the
+workers are forked ready. It starts no threads: each worker starts its
+background threads (cleanup, release warm-up, re-keying) with its first
+request, after the fork. Importing this module builds nothing; app, for
+`gunicorn app:app` and `flask run`, is the default app, created on first use.
+"""
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, g
 from flask_cors import CORS
 import os
+from functools import wraps
 from dotenv import load_dotenv
-import io
-from datetime import datetime
-from encryption import encrypt_file, decrypt_file
-from utils import generate_secure_filename, validate_file_type
+from werkzeug.exceptions import HTTPException
+from werkzeug.local import LocalProxy
 from config import DevelopmentConfig, ProductionConfig
+from crypto_executor import CryptoBusyError
+from services import ExamService, ServiceError
+from audit import request_context
+from streaming import ndjson_lines
+from metrics import RequestTimer, CONTENT_TYPE
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# The ExamService of the app handling the current request
+service = LocalProxy(lambda: current_app.extensions['exam_service'])
+
+def create_app(config=None) -> Flask:
+    """
+    Flask app for config, a config class or mapping (by default
+    DevelopmentConfig when FLASK_ENV is 'development', else ProductionConfig)
+    """
+    # Load environment variables
+    load_dotenv()
+
+    app = Flask(__name__)
+    if config is None:
+        config = DevelopmentConfig if os.getenv('FLASK_ENV') == 'development' else ProductionConfig
+    if isinstance(config, dict):
+        app.config.from_mapping(config)
+    else:
+        app.config.from_object(config)
+    CORS(app)
+
+    exam_service = ExamService(app.config)
+    app.extensions['exam_service'] = exam_service
+    app.register_blueprint(api)
+
+    if app.config['WARM_UP_ON_START']:
+        exam_service.warm_up()
+    return app
+
+def __getattr__(name):
+    # The default app, built the first time something asks for it
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@api.before_app_request
+def start_background():
+    """Start this worker's background threads, on its first request"""
+    service.start_background()
+
+def request_client() -> str:
+    """Who the current request is from, seen through TRUSTED_PROXIES"""
+    return service.client_address(request.remote_addr, ', '.join(request.headers.getlist('X-Forwarded-For')))
+
+@api.before_app_request
+def set_audit_context():
+    """Tag this request's audit records with who made it and how"""
+    request_context.set({'client': request_client(), 'method': request.method, 'path': request.path})
 
-# Load environment variables
-load_dotenv()
+@api.before_app_request
+def start_request_timer():
+    """Count the request against its route pattern (not the path, which embeds file ids)"""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.request_timer = RequestTimer(route, request.method, request.content_length or 0)
 
-app = Flask(__name__)
-# Use DevelopmentConfig for development
-if os.getenv('FLASK_ENV') == 'development':
-    app.config.from_object(DevelopmentConfig)
-else:
-    app.config.from_object(ProductionConfig)
-CORS(app)
+@api.after_app_request
+def finish_request_timer(response):
+    """Record the request once its response has been sent, streamed bodies included"""
+    timer = g.pop('request_timer', None)
+    if timer is None:
+        return response
+    if response.is_streamed:
+        response.response = timer.counted(response.response)
+    else:
+        timer.bytes_out = response.content_length or 0
+    status = response.status_code
+    response.call_on_close(lambda: timer.finish(status))
+    return response
 
-# Ensure directories exist
-os.makedirs(app.config['STORAGE_FOLDER'], exist_ok=True)
-os.makedirs(app.config['DECRYPTED_FOLDER'], exist_ok=True)
+def busy_response(error):
+    """503 telling the client when to retry a request the crypto executor refused"""
+    response = jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
-# Store file metadata (in production, use a database)
-file_metadata = {}
+def api_errors(failure_message):
+    """Turn service errors into JSON responses; anything else is a 500"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                service.check_rate_limit(request_client(), view.__name__)
+                return view(*args, **kwargs)
+            except ServiceError as e:
+                return jsonify(e.body), e.status, e.headers
+            except CryptoBusyError as e:
+                return busy_response(e)
+            except HTTPException as e:
+                # Raised by Flask itself: a body over MAX_CONTENT_LENGTH, a body that is not JSON
+                return jsonify({'error': e.description}), e.code
+            except Exception as e:
+                return jsonify({'error': f'{failure_message}: {str(e)}'}), 500
+        return wrapper
+    return decorator
 
-@app.route('/api/health', methods=['GET'])
+@api.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'message': 'Secure Exam Distribution System is running'
-    })
+    return jsonify(service.health())
 
-@app.route('/api/upload', methods=['POST'])
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for this worker process"""
+    return Response(service.metrics(), content_type=CONTENT_TYPE)
+
+@api.route('/upload', methods=['POST'])
+@api_errors('Upload failed')
 def upload_file():
     """Upload and encrypt exam paper"""
-    try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        password = request.form.get('password')
-        subject = request.form.get('subject', 'Unknown')
-        exam_date = request.form.get('exam_date', datetime.now().strftime('%Y-%m-%d'))
-        
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not password:
-            return jsonify({'error': 'Password is required'}), 400
-        
-        if not validate_file_type(file.filename):
-            return jsonify({'error': 'Invalid file type. Only PDF, DOC, DOCX allowed'}), 400
-        
-        # Generate secure filename
-        original_filename = file.filename
-        secure_filename = generate_secure_filename(original_filename)
-        
-        # Read file content
-        file_content = file.read()
-        
-        # Encrypt file
-        encrypted_content = encrypt_file(file_content, password)
-        
-        # Save encrypted file
-        encrypted_path = os.path.join(app.config['STORAGE_FOLDER'], secure_filename + '.enc')
-        with open(encrypted_path, 'wb') as f:
-            f.write(encrypted_content)
-        
-        # Store metadata
-        file_id = secure_filename
-        file_metadata[file_id] = {
-            'original_filename': original_filename,
-            'secure_filename': secure_filename,
-            'subject': subject,
-            'exam_date': exam_date,
-            'upload_time': datetime.now().isoformat(),
-            'file_size': len(file_content),
-            'encrypted_path': encrypted_path
-        }
-        
-        return jsonify({
-            'message': 'File uploaded and encrypted successfully',
-            'file_id': file_id,
-            'original_filename': original_filename,
-            'subject': subject,
-            'exam_date': exam_date
-        }), 201
-        
-    except Exception as e:
-        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
-
-@app.route('/api/files', methods=['GET'])
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    # Read from request.stream rather than request.files so nothing is buffered
+    return jsonify(service.upload(request.stream, boundary.encode('latin-1'))), 201
+
+@api.route('/upload/batch', methods=['POST'])
+@api_errors('Batch upload failed')
+def upload_batch():
+    """Upload and encrypt many exam papers (or a zip of them), streaming NDJSON progress"""
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    request.max_content_length = current_app.config['BATCH_MAX_CONTENT_LENGTH']
+    events = service.upload_batch(request.stream, boundary.encode('latin-1'))
+    return Response(ndjson_lines(events), mimetype='application/x-ndjson')
+
+@api.route('/files', methods=['GET'])
+@api_errors('Failed to list files')
 def list_files():
-    """List all uploaded files"""
-    try:
-        files_list = []
-        for file_id, metadata in file_metadata.items():
-            files_list.append({
-                'file_id': file_id,
-                'original_filename': metadata['original_filename'],
-                'subject': metadata['subject'],
-                'exam_date': metadata['exam_date'],
-                'upload_time': metadata['upload_time'],
-                'file_size': metadata['file_size']
-            })
-        
-        return jsonify({
-            'files': files_list,
-            'total_files': len(files_list)
-        })
-        
-    except Exception as e:
-        return jsonify({'error': f'Failed to list files: {str(e)}'}), 500
-
-@app.route('/api/download/<file_id>', methods=['POST'])
+    """List uploaded files, one page at a time (see ExamService.list_files)"""
+    etag = service.list_etag(request.query_string.decode())
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(service.list_files(request.args))
+    
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+@api.route('/download/<file_id>', methods=['POST'])
+@api_errors('Download failed')
 def download_file(file_id):
-    """Download and decrypt exam paper"""
-    try:
-        password = request.json.get('password')
-        
-        if not password:
-            return jsonify({'error': 'Password is required'}), 400
-        
-        if file_id not in file_metadata:
-            return jsonify({'error': 'File not found'}), 404
-        
-        metadata = file_metadata[file_id]
-        encrypted_path = metadata['encrypted_path']
-        
-        if not os.path.exists(encrypted_path):
-            return jsonify({'error': 'Encrypted file not found on disk'}), 404
-        
-        # Read encrypted file
-        with open(encrypted_path, 'rb') as f:
-            encrypted_content = f.read()
-        
-        # Decrypt file
-        try:
-            decrypted_content = decrypt_file(encrypted_content, password)
-        except Exception as decrypt_error:
-            return jsonify({'error': 'Invalid password or corrupted file'}), 401
-        
-        # Create file-like object for download
-        file_obj = io.BytesIO(decrypted_content)
-        file_obj.seek(0)
-        
-        return send_file(
-            file_obj,
-            as_attachment=True,
-            download_name=metadata['original_filename'],
-            mimetype='application/octet-stream'
-        )
-        
-    except Exception as e:
-        return jsonify({'error': f'Download failed: {str(e)}'}), 500
-
-@app.route('/api/delete/<file_id>', methods=['DELETE'])
+    """Download and decrypt exam paper, or the byte range asked for with Range/If-Range"""
+    download = service.open_download(
+        file_id,
+        request.json.get('password'),
+        request.headers.get('Range'),
+        request.headers.get('If-Range')
+    )
+    
+    response = Response(
+        download.chunks,
+        status=download.status,
+        mimetype='application/octet-stream',
+        headers=download.headers
+    )
+    response.call_on_close(download.close)
+    return response
+
+@api.route('/bundle', methods=['POST'])
+@api_errors('Bundle download failed')
+def download_bundle():
+    """Download several decrypted exam papers as one zip, built as it is sent"""
+    download = service.open_bundle(request.json or {})
+    
+    response = Response(
+        download.chunks,
+        status=download.status,
+        mimetype='application/zip',
+        headers=download.headers
+    )
+    response.call_on_close(download.close)
+    return response
+
+@api.route('/delete/<file_id>', methods=['DELETE'])
+@api_errors('Delete failed')
 def delete_file(file_id):
     """Delete encrypted file"""
-    try:
-        if file_id not in file_metadata:
-            return jsonify({'error': 'File not found'}), 404
-        
-        metadata = file_metadata[file_id]
-        encrypted_path = metadata['encrypted_path']
-        
-        # Delete encrypted file from disk
-        if os.path.exists(encrypted_path):
-            os.remove(encrypted_path)
-        
-        # Remove from metadata
-        del file_metadata[file_id]
-        
-        return jsonify({'message': 'File deleted successfully'})
-        
-    except Exception as e:
-        return jsonify({'error': f'Delete failed: {str(e)}'}), 500
-
-@app.route('/api/verify/<file_id>', methods=['POST'])
+    return jsonify(service.delete(file_id))
+
+@api.route('/verify/<file_id>', methods=['POST'])
+@api_errors('Verification failed')
 def verify_file(file_id):
     """Verify file access without downloading"""
-    try:
-        password = request.json.get('password')
-        
-        if not password:
-            return jsonify({'error': 'Password is required'}), 400
-        
-        if file_id not in file_metadata:
-            return jsonify({'error': 'File not found'}), 404
-        
-        metadata = file_metadata[file_id]
-        encrypted_path = metadata['encrypted_path']
-        
-        if not os.path.exists(encrypted_path):
-            return jsonify({'error': 'Encrypted file not found on disk'}), 404
-        
-        # Read a small portion of encrypted file for verification
-        with open(encrypted_path, 'rb') as f:
-            encrypted_content = f.read()
-        
-        # Try to decrypt (this will raise an exception if password is wrong)
-        try:
-            decrypt_file(encrypted_content, password)
-            return jsonify({
-                'valid': True,
-                'message': 'Password is correct',
-                'file_info': {
-                    'original_filename': metadata['original_filename'],
-                    'subject': metadata['subject'],
-                    'exam_date': metadata['exam_date'],
-                    'file_size': metadata['file_size']
-                }
-            })
-        except:
-            return jsonify({'valid': False, 'message': 'Invalid password'}), 401
-            
-    except Exception as e:
-        return jsonify({'error': f'Verification failed: {str(e)}'}), 500
+    return jsonify(service.verify(file_id, request.json.get('password')))
+
+@api.route('/release/<file_id>', methods=['PUT'])
+@api_errors('Scheduling failed')
+def set_release(file_id):
+    """Set or clear the time an exam paper can be downloaded from (see ExamService.set_release_time)"""
+    body = request.json or {}
+    return jsonify(service.set_release_time(file_id, body.get('release_time'), body.get('password'),
+                                            request.headers.get('X-Admin-Token')))
+
+@api.route('/passwords/<file_id>', methods=['GET'])
+@api_errors('Failed to list passwords')
+def list_passwords(file_id):
+    """List the passwords (key slots) opening an exam paper"""
+    return jsonify(service.list_passwords(file_id))
+
+@api.route('/passwords/<file_id>', methods=['POST'])
+@api_errors('Adding password failed')
+def add_password(file_id):
+    """Let another password open an exam paper, without re-encrypting it"""
+    body = request.json or {}
+    return jsonify(service.add_password(file_id, body.get('password'), body.get('new_password'), body.get('label')))
+
+@api.route('/passwords/<file_id>', methods=['PUT'])
+@api_errors('Changing password failed')
+def change_password(file_id):
+    """Replace the password given with a new one, without re-encrypting the paper"""
+    body = request.json or {}
+    return jsonify(service.change_password(file_id, body.get('password'), body.get('new_password')))
+
+@api.route('/passwords/<file_id>/<slot_id>', methods=['DELETE'])
+@api_errors('Revoking password failed')
+def revoke_password(file_id, slot_id):
+    """Stop a password opening an exam paper"""
+    return jsonify(service.revoke_password(file_id, slot_id, (request.json or {}).get('password')))
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
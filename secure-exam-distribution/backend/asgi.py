@@ -0,0 +1,376 @@
+"""
+Asyncio/ASGI serving mode for the same /api/* routes as app.py
+
+    uvicorn asgi:create_app --factory --host 0.0.0.0 --port 5000 --workers 4
+
+Each connection is a coroutine rather than an OS thread, so thousands of slow
+exam-centre downloads can be held open per core. Blocking work (file reads,
+SQLite, the multipart/encrypt pipeline) runs in the thread pool and key
+derivation on the ExamService crypto executor; the event loop only moves bytes.
+"""
+import asyncio
+import contextlib
+import json
+import os
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Match, Route
+from werkzeug.http import parse_etags, parse_options_header
+from config import DevelopmentConfig, ProductionConfig, config_to_dict
+from crypto_executor import CryptoBusyError
+from services import ExamService, ServiceError
+from audit import request_context
+from streaming import ndjson_lines
+from metrics import RequestTimer, CONTENT_TYPE
+
+class _BlockingBodyReader:
+    """
+    File-like read() over an ASGI request body, for use from a worker thread
+    Each read that needs more data hands one receive back to the event loop.
+    """
+
+    def __init__(self, request, loop, max_length: int = None):
+        self._chunks = request.stream().__aiter__()
+        self._loop = loop
+        self._buffer = b''
+        self._received = 0
+        self._max_length = max_length
+        self._eof = False
+
+    async def _next_chunk(self) -> bytes:
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b''
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buffer and not self._eof:
+            chunk = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop).result()
+            if not chunk:
+                self._eof = True
+                break
+            self._received += len(chunk)
+            if self._max_length is not None and self._received > self._max_length:
+                raise ServiceError('Request body too large', 413)
+            self._buffer = chunk
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def api_errors(failure_message):
+    """Turn service errors into JSON responses; anything else is a 500"""
+    def decorator(endpoint):
+        async def wrapper(request):
+            # Copied into the thread pool along with the rest of the context
+            client = request.app.state.service.client_address(
+                request.client.host if request.client else None, ', '.join(request.headers.getlist('x-forwarded-for'))
+            )
+            request_context.set({'client': client, 'method': request.method, 'path': request.url.path})
+            try:
+                await run_in_threadpool(request.app.state.service.check_rate_limit, client, endpoint.__name__)
+                return await endpoint(request)
+            except ServiceError as e:
+                return JSONResponse(e.body, status_code=e.status, headers=e.headers)
+            except CryptoBusyError as e:
+                return JSONResponse({'error': str(e)}, status_code=503,
+                                    headers={'Retry-After': str(e.retry_after)})
+            except HTTPException as e:
+                return JSONResponse({'error': e.detail}, status_code=e.status_code, headers=e.headers)
+            except json.JSONDecodeError:
+                # From request.json(), like Flask's 400 for a body that does not parse
+                return JSONResponse({'error': 'Request body must be JSON'}, status_code=400)
+            except Exception as e:
+                return JSONResponse({'error': f'{failure_message}: {str(e)}'}, status_code=500)
+        return wrapper
+    return decorator
+
+class MetricsMiddleware:
+    """
+    Request metrics for the ASGI app, like the before/after_request hooks in
+    app.py: counted against the route pattern, and timed until the last
+    body chunk has been sent
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    def _route(self, scope) -> str:
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match != Match.NONE:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timer = RequestTimer(self._route(scope), scope['method'])
+        status = 500
+
+        async def counting_receive():
+            message = await receive()
+            if message['type'] == 'http.request':
+                timer.received(len(message.get('body', b'')))
+            return message
+
+        async def counting_send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                timer.bytes_out += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            timer.finish(status)
+
+async def _password(request) -> str:
+    body = await request.json()
+    return body.get('password')
+
+async def health_check(request):
+    """Health check endpoint"""
+    service = request.app.state.service
+    return JSONResponse(service.health())
+
+async def metrics(request):
+    """Prometheus metrics for this worker process"""
+    service = request.app.state.service
+    return Response(await run_in_threadpool(service.metrics), headers={'Content-Type': CONTENT_TYPE})
+
+@api_errors('Upload failed')
+async def upload_file(request):
+    """Upload and encrypt exam paper"""
+    service = request.app.state.service
+    mimetype, options = parse_options_header(request.headers.get('content-type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        return JSONResponse({'error': 'No file provided'}, status_code=400)
+    
+    reader = _BlockingBodyReader(request, asyncio.get_running_loop(), service.config['MAX_CONTENT_LENGTH'])
+    body = await run_in_threadpool(service.upload, reader, boundary.encode('latin-1'))
+    return JSONResponse(body, status_code=201)
+
+class _BodyReadingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse for a handler still reading the request body
+    Under ASGI spec versions before 2.4 StreamingResponse also watches
+    receive() for a disconnect, which would swallow body chunks; a client
+    that goes away surfaces through the body reader instead.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+async def _stream_events(events):
+    """Pull progress events in the thread pool, where the request body is read"""
+    while True:
+        chunk = await run_in_threadpool(next, events, None)
+        if chunk is None:
+            return
+        yield chunk
+
+@api_errors('Batch upload failed')
+async def upload_batch(request):
+    """Upload and encrypt many exam papers (or a zip of them), streaming NDJSON progress"""
+    service = request.app.state.service
+    mimetype, options = parse_options_header(request.headers.get('content-type', ''))
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        return JSONResponse({'error': 'No file provided'}, status_code=400)
+    
+    reader = _BlockingBodyReader(request, asyncio.get_running_loop(), service.config['BATCH_MAX_CONTENT_LENGTH'])
+    events = await run_in_threadpool(service.upload_batch, reader, boundary.encode('latin-1'))
+    return _BodyReadingStreamingResponse(_stream_events(ndjson_lines(events)), media_type='application/x-ndjson')
+
+@api_errors('Failed to list files')
+async def list_files(request):
+    """List uploaded files, one page at a time (see ExamService.list_files)"""
+    service = request.app.state.service
+    etag = await run_in_threadpool(service.list_etag, request.url.query)
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return Response(status_code=304, headers=headers)
+    
+    body = await run_in_threadpool(service.list_files, request.query_params)
+    return JSONResponse(body, headers=headers)
+
+async def _stream_download(download):
+    """Pull decrypted chunks in the thread pool and release the file when done"""
+    try:
+        while True:
+            chunk = await run_in_threadpool(next, download.chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        download.close()
+
+@api_errors('Download failed')
+async def download_file(request):
+    """Download and decrypt exam paper, or the byte range asked for with Range/If-Range"""
+    service = request.app.state.service
+    password = await _password(request)
+    download = await run_in_threadpool(
+        service.open_download,
+        request.path_params['file_id'],
+        password,
+        request.headers.get('range'),
+        request.headers.get('if-range')
+    )
+    
+    return StreamingResponse(
+        _stream_download(download),
+        status_code=download.status,
+        media_type='application/octet-stream',
+        headers=dict(download.headers.items())
+    )
+
+@api_errors('Bundle download failed')
+async def download_bundle(request):
+    """Download several decrypted exam papers as one zip, built as it is sent"""
+    service = request.app.state.service
+    selection = await request.json()
+    download = await run_in_threadpool(service.open_bundle, selection or {})
+    
+    return StreamingResponse(
+        _stream_download(download),
+        status_code=download.status,
+        media_type='application/zip',
+        headers=dict(download.headers.items())
+    )
+
+@api_errors('Delete failed')
+async def delete_file(request):
+    """Delete encrypted file"""
+    service = request.app.state.service
+    return JSONResponse(await run_in_threadpool(service.delete, request.path_params['file_id']))
+
+@api_errors('Verification failed')
+async def verify_file(request):
+    """Verify file access without downloading"""
+    service = request.app.state.service
+    password = await _password(request)
+    return JSONResponse(await run_in_threadpool(service.verify, request.path_params['file_id'], password))
+
+@api_errors('Scheduling failed')
+async def set_release(request):
+    """Set or clear the time an exam paper can be downloaded from (see ExamService.set_release_time)"""
+    service = request.app.state.service
+    body = (await request.json()) or {}
+    return JSONResponse(await run_in_threadpool(
+        service.set_release_time, request.path_params['file_id'], body.get('release_time'), body.get('password'),
+        request.headers.get('X-Admin-Token')
+    ))
+
+@api_errors('Failed to list passwords')
+async def list_passwords(request):
+    """List the passwords (key slots) opening an exam paper"""
+    service = request.app.state.service
+    return JSONResponse(await run_in_threadpool(service.list_passwords, request.path_params['file_id']))
+
+@api_errors('Adding password failed')
+async def add_password(request):
+    """Let another password open an exam paper, without re-encrypting it"""
+    service = request.app.state.service
+    body = (await request.json()) or {}
+    return JSONResponse(await run_in_threadpool(
+        service.add_password, request.path_params['file_id'], body.get('password'), body.get('new_password'),
+        body.get('label')
+    ))
+
+@api_errors('Changing password failed')
+async def change_password(request):
+    """Replace the password given with a new one, without re-encrypting the paper"""
+    service = request.app.state.service
+    body = (await request.json()) or {}
+    return JSONResponse(await run_in_threadpool(
+        service.change_password, request.path_params['file_id'], body.get('password'), body.get('new_password')
+    ))
+
+@api_errors('Revoking password failed')
+async def revoke_password(request):
+    """Stop a password opening an exam paper"""
+    service = request.app.state.service
+    password = await _password(request)
+    return JSONResponse(await run_in_threadpool(
+        service.revoke_password, request.path_params['file_id'], request.path_params['slot_id'], password
+    ))
+
+routes = [
+    Route('/api/health', health_check, methods=['GET']),
+    Route('/api/metrics', metrics, methods=['GET']),
+    Route('/api/upload', upload_file, methods=['POST']),
+    Route('/api/upload/batch', upload_batch, methods=['POST']),
+    Route('/api/files', list_files, methods=['GET']),
+    Route('/api/download/{file_id}', download_file, methods=['POST']),
+    Route('/api/bundle', download_bundle, methods=['POST']),
+    Route('/api/delete/{file_id}', delete_file, methods=['DELETE']),
+    Route('/api/verify/{file_id}', verify_file, methods=['POST']),
+    Route('/api/release/{file_id}', set_release, methods=['PUT']),
+    Route('/api/passwords/{file_id}', list_passwords, methods=['GET']),
+    Route('/api/passwords/{file_id}', add_password, methods=['POST']),
+    Route('/api/passwords/{file_id}', change_password, methods=['PUT']),
+    Route('/api/passwords/{file_id}/{slot_id}', revoke_password, methods=['DELETE']),
+]
+
+@contextlib.asynccontextmanager
+async def _lifespan(app):
+    # Lifespan startup runs in each worker process, so the background threads
+    # are never started in a process that is about to fork
+    app.state.service.start_background()
+    yield
+
+def create_app(config=None) -> Starlette:
+    """
+    ASGI app for config, a config class or mapping (by default chosen like
+    app.py's); see app.create_app for what happens before it is returned
+    """
+    # Load environment variables
+    load_dotenv()
+
+    if config is None:
+        config = DevelopmentConfig if os.getenv('FLASK_ENV') == 'development' else ProductionConfig
+    if not isinstance(config, dict):
+        config = config_to_dict(config)
+
+    app = Starlette(
+        routes=routes,
+        lifespan=_lifespan,
+        middleware=[
+            Middleware(MetricsMiddleware, routes=routes),
+            # flask_cors defaults: any origin
+            Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+        ]
+    )
+    service = ExamService(config)
+    app.state.service = service
+
+    if config['WARM_UP_ON_START']:
+        service.warm_up()
+    return app
+
+def __getattr__(name):
+    # The default app (uvicorn asgi:app), built the first time something asks for it
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+if __name__ == '__main__':
+    import uvicorn
+    app = create_app()
+    uvicorn.run(app, host=app.state.service.config['HOST'], port=app.state.service.config['PORT'])
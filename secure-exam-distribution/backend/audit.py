@@ -0,0 +1,196 @@
+import os
+import json
+import queue
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from crypto_executor import CryptoBusyError
+
+try:
+    import fcntl
+except ImportError:  # Windows: rotation is only safe with a single worker
+    fcntl = None
+
+# Per-request fields (client address, route) added to every record, set by
+# the web layer for the request being handled
+request_context = contextvars.ContextVar('audit_request_context', default={})
+
+class AuditLogger:
+    """
+    JSON-lines audit log written by a background thread
+    log() only queues the record. The writer drains whatever has queued up
+    and appends it with a single write, under a file lock so workers sharing
+    the file neither interleave nor rotate it from under each other. Files
+    rotate like logging's RotatingFileHandler (audit.jsonl.1, .2, ...). When
+    the queue is full the record is dropped, immediately ('drop') or after
+    waiting up to block_timeout ('block'), and the next batch written
+    records how many were lost.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                 queue_size: int = 10000, overflow: str = 'drop', block_timeout: float = 1.0,
+                 batch_size: int = 1000):
+        if overflow not in ('drop', 'block'):
+            raise ValueError(f"Unknown audit overflow policy: {overflow}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self._fd = None
+        self.written = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self._reported_dropped = 0
+
+    def log(self, record: dict):
+        """Queue a record; never blocks longer than the overflow policy allows"""
+        self._ensure_writer()
+        try:
+            if self.overflow == 'block':
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until everything queued so far has been written"""
+        self._ensure_writer()
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'write_errors': self.write_errors
+            }
+
+    def _ensure_writer(self):
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid != os.getpid():
+                # A forked worker gets its own writer and file descriptor
+                self._fd = None
+                threading.Thread(target=self._run, name='audit-writer', daemon=True).start()
+                self._thread_pid = os.getpid()
+                atexit.register(self.flush, 2.0)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = [item for item in batch if isinstance(item, dict)]
+            with self._lock:
+                lost = self.dropped - self._reported_dropped
+                self._reported_dropped = self.dropped
+            if lost:
+                records.append({'timestamp': datetime.now().isoformat(), 'event': 'audit_overflow', 'dropped': lost})
+
+            if records:
+                lines = ''.join(json.dumps(record, default=str) + '\n' for record in records)
+                try:
+                    self._write(lines.encode('utf-8'))
+                    with self._lock:
+                        self.written += len(records)
+                except OSError:
+                    with self._lock:
+                        self.write_errors += 1
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write(self, data: bytes):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._reopen_if_rotated()
+            size = os.fstat(self._fd).st_size
+            if self.max_bytes and size and size + len(data) > self.max_bytes:
+                self._rotate()
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+
+    def _reopen_if_rotated(self):
+        """(Re)open the log if it is not open yet or another worker rotated it"""
+        if self._fd is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._fd).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def _rotate(self):
+        os.close(self._fd)
+        self._fd = None
+        for n in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{n}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{n + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._reopen_if_rotated()
+
+_audit_logger = AuditLogger(os.path.join('logs', 'audit.jsonl'))
+
+def configure_audit_logger(logger: AuditLogger):
+    """Send audit records to logger (built from the app config)"""
+    global _audit_logger
+    _audit_logger = logger
+
+def audit_logger() -> AuditLogger:
+    return _audit_logger
+
+def audit_log(event: str, **fields):
+    """Queue an audit record for event, with the current request's context"""
+    record = {'timestamp': datetime.now().isoformat(), 'event': event}
+    record.update(request_context.get())
+    record.update(fields)
+    _audit_logger.log(record)
+
+@contextmanager
+def audited(event: str, **fields):
+    """
+    Audit the operation in the with block
+    Yields a dict the block can add fields to. The record is written when
+    the block exits, with success, and for failures the error and the HTTP
+    status it maps to.
+    """
+    record = dict(fields)
+    try:
+        yield record
+    except CryptoBusyError as e:
+        audit_log(event, success=False, status=503, error=str(e), **record)
+        raise
+    except Exception as e:
+        status = getattr(e, 'status', 500)
+        audit_log(event, success=False, status=status, error=str(e), **record)
+        raise
+    audit_log(event, success=True, **record)
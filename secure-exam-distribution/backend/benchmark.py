@@ -0,0 +1,503 @@
+"""
+Benchmarks for the key derivation, encryption and /api/* hot paths
+
+    python benchmark.py run [--quick] [--only derive_key,crypto,api,load,startup] [--output results.json]
+    python benchmark.py compare baseline.json results.json [--threshold 0.1] [--p99-threshold 0.2]
+
+run writes JSON holding the machine and commit under 'meta' and, under
+'results', each benchmark's iterations, throughput (ops_per_sec, plus
+mb_per_sec for sized ones) and latency in milliseconds (mean, p50, p99,
+max). compare prints both runs side by side and exits 1 when a benchmark
+present in both lost more than threshold of its throughput or its p99
+grew by more than p99-threshold, so a run before and after a hot-path
+change can gate it. Compare runs from the same machine, left idle.
+
+The crypto benchmarks call encryption.py directly; derive_key uses a new
+salt each time, so every call is a full PBKDF2. The api benchmarks drive
+app.py through the Flask test client. The load benchmark models an exam
+start: it serves app.py on 127.0.0.1 (or targets a running server with
+--url), uploads --papers papers, then releases --clients students at
+once, each verifying the password and downloading one of them. The
+startup benchmark starts app.py in fresh interpreters against --archive
+stored papers, with and without WARM_UP_ON_START: import time, create_app
+time, time to the first /api/files response, and the first response of a
+worker forked after create_app (a preloading server's worker). The apps are
+built with create_app pointed at a scratch directory, without rate limiting
+or background threads.
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+KB = 1024
+MB = 1024 * 1024
+CRYPTO_SIZES = (10 * KB, 100 * KB, MB, 10 * MB, 50 * MB)
+API_SIZES = (10 * KB, MB, 10 * MB)
+QUICK_MAX_SIZE = MB
+PASSWORD = 'benchmark-password'
+BOUNDARY = 'benchmark-boundary-7f3a9c'
+
+# Rows /api/files pages through
+LIST_ROWS = 1000
+# Stored papers the startup benchmark opens, and how many starts it times
+STARTUP_ARCHIVE = 5000
+STARTUP_RUNS = 5
+
+def _percentile(ordered: list, fraction: float) -> float:
+    # Nearest rank
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def summarize(latencies: list, elapsed: float, size: int = 0, **extra) -> dict:
+    """Throughput and latency figures for latencies (seconds) measured over elapsed seconds"""
+    ordered = sorted(latencies)
+    result = {
+        'iterations': len(ordered),
+        'seconds': round(elapsed, 4),
+        'ops_per_sec': len(ordered) / elapsed if elapsed else 0.0,
+        'mean_ms': 1000 * sum(ordered) / len(ordered),
+        'p50_ms': 1000 * _percentile(ordered, 0.5),
+        'p99_ms': 1000 * _percentile(ordered, 0.99),
+        'max_ms': 1000 * ordered[-1],
+    }
+    if size:
+        result['mb_per_sec'] = size * len(ordered) / elapsed / MB
+    result.update(extra)
+    return result
+
+def measure(fn, min_seconds: float, min_iterations: int = 3, max_iterations: int = 10000, size: int = 0) -> dict:
+    """
+    Call fn after one warm-up call until it has run min_iterations times and
+    min_seconds have passed (or max_iterations), timing each call
+    """
+    fn()
+    latencies = []
+    elapsed = 0.0
+    while len(latencies) < max_iterations and (len(latencies) < min_iterations or elapsed < min_seconds):
+        started = time.perf_counter()
+        fn()
+        latency = time.perf_counter() - started
+        latencies.append(latency)
+        elapsed += latency
+    return summarize(latencies, elapsed, size)
+
+def measure_timed(fn, min_seconds: float, min_iterations: int = 3, size: int = 0) -> dict:
+    """measure() for an fn returning its own timing, leaving out its setup"""
+    fn()
+    latencies = []
+    while len(latencies) < min_iterations or sum(latencies) < min_seconds:
+        latencies.append(fn())
+    return summarize(latencies, sum(latencies), size)
+
+def _label(size: int) -> str:
+    return f'{size // MB}mb' if size >= MB else f'{size // KB}kb'
+
+def _multipart(fields: dict, filename: str, data: bytes) -> bytes:
+    """A multipart/form-data body (boundary BOUNDARY) of fields then the file part"""
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 'Content-Type: application/pdf\r\n\r\n'.encode())
+    parts.append(data)
+    parts.append(f'\r\n--{BOUNDARY}--\r\n'.encode())
+    return b''.join(parts)
+
+def _paper(size: int) -> bytes:
+    # Random, so uploads are never deduplicated against each other
+    return os.urandom(size)
+
+def bench_derive_key(args) -> dict:
+    from encryption import derive_key
+    return {'derive_key': measure(lambda: derive_key(PASSWORD, os.urandom(16)), args.min_seconds)}
+
+def bench_crypto(args) -> dict:
+    from encryption import encrypt_file, decrypt_file
+    results = {}
+    for size in _sizes(CRYPTO_SIZES, args):
+        data = _paper(size)
+        encrypted = encrypt_file(data, PASSWORD)
+        # Each encryption draws a new salt, so it includes a key derivation;
+        # decryption of the same file derives it once and then hits the key cache
+        results[f'encrypt_file_{_label(size)}'] = measure(
+            lambda: encrypt_file(data, PASSWORD), args.min_seconds, size=size)
+        results[f'decrypt_file_{_label(size)}'] = measure(
+            lambda: decrypt_file(encrypted, PASSWORD), args.min_seconds, size=size)
+    return results
+
+def bench_api(args, app) -> dict:
+    client = app.test_client()
+    service = app.extensions['exam_service']
+    content_type = f'multipart/form-data; boundary={BOUNDARY}'
+    fields = {'password': PASSWORD, 'subject': 'Benchmark', 'exam_date': '2030-01-01'}
+    results = {}
+
+    for size in _sizes(API_SIZES, args):
+        data = _paper(size)
+        uploaded = []
+
+        def upload():
+            # Vary the first bytes so every upload is a new blob
+            body = _multipart(fields, 'paper.pdf', os.urandom(16) + data[16:])
+            started = time.perf_counter()
+            response = client.post('/api/upload', data=body, content_type=content_type)
+            elapsed = time.perf_counter() - started
+            if response.status_code != 201:
+                raise RuntimeError(f'Upload failed: {response.status_code} {response.get_data(as_text=True)}')
+            uploaded.append(response.json['file_id'])
+            return elapsed
+
+        results[f'api_upload_{_label(size)}'] = measure_timed(upload, args.min_seconds, size=size)
+        file_id = uploaded[0]
+
+        def download():
+            response = client.post(f'/api/download/{file_id}', json={'password': PASSWORD})
+            body = response.get_data()
+            response.close()
+            if response.status_code != 200 or len(body) != size:
+                raise RuntimeError(f'Download failed: {response.status_code}')
+
+        results[f'api_download_{_label(size)}'] = measure(download, args.min_seconds, size=size)
+
+        for other in uploaded[1:]:
+            service.delete(other)
+
+    def verify():
+        response = client.post(f'/api/verify/{file_id}', json={'password': PASSWORD})
+        if response.status_code != 200:
+            raise RuntimeError(f'Verify failed: {response.status_code}')
+
+    results['api_verify'] = measure(verify, args.min_seconds, min_iterations=20)
+
+    # Extra records sharing one blob, so listing has something to page through
+    metadata = service.metadata_store.get(file_id)
+    for i in range(LIST_ROWS):
+        record = {k: v for k, v in metadata.items() if k != 'file_id'}
+        record['upload_time'] = (datetime.fromisoformat(metadata['upload_time'])
+                                 - timedelta(seconds=i + 1)).isoformat()
+        service.metadata_store.add(f'{file_id}_list{i}', record)
+
+    def list_files():
+        # A new query string each time, so the ETag never lets it off with a 304
+        response = client.get('/api/files', query_string={'limit': 100, 'sort': 'upload_time',
+                                                          'order': random.choice(('asc', 'desc'))})
+        if response.status_code != 200:
+            raise RuntimeError(f'Listing failed: {response.status_code}')
+
+    results['api_files'] = measure(list_files, args.min_seconds, min_iterations=20)
+    return results
+
+def bench_load(args, app=None) -> dict:
+    server = None
+    if args.url:
+        base = urlsplit(args.url)
+        host, port = base.hostname, base.port or 80
+    else:
+        from werkzeug.serving import make_server
+        # One access log line per request would swamp the results
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True).start()
+        host, port = '127.0.0.1', server.server_port
+
+    def request(method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection(host, port, timeout=args.timeout)
+        try:
+            started = time.perf_counter()
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            received = 0
+            while True:
+                chunk = response.read(64 * KB)
+                if not chunk:
+                    break
+                received += len(chunk)
+            return response.status, received, time.perf_counter() - started
+        finally:
+            connection.close()
+
+    try:
+        file_ids = []
+        for i in range(args.papers):
+            body = _multipart({'password': PASSWORD, 'subject': 'Benchmark', 'exam_date': '2030-01-01'},
+                              f'paper{i}.pdf', _paper(args.paper_size))
+            connection = http.client.HTTPConnection(host, port, timeout=args.timeout)
+            connection.request('POST', '/api/upload', body,
+                               {'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+            response = connection.getresponse()
+            reply = response.read()
+            connection.close()
+            if response.status != 201:
+                raise RuntimeError(f'Upload failed: {response.status} {reply[:200]!r}')
+            file_ids.append(json.loads(reply)['file_id'])
+
+        start = threading.Barrier(args.clients)
+        json_headers = {'Content-Type': 'application/json'}
+        password = json.dumps({'password': PASSWORD})
+
+        def student(index):
+            file_id = file_ids[index % len(file_ids)]
+            start.wait()
+            calls = []
+            for _ in range(args.rounds):
+                for operation, path in (('verify', f'/api/verify/{file_id}'),
+                                        ('download', f'/api/download/{file_id}')):
+                    try:
+                        status, received, latency = request('POST', path, password, json_headers)
+                    except OSError:
+                        status, received, latency = 0, 0, args.timeout
+                    calls.append((operation, status, received, latency))
+            return calls
+
+        burst_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            calls = [call for calls in pool.map(student, range(args.clients)) for call in calls]
+        elapsed = time.perf_counter() - burst_started
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    results = {}
+    for operation in ('verify', 'download'):
+        done = [call for call in calls if call[0] == operation]
+        ok = [call for call in done if call[1] == 200]
+        statuses = {}
+        for call in done:
+            statuses[str(call[1])] = statuses.get(str(call[1]), 0) + 1
+        if not ok:
+            raise RuntimeError(f'Every {operation} in the burst failed: {statuses}')
+        # Throughput counts successful requests over the whole burst
+        results[f'load_{operation}'] = summarize(
+            [call[3] for call in ok], elapsed,
+            args.paper_size if operation == 'download' else 0,
+            clients=args.clients, statuses=statuses
+        )
+        results[f'load_{operation}']['ops_per_sec'] = len(ok) / elapsed
+        if operation == 'download':
+            results['load_download']['mb_per_sec'] = sum(call[2] for call in ok) / elapsed / MB
+    return results
+
+# One start of app.py, run in a fresh interpreter so nothing is imported yet.
+# argv: the scratch settings as JSON, then 'warm' or 'lazy' (WARM_UP_ON_START).
+# Before its own first request it forks a worker, as a preloading server
+# would, which times its first request too. Prints the timings as JSON.
+_STARTUP_PROBE = """
+import json, os, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+from config import DevelopmentConfig, config_to_dict
+settings = dict(json.loads(sys.argv[1]), WARM_UP_ON_START=sys.argv[2] == 'warm')
+flask_app = app.create_app(dict(config_to_dict(DevelopmentConfig), **settings))
+created = time.perf_counter()
+
+def first_request():
+    began = time.perf_counter()
+    response = flask_app.test_client().get('/api/files')
+    if response.status_code != 200:
+        raise RuntimeError(f'Listing failed: {response.status_code}')
+    return time.perf_counter() - began
+
+read_end, write_end = os.pipe()
+pid = os.fork()
+if pid == 0:
+    try:
+        os.write(write_end, json.dumps(first_request()).encode())
+    finally:
+        os._exit(0)
+os.close(write_end)
+os.waitpid(pid, 0)
+worker = json.loads(os.read(read_end, 64))
+first = first_request()
+print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                  'ready': created - started + first, 'forked_worker': worker}))
+"""
+
+def bench_startup(args, scratch: str) -> dict:
+    """
+    Worker startup against an archive of args.archive stored papers: import,
+    create_app with and without WARM_UP_ON_START, time from interpreter start
+    to a first /api/files response, and a forked worker's first response
+    """
+    from storage import LocalBlobStore
+    from metadata_store import MetadataStore
+    settings = _scratch_settings(scratch)
+    blob_store = LocalBlobStore(settings['STORAGE_FOLDER'], fsync='off')
+    staged = os.path.join(scratch, 'staged')
+    for i in range(args.archive):
+        with open(staged, 'wb') as f:
+            f.write(_paper(KB))
+        blob_store.put(staged, f'{i:032x}')
+    # Recorded up front, so each start only has the steady-state reconcile to do
+    MetadataStore(settings['METADATA_DB_PATH']).rebuild_from_storage(blob_store, min_age=0)
+
+    timings = {}
+    backend = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(3 if args.quick else STARTUP_RUNS):
+        for mode in ('lazy', 'warm'):
+            probe = subprocess.run([sys.executable, '-c', _STARTUP_PROBE, json.dumps(settings), mode],
+                                   capture_output=True, text=True, cwd=backend)
+            if probe.returncode != 0:
+                raise RuntimeError(f'Startup probe failed: {probe.stderr[-500:]}')
+            for name, seconds in json.loads(probe.stdout.splitlines()[-1]).items():
+                key = 'startup_import' if name == 'import' else f'startup_{name}_{mode}'
+                timings.setdefault(key, []).append(seconds)
+
+    return {name: summarize(latencies, sum(latencies), archive=args.archive)
+            for name, latencies in sorted(timings.items())}
+
+def _sizes(sizes: tuple, args) -> tuple:
+    return tuple(size for size in sizes if not args.quick or size <= QUICK_MAX_SIZE)
+
+def _scratch_settings(scratch: str) -> dict:
+    """Settings serving from scratch, without rate limits or background threads"""
+    return {
+        'STORAGE_FOLDER': os.path.join(scratch, 'encrypted'),
+        'DECRYPTED_FOLDER': os.path.join(scratch, 'decrypted'),
+        'LOG_FOLDER': os.path.join(scratch, 'logs'),
+        'METADATA_DB_PATH': os.path.join(scratch, 'metadata.db'),
+        'DEDUP_KEY': 'benchmark-dedup-key',
+        'RATE_LIMIT_BACKEND': 'off',
+        'AUTO_CLEANUP_ENABLED': False,
+        'RELEASE_WARMUP_ENABLED': False,
+        'REKEY_ENABLED': False,
+    }
+
+def _load_app(scratch: str):
+    """app.py's Flask app (DevelopmentConfig) serving from scratch"""
+    from app import create_app
+    from config import DevelopmentConfig, config_to_dict
+    return create_app(dict(config_to_dict(DevelopmentConfig), **_scratch_settings(scratch)))
+
+def _meta(args) -> dict:
+    import cryptography
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'cryptography': cryptography.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'quick': args.quick,
+        'only': args.only,
+    }
+
+def run(args) -> dict:
+    suites = args.only.split(',')
+    unknown = set(suites) - {'derive_key', 'crypto', 'api', 'load', 'startup'}
+    if unknown:
+        raise SystemExit(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    results = {}
+    scratch = tempfile.mkdtemp(prefix='exam-benchmark-')
+    try:
+        if 'derive_key' in suites:
+            results.update(bench_derive_key(args))
+        if 'crypto' in suites:
+            results.update(bench_crypto(args))
+        if 'startup' in suites:
+            results.update(bench_startup(args, os.path.join(scratch, 'startup')))
+        app = _load_app(scratch) if 'api' in suites or ('load' in suites and not args.url) else None
+        if 'api' in suites:
+            results.update(bench_api(args, app))
+        if 'load' in suites:
+            results.update(bench_load(args, app))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {'meta': _meta(args), 'results': results}
+
+def compare(baseline: dict, current: dict, threshold: float, p99_threshold: float) -> list:
+    """Print the two runs side by side; returns the names of the benchmarks that regressed"""
+    regressed = []
+    print(f"{'benchmark':<28}{'ops/s':>12}{'was':>12}{'change':>9}{'p99 ms':>12}{'was':>12}{'change':>9}")
+    for name, before in baseline['results'].items():
+        after = current['results'].get(name)
+        if after is None:
+            print(f'{name:<28}  missing from the new run')
+            continue
+        throughput = after['ops_per_sec'] / before['ops_per_sec'] - 1 if before['ops_per_sec'] else 0.0
+        p99 = after['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0.0
+        failed = throughput < -threshold or p99 > p99_threshold
+        if failed:
+            regressed.append(name)
+        print(f"{name:<28}{after['ops_per_sec']:>12.2f}{before['ops_per_sec']:>12.2f}{throughput:>+9.1%}"
+              f"{after['p99_ms']:>12.2f}{before['p99_ms']:>12.2f}{p99:>+9.1%}"
+              f"{'  REGRESSED' if failed else ''}")
+    for name in current['results'].keys() - baseline['results'].keys():
+        print(f'{name:<28}  new, no baseline')
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the crypto and /api/* hot paths')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks and write their results as JSON')
+    run_parser.add_argument('--output', default='benchmark-results.json', help="JSON results file ('-' for stdout)")
+    run_parser.add_argument('--only', default='derive_key,crypto,api,load,startup',
+                            help='comma separated: derive_key, crypto, api, load, startup')
+    run_parser.add_argument('--quick', action='store_true', help=f'sizes up to {_label(QUICK_MAX_SIZE)} only')
+    run_parser.add_argument('--min-seconds', type=float, default=2.0, help='time spent measuring each benchmark')
+    run_parser.add_argument('--url', help='run the load benchmark against this server instead of a local one')
+    run_parser.add_argument('--clients', type=int, default=50, help='students starting at once')
+    run_parser.add_argument('--rounds', type=int, default=2, help='verify+download pairs per student')
+    run_parser.add_argument('--papers', type=int, default=5, help='papers the students share')
+    run_parser.add_argument('--paper-size', type=int, default=MB, help='bytes per paper')
+    run_parser.add_argument('--timeout', type=float, default=60.0)
+    run_parser.add_argument('--archive', type=int, default=STARTUP_ARCHIVE,
+                            help='stored papers the startup benchmark starts against')
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help='largest tolerated throughput loss, as a fraction')
+    compare_parser.add_argument('--p99-threshold', type=float, default=None,
+                                help='largest tolerated p99 latency growth, as a fraction (default: --threshold)')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        for key in ('quick', 'cpu_count'):
+            if baseline['meta'].get(key) != current['meta'].get(key):
+                print(f"Warning: runs differ in {key} ({baseline['meta'].get(key)} vs {current['meta'].get(key)})")
+        p99_threshold = args.p99_threshold if args.p99_threshold is not None else args.threshold
+        regressed = compare(baseline, current, args.threshold, p99_threshold)
+        if regressed:
+            print(f"{len(regressed)} regressed: {', '.join(regressed)}")
+            sys.exit(1)
+        return
+
+    report = run(args)
+    output = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        for name, result in report['results'].items():
+            print(f"{name:<28}{result['ops_per_sec']:>10.2f} ops/s  p99 {result['p99_ms']:>9.2f} ms")
+        print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
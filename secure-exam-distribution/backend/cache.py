@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire a fixed time after insertion
+    Keeps hit/miss/eviction counters for monitoring. When max_size and sizeof
+    are given the cache is also bounded by the total size of its values, and
+    on_evict is called with every value that leaves the cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 900, clock=time.monotonic,
+                 max_size: int = None, sizeof=None, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._sizeof = sizeof or (lambda value: 0)
+        self._on_evict = on_evict
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._size = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _lookup(self, key):
+        """Return the live entry for key, dropping it if expired. Lock must be held."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= self._clock():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def _remove(self, key):
+        """Drop key and notify on_evict. Lock must be held."""
+        value, _ = self._entries.pop(key)
+        self._size -= self._sizeof(value)
+        if self._on_evict:
+            self._on_evict(value)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """Store value; ttl overrides ttl_seconds for this entry"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, self._clock() + (self.ttl_seconds if ttl is None else ttl))
+            self._size += self._sizeof(value)
+            while len(self._entries) > self.max_entries or (
+                    self.max_size is not None and self._size > self.max_size and len(self._entries) > 1):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def get_or_compute(self, key, compute, ttl: float = None):
+        """
+        Return the cached value for key, computing it on a miss
+        Concurrent misses for the same key wait for a single computation
+        instead of all running it.
+        """
+        while True:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry[0]
+                waiter = self._inflight.get(key)
+                if waiter is None:
+                    self.misses += 1
+                    done = self._inflight[key] = threading.Event()
+                    break
+            waiter.wait()
+
+        try:
+            value = compute()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,78 @@
+"""
+Pick KDF parameters that take about a target time to derive on this machine
+
+    python calibrate_kdf.py [--algorithm pbkdf2-sha256|scrypt|argon2id]
+                            [--target-ms 250] [--max-memory-mb 64] [--lanes 1]
+
+Run it on the hardware that serves downloads. The cost is raised until one
+derivation takes target-ms, using at most max-memory-mb for the memory-hard
+algorithms: PBKDF2 iterations are scaled from a timed run, scrypt doubles n
+(r=8, p=1), and argon2id takes the whole memory budget and raises t. The
+result is printed as a KDF_PARAMS line for .env. Every derivation runs on a
+crypto worker, so target-ms is also roughly how long one cold download or
+verify holds a CPU.
+"""
+import argparse
+import os
+import time
+from encryption import KdfParams, check_kdf_params, format_kdf_params, derive_key
+
+def time_derivation(params: KdfParams, rounds: int = 3) -> float:
+    """Best of rounds derivation times with params, in seconds"""
+    check_kdf_params(params)
+    best = float('inf')
+    for _ in range(rounds):
+        # A new salt each round, so the derived key cache never answers
+        salt = os.urandom(16)
+        started = time.perf_counter()
+        derive_key('calibration password', salt, params)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def calibrate(algorithm: str, target: float, max_memory: int, lanes: int = 1) -> tuple:
+    """Parameters for algorithm taking about target seconds; returns (params, seconds)"""
+    if algorithm == 'pbkdf2-sha256':
+        # Linear in the iteration count
+        seconds = time_derivation(KdfParams(algorithm, (100000,)))
+        params = KdfParams(algorithm, (max(1000, int(round(100000 * target / seconds, -3))),))
+        return params, time_derivation(params)
+
+    if algorithm == 'scrypt':
+        # Memory is 128 * n * r bytes
+        n = 1024
+        params = KdfParams(algorithm, (n, 8, 1))
+        seconds = time_derivation(params)
+        while seconds < target and 128 * n * 2 * 8 <= max_memory:
+            n *= 2
+            params = KdfParams(algorithm, (n, 8, 1))
+            seconds = time_derivation(params)
+        return params, seconds
+
+    if algorithm == 'argon2id':
+        memory_kib = max(8 * lanes, max_memory // 1024)
+        t = 1
+        params = KdfParams(algorithm, (t, memory_kib, lanes))
+        seconds = time_derivation(params)
+        while seconds < target and t < 100:
+            t += 1
+            params = KdfParams(algorithm, (t, memory_kib, lanes))
+            seconds = time_derivation(params)
+        return params, seconds
+
+    raise ValueError(f"Unknown KDF: {algorithm}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Pick KDF_PARAMS for a target derivation time')
+    parser.add_argument('--algorithm', default='scrypt', choices=['pbkdf2-sha256', 'scrypt', 'argon2id'])
+    parser.add_argument('--target-ms', type=float, default=250)
+    parser.add_argument('--max-memory-mb', type=int, default=64,
+                        help='memory one derivation may use (scrypt, argon2id)')
+    parser.add_argument('--lanes', type=int, default=1, help='argon2id parallelism')
+    args = parser.parse_args()
+
+    params, seconds = calibrate(args.algorithm, args.target_ms / 1000, args.max_memory_mb * 1024 * 1024, args.lanes)
+    print(f"# {seconds * 1000:.0f} ms per derivation")
+    print(f"KDF_PARAMS={format_kdf_params(params)}")
+
+if __name__ == '__main__':
+    main()
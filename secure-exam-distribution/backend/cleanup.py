@@ -0,0 +1,204 @@
+import os
+import time
+import itertools
+import threading
+from datetime import date, timedelta
+from utils import clean_temp_files
+from metrics import CLEANUP_RUNS, CLEANUP_REMOVED, CLEANUP_BYTES, CLEANUP_LAST_RUN
+
+try:
+    import fcntl
+except ImportError:  # Windows: every worker runs its own cleanup
+    fcntl = None
+
+# Longest wait between checks whether a run is due, so a run a limit left
+# unfinished, or one due while its worker was restarting, starts soon after
+POLL_SECONDS = 300
+
+# Stored blobs looked at per orphan removal a run may make
+ORPHAN_SCAN_FACTOR = 10
+
+class CleanupScheduler:
+    """
+    Incremental cleanup, run every interval_hours from a background thread
+    A run removes upload staging files and DECRYPTED_FOLDER files older
+    than temp_max_age_hours, rotated logs older than log_retention_days,
+    blobs no paper references (once they are as old as a staging file
+    could be) and, if retention_days is set, papers whose exam_date is more
+    than that many days ago. Each kind is capped at batch_size removals per
+    run, pausing between them, so a backlog is worked off over several
+    short runs instead of one I/O burst; a run that hits a cap is repeated
+    after POLL_SECONDS rather than a full interval.
+
+    Workers share a lock file holding the time of the last complete run.
+    Whoever gets the lock runs if that is at least interval_hours ago, the
+    others skip, so one worker does the work wherever the thread runs.
+    """
+
+    def __init__(self, service, lock_path: str, interval_hours: float = 6, temp_max_age_hours: float = 24,
+                 retention_days: int = 0, log_retention_days: int = 90, batch_size: int = 500,
+                 pause: float = 0.01):
+        self.service = service
+        self.lock_path = lock_path
+        self.interval = interval_hours * 3600
+        self.temp_max_age_hours = temp_max_age_hours
+        self.retention_days = retention_days
+        self.log_retention_days = log_retention_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        self._blob_ids = None
+
+    def start(self):
+        """Start the scheduler thread in this process, and in every process forked from it"""
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            if self._thread_pid is None:
+                os.register_at_fork(after_in_child=self.start)
+            threading.Thread(target=self._run, name='cleanup', daemon=True).start()
+            self._thread_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.interval, POLL_SECONDS))
+            try:
+                self.run_once()
+            except Exception as e:
+                CLEANUP_RUNS.inc('failed')
+                print(f"Cleanup run failed: {str(e)}")
+
+    def run_once(self, force: bool = False):
+        """
+        Run cleanup now if it is due (or force) and no other worker is running it
+        Returns {kind: {'removed': n, 'bytes': n}}, or None if the run was skipped.
+        """
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        with open(self.lock_path, 'a+') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+            lock_file.seek(0)
+            try:
+                last_run = float(lock_file.read() or 0)
+            except ValueError:
+                last_run = 0
+            if not force and time.time() - last_run < self.interval:
+                return None
+
+            reclaimed = {}
+            complete = True
+            for kind, task in (('staged', self._clean_staged), ('decrypted', self._clean_decrypted),
+                               ('logs', self._clean_logs), ('orphans', self._clean_orphans),
+                               ('expired', self._expire_papers)):
+                try:
+                    removed, size, finished = task()
+                except Exception as e:
+                    print(f"Error during {kind} cleanup: {str(e)}")
+                    removed, size, finished = 0, 0, False
+                reclaimed[kind] = {'removed': removed, 'bytes': size}
+                CLEANUP_REMOVED.inc(kind, amount=removed)
+                CLEANUP_BYTES.inc(kind, amount=size)
+                complete = complete and finished
+
+            if complete:
+                lock_file.seek(0)
+                lock_file.truncate()
+                lock_file.write(str(time.time()))
+            CLEANUP_RUNS.inc('done' if complete else 'partial')
+            CLEANUP_LAST_RUN.set(time.time())
+            return reclaimed
+
+    def _clean_files(self, directory: str, max_age_hours: float, match=None) -> tuple:
+        removed, size = clean_temp_files(directory, max_age_hours, self.batch_size, match, self.pause)
+        return removed, size, removed < self.batch_size
+
+    def _clean_staged(self) -> tuple:
+        """Encryption staging files left behind by uploads that died mid-way"""
+        return self._clean_files(self.service.storage_folder, self.temp_max_age_hours, _is_staged_upload)
+
+    def _clean_decrypted(self) -> tuple:
+        return self._clean_files(self.service.config['DECRYPTED_FOLDER'], self.temp_max_age_hours)
+
+    def _clean_logs(self) -> tuple:
+        if not self.log_retention_days:
+            return 0, 0, True
+        return self._clean_files(self.service.config['LOG_FOLDER'], self.log_retention_days * 24, _is_old_log)
+
+    def _clean_orphans(self) -> tuple:
+        """
+        Blobs without a metadata row, e.g. from an upload whose record failed
+        to commit. A blob is stored just before its row is written, so only
+        blobs older than any upload could take are considered.
+        """
+        blob_store = self.service.blob_store
+        metadata_store = self.service.metadata_store
+        if self._blob_ids is None:
+            # Carried over between runs, so each run continues the scan
+            self._blob_ids = blob_store.iter_blob_ids()
+        cutoff = time.time() - self.temp_max_age_hours * 3600
+        removed = 0
+        reclaimed = 0
+
+        scanned = 0
+        for blob_id in itertools.islice(self._blob_ids, self.batch_size * ORPHAN_SCAN_FACTOR):
+            scanned += 1
+            if metadata_store.get_blob(blob_id) is not None:
+                continue
+            try:
+                if blob_store.modified(blob_id) > cutoff:
+                    continue
+                size = blob_store.size(blob_id)
+            except Exception:
+                # Removed meanwhile
+                continue
+            blob_store.delete(blob_id)
+            removed += 1
+            reclaimed += size
+            if removed >= self.batch_size:
+                return removed, reclaimed, False
+            if self.pause:
+                time.sleep(self.pause)
+
+        if scanned < self.batch_size * ORPHAN_SCAN_FACTOR:
+            self._blob_ids = None
+            return removed, reclaimed, True
+        return removed, reclaimed, False
+
+    def _expire_papers(self) -> tuple:
+        """Papers past retention, deleted like DELETE /api/delete but audited as 'expire'"""
+        if not self.retention_days:
+            return 0, 0, True
+        metadata_store = self.service.metadata_store
+        cutoff = (date.today() - timedelta(days=self.retention_days + 1)).isoformat()
+        # The lower bound skips records whose exam_date is empty rather than a date
+        records = metadata_store.query_files(
+            {'exam_date_from': '0001-01-01', 'exam_date_to': cutoff}, sort='exam_date', limit=self.batch_size
+        )
+
+        removed = 0
+        reclaimed = 0
+        for record in records:
+            blob = metadata_store.get_blob(record['blob_id'])
+            try:
+                self.service.delete(record['file_id'], event='expire')
+            except Exception as e:
+                print(f"Error expiring {record['file_id']}: {str(e)}")
+                continue
+            removed += 1
+            if blob is not None and blob['ref_count'] == 1:
+                reclaimed += blob['encrypted_size'] or 0
+            if self.pause:
+                time.sleep(self.pause)
+        return removed, reclaimed, len(records) < self.batch_size
+
+def _is_staged_upload(name: str) -> bool:
+    # streaming.write_temp names
+    return name.startswith('.upload-') and name.endswith('.tmp')
+
+def _is_old_log(name: str) -> bool:
+    """Rotated logs (audit.jsonl.1, ...) and plain .log files; the live audit log is never touched"""
+    return name.rsplit('.', 1)[-1].isdigit() or name.endswith('.log')
@@ -14,11 +14,39 @@ class Config:
     # Server Configuration
     HOST = os.environ.get('FLASK_HOST', '0.0.0.0')
     PORT = int(os.environ.get('FLASK_PORT', 5000))
+    # create_app() opens the metadata and blob stores (reconciling them) and runs
+    # the cipher once before returning; otherwise the first request does it. With
+    # a preloading server (gunicorn --preload) that happens once, before forking
+    WARM_UP_ON_START = os.environ.get('WARM_UP_ON_START', 'True').lower() == 'true'
     
     # File Storage Configuration
     STORAGE_FOLDER = os.path.join(BASE_DIR, 'storage', 'encrypted')
     DECRYPTED_FOLDER = os.path.join(BASE_DIR, 'storage', 'decrypted')
     LOG_FOLDER = os.path.join(BASE_DIR, 'logs')
+    METADATA_DB_PATH = os.environ.get('METADATA_DB_PATH', os.path.join(BASE_DIR, 'storage', 'metadata.db'))
+    
+    # Blob Storage Configuration ('local' keeps blobs in STORAGE_FOLDER, 's3' needs boto3)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    STORAGE_LAYOUT = os.environ.get('STORAGE_LAYOUT', 'sharded')  # or 'flat'; see migrate_storage.py
+    STORAGE_FSYNC = os.environ.get('STORAGE_FSYNC', 'batch')  # 'batch', 'async' or 'off'
+    # Local blobs are read through shared read-only mmaps, up to this many at
+    # once (0 reads them with plain file handles); see LocalBlobStore
+    STORAGE_MMAP_ENTRIES = int(os.environ.get('STORAGE_MMAP_ENTRIES', 256))
+    STORAGE_MMAP_MAX_BYTES = int(os.environ.get('STORAGE_MMAP_MAX_BYTES', 4 * 1024 * 1024 * 1024))
+    STORAGE_MMAP_TTL_SECONDS = 600
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_PREFIX = os.environ.get('S3_PREFIX', '')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+    # A blob no paper references any more (deleted, or replaced by re-keying)
+    # stays this long in S3 so downloads already streaming it can finish
+    S3_COLLECT_DELAY_SECONDS = int(os.environ.get('S3_COLLECT_DELAY_SECONDS', 600))
+    # Keys the content addresses uploads are deduplicated by, so the index cannot
+    # be matched against the hash of a known document. Required outside testing
+    DEDUP_KEY = os.environ.get('DEDUP_KEY')
+    # An upload identical to a stored paper shares its blob when the uploader's
+    # password opens the blob. Each try is a key derivation on the crypto
+    # executor, so at most this many are made per upload
+    DEDUP_MAX_ATTEMPTS = int(os.environ.get('DEDUP_MAX_ATTEMPTS', 4))
     
     # File Upload Configuration
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
@@ -34,23 +62,101 @@ class Config:
     CORS_ORIGINS = ['http://localhost:3000', 'http://127.0.0.1:3000']
     
     # Encryption Configuration
-    ENCRYPTION_ALGORITHM = 'AES-256-CBC'
-    KEY_DERIVATION_ITERATIONS = 100000
+    ENCRYPTION_ALGORITHM = 'AES-256-GCM'  # chunked, see encryption.py
+    KEY_DERIVATION_ITERATIONS = int(os.environ.get('KEY_DERIVATION_ITERATIONS', 100000))
+    
+    # KDF turning passwords into the keys that open papers, e.g.
+    # 'scrypt:n=32768,r=8,p=1' or 'argon2id:t=3,m=65536,p=4' (see
+    # calibrate_kdf.py). Papers are encrypted with random data keys, wrapped
+    # per password in the metadata database, which must be backed up with
+    # the blobs. Older papers keep working; with REKEY_ENABLED each is
+    # brought up to date in the background after its next download (see rekey.py)
+    KDF_PARAMS = os.environ.get('KDF_PARAMS', f'pbkdf2-sha256:i={KEY_DERIVATION_ITERATIONS}')
+    REKEY_ENABLED = os.environ.get('REKEY_ENABLED', 'True').lower() == 'true'
+    REKEY_QUEUE_SIZE = 100
+    # No re-keying while any paper is within this many minutes of its
+    # release_time, so it never competes with a release burst
+    REKEY_QUIET_MINUTES = int(os.environ.get('REKEY_QUIET_MINUTES', 60))
+    
+    # Derived key cache (skips PBKDF2 on repeated verify/download)
+    KDF_CACHE_ENABLED = os.environ.get('KDF_CACHE_ENABLED', 'True').lower() == 'true'
+    KDF_CACHE_MAX_ENTRIES = int(os.environ.get('KDF_CACHE_MAX_ENTRIES', 1024))
+    KDF_CACHE_TTL_SECONDS = int(os.environ.get('KDF_CACHE_TTL_SECONDS', 900))
+    
+    # Decrypt-once plaintext cache for release-window download bursts (opt-in).
+    # Entries live in mlocked memory until the paper's release window closes,
+    # PLAINTEXT_CACHE_TTL_SECONDS after its release_time (or its first download).
+    PLAINTEXT_CACHE_ENABLED = os.environ.get('PLAINTEXT_CACHE_ENABLED', 'False').lower() == 'true'
+    PLAINTEXT_CACHE_MAX_BYTES = int(os.environ.get('PLAINTEXT_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+    PLAINTEXT_CACHE_MAX_ENTRY_BYTES = 50 * 1024 * 1024
+    PLAINTEXT_CACHE_TTL_SECONDS = int(os.environ.get('PLAINTEXT_CACHE_TTL_SECONDS', 1800))
+    
+    # Crypto executor ('thread' or 'process') running key derivations; requests
+    # needing one get 503 once CRYPTO_WORKERS + CRYPTO_MAX_PENDING are in flight
+    CRYPTO_EXECUTOR = os.environ.get('CRYPTO_EXECUTOR', 'thread')
+    CRYPTO_WORKERS = int(os.environ.get('CRYPTO_WORKERS', os.cpu_count() or 1))
+    CRYPTO_MAX_PENDING = int(os.environ.get('CRYPTO_MAX_PENDING', 4 * (os.cpu_count() or 1)))
+    CRYPTO_JOB_TIMEOUT = int(os.environ.get('CRYPTO_JOB_TIMEOUT', 30))
+    CRYPTO_RETRY_AFTER = 2
+    
+    # Bulk uploads (/api/upload/batch): papers encrypted at once, papers per
+    # batch and the request body limit replacing MAX_CONTENT_LENGTH
+    BATCH_UPLOAD_WORKERS = int(os.environ.get('BATCH_UPLOAD_WORKERS', os.cpu_count() or 1))
+    BATCH_MAX_FILES = 500
+    BATCH_MAX_CONTENT_LENGTH = int(os.environ.get('BATCH_MAX_CONTENT_LENGTH', 2 * 1024 * 1024 * 1024))
     
-    # Rate Limiting (requests per minute)
+    # Bundle downloads (/api/bundle): papers per zip, and how many decrypt ahead of the writer
+    BUNDLE_MAX_FILES = 100
+    BUNDLE_PARALLEL = int(os.environ.get('BUNDLE_PARALLEL', 4))
+    
+    # Scheduled release: papers without a release_time open at the start of their
+    # exam_date when RELEASE_ON_EXAM_DATE is set, and papers are checked and paged
+    # in from RELEASE_WARMUP_MINUTES before their release (see release.py)
+    RELEASE_ON_EXAM_DATE = os.environ.get('RELEASE_ON_EXAM_DATE', 'False').lower() == 'true'
+    RELEASE_WARMUP_ENABLED = os.environ.get('RELEASE_WARMUP_ENABLED', 'True').lower() == 'true'
+    RELEASE_WARMUP_MINUTES = int(os.environ.get('RELEASE_WARMUP_MINUTES', 15))
+    RELEASE_WARMUP_POLL_SECONDS = 30
+    # Sent as X-Admin-Token, lets PUT /api/release bring a pending release forward or
+    # clear it. Without it a paper's password only allows postponing (students hold it)
+    RELEASE_ADMIN_TOKEN = os.environ.get('RELEASE_ADMIN_TOKEN')
+    
+    # Rate Limiting (requests per minute, per client and route; see ratelimit.py).
+    # Buckets live in RATE_LIMIT_DB_PATH ('sqlite', shared by this host's workers),
+    # Redis ('redis', shared by every host), this process ('memory') or nowhere ('off')
     RATE_LIMIT_UPLOAD = 10
     RATE_LIMIT_DOWNLOAD = 20
     RATE_LIMIT_GENERAL = 100
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'sqlite')
+    RATE_LIMIT_DB_PATH = os.environ.get('RATE_LIMIT_DB_PATH', os.path.join(BASE_DIR, 'storage', 'ratelimit.db'))
+    RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0')
+    # Comma-separated addresses or CIDR ranges of the reverse proxies in front of the
+    # app. Requests from them are counted and audited as the client named in
+    # X-Forwarded-For; the header is ignored from anyone else, as clients can forge it
+    TRUSTED_PROXIES = os.environ.get('TRUSTED_PROXIES', '')
     
-    # Cleanup Configuration
+    # Cleanup Configuration (see cleanup.py). Each run removes at most
+    # CLEANUP_BATCH_SIZE files of each kind; papers are only expired when
+    # RETENTION_DAYS (days after their exam_date) is set
+    AUTO_CLEANUP_ENABLED = os.environ.get('AUTO_CLEANUP_ENABLED', 'True').lower() == 'true'
     TEMP_FILE_MAX_AGE_HOURS = 24
-    AUTO_CLEANUP_INTERVAL_HOURS = 6
+    AUTO_CLEANUP_INTERVAL_HOURS = float(os.environ.get('AUTO_CLEANUP_INTERVAL_HOURS', 6))
+    CLEANUP_BATCH_SIZE = 500
+    CLEANUP_PAUSE_SECONDS = 0.01
+    RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 0))
+    LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', 90))
     
     # Logging Configuration
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
     LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     LOG_MAX_BYTES = 10 * 1024 * 1024  # 10MB
     LOG_BACKUP_COUNT = 5
+    
+    # Audit log (LOG_FOLDER/audit.jsonl, rotated by LOG_MAX_BYTES/LOG_BACKUP_COUNT).
+    # When AUDIT_QUEUE_SIZE records are waiting, new ones are dropped ('drop') or
+    # wait up to AUDIT_BLOCK_TIMEOUT seconds first ('block')
+    AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+    AUDIT_OVERFLOW = os.environ.get('AUDIT_OVERFLOW', 'drop')
+    AUDIT_BLOCK_TIMEOUT = 1.0
 
 class DevelopmentConfig(Config):
     """Development configuration"""
@@ -88,9 +194,17 @@ class TestingConfig(Config):
     STORAGE_FOLDER = '/tmp/exam_system_test/storage'
     DECRYPTED_FOLDER = '/tmp/exam_system_test/decrypted'
     LOG_FOLDER = '/tmp/exam_system_test/logs'
+    METADATA_DB_PATH = '/tmp/exam_system_test/metadata.db'
+    RATE_LIMIT_DB_PATH = '/tmp/exam_system_test/ratelimit.db'
+    
+    DEDUP_KEY = 'testing-dedup-key'
     
     # Disable CSRF for testing
     WTF_CSRF_ENABLED = False
+    AUTO_CLEANUP_ENABLED = False
+    RELEASE_WARMUP_ENABLED = False
+    REKEY_ENABLED = False
+    WARM_UP_ON_START = False
 
 # Configuration dictionary
 config = {
@@ -105,6 +219,10 @@ def get_config():
     config_name = os.environ.get('FLASK_ENV', 'development')
     return config.get(config_name, config['default'])
 
+def config_to_dict(config_object) -> dict:
+    """Uppercase settings of a config class, the same keys Flask's from_object reads"""
+    return {key: getattr(config_object, key) for key in dir(config_object) if key.isupper()}
+
 # Application-specific constants
 class AppConstants:
     """Application constants"""
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+class CryptoBusyError(Exception):
+    """Raised when the crypto executor is saturated; maps to 503 + Retry-After"""
+
+    def __init__(self, message: str = 'Server is busy, please retry', retry_after: int = 2):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _timed_call(fn, args):
+    """Run fn in the worker and report how long it took there"""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+class CryptoExecutor:
+    """
+    Bounded pool for CPU-bound crypto (the service's key derivations)
+    kind is 'thread' (cryptography releases the GIL inside OpenSSL) or
+    'process'. At most max_workers + max_pending jobs are admitted at once;
+    beyond that submit raises CryptoBusyError instead of queueing without
+    bound. The pool is created on first use so it is never inherited
+    across a fork. AES-GCM segments stay on the request thread, interleaved
+    with its I/O, so a saturated pool refuses new key derivations but never
+    stalls a download already streaming.
+    """
+
+    def __init__(self, kind: str = 'thread', max_workers: int = None, max_pending: int = None,
+                 timeout: float = 30, retry_after: int = 2):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = self.max_workers * 4 if max_pending is None else max_pending
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_pending)
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+        self._jobs = {}
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                pool_class = ThreadPoolExecutor if self.kind == 'thread' else ProcessPoolExecutor
+                self._pool = pool_class(max_workers=self.max_workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def submit(self, name: str, fn, *args):
+        """
+        Queue fn(*args) and return a Future of its result
+        Raises CryptoBusyError when the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise CryptoBusyError(retry_after=self.retry_after)
+
+        submitted = time.perf_counter()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._get_pool().submit(_timed_call, fn, args)
+        except BaseException:
+            self._release()
+            raise
+
+        outer = _JobFuture(future)
+        future.add_done_callback(lambda f: self._finish(name, submitted, f, outer))
+        return outer
+
+    def run(self, name: str, fn, *args, timeout: float = None):
+        """Submit fn(*args) and wait for its result"""
+        future = self.submit(name, fn, *args)
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            raise CryptoBusyError('Crypto operation timed out', retry_after=self.retry_after)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _finish(self, name, submitted, future, outer):
+        total = time.perf_counter() - submitted
+        error = future.exception()
+        run_seconds = 0.0 if error else future.result()[1]
+
+        with self._lock:
+            job = self._jobs.setdefault(name, {
+                'count': 0, 'errors': 0, 'run_seconds': 0.0, 'wait_seconds': 0.0, 'max_run_seconds': 0.0
+            })
+            job['count'] += 1
+            job['errors'] += 1 if error else 0
+            job['run_seconds'] += run_seconds
+            job['wait_seconds'] += max(total - run_seconds, 0.0)
+            job['max_run_seconds'] = max(job['max_run_seconds'], run_seconds)
+        self._release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'kind': self.kind,
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'in_flight': self._in_flight,
+                'rejected': self._rejected,
+                'jobs': {name: dict(job) for name, job in self._jobs.items()}
+            }
+
+class _JobFuture:
+    """Future wrapper that strips the timing from _timed_call results"""
+
+    def __init__(self, future):
+        self._future = future
+
+    def result(self, timeout: float = None):
+        return self._future.result(timeout)[0]
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def exception(self, timeout: float = None):
+        return self._future.exception(timeout)
@@ -1,95 +1,667 @@
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.primitives import hashes, padding
 from cryptography.hazmat.backends import default_backend
 import os
+import io
+import hmac
+import time
+import struct
 import base64
+import hashlib
+from collections import namedtuple
+from cache import TTLCache
+from crypto_executor import CryptoBusyError
+from metrics import StageTimer, observe_stage
+from streaming import BufferReader
 
-def derive_key(password: str, salt: bytes) -> bytes:
-    """Derive encryption key from password using PBKDF2"""
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,  # 256 bits for AES-256
-        salt=salt,
-        iterations=100000,  # High iteration count for security
-        backend=default_backend()
-    )
+# Key derivation settings. Files record theirs in the header (format version
+# 3); earlier files and derive_key() callers that give none use LEGACY_KDF.
+# Parameters per algorithm, as written in KDF_PARAMS specs and stored in the
+# header as three integers:
+#   pbkdf2-sha256  i (iterations)
+#   scrypt         n (CPU/memory cost, a power of 2), r (block size), p (parallelism)
+#   argon2id       t (iterations), m (memory in KiB), p (lanes)
+KdfParams = namedtuple('KdfParams', ['algorithm', 'params'])
+KDF_ALGORITHMS = {
+    1: ('pbkdf2-sha256', ('i',)),
+    2: ('scrypt', ('n', 'r', 'p')),
+    3: ('argon2id', ('t', 'm', 'p')),
+}
+KDF_IDS = {name: kdf_id for kdf_id, (name, _) in KDF_ALGORITHMS.items()}
+LEGACY_KDF = KdfParams('pbkdf2-sha256', (100000,))
+
+# Upper bounds on what a header may ask for, so a damaged or forged header
+# cannot make a single derivation take minutes or gigabytes
+MAX_PBKDF2_ITERATIONS = 10000000
+MAX_KDF_MEMORY = 1024 * 1024 * 1024
+MAX_KDF_PARALLELISM = 64
+
+# Derived keys are cached per (salt, keyed password hash, parameters) so
+# repeated verify and download calls for the same paper skip the KDF.
+# Passwords themselves are never stored; the hash key is random per process.
+_key_cache = TTLCache(max_entries=1024, ttl_seconds=900)
+_key_cache_enabled = True
+_password_hash_key = os.urandom(32)
+
+# Optional CryptoExecutor that runs the KDF off the request thread
+_kdf_executor = None
+
+# Parameters new files are encrypted with
+_kdf_params = LEGACY_KDF
+
+def configure_key_cache(enabled: bool = True, max_entries: int = 1024, ttl_seconds: float = 900):
+    """Apply cache settings from the app config"""
+    global _key_cache_enabled
+    _key_cache_enabled = enabled
+    _key_cache.max_entries = max_entries
+    _key_cache.ttl_seconds = ttl_seconds
+    _key_cache.clear()
+
+def configure_kdf(params: KdfParams):
+    """Encrypt new files with params (see parse_kdf_params)"""
+    global _kdf_params
+    check_kdf_params(params)
+    _kdf_params = params
+
+def kdf_params() -> KdfParams:
+    """The parameters new files are encrypted with"""
+    return _kdf_params
+
+def parse_kdf_params(spec: str) -> KdfParams:
+    """Parse a spec such as 'pbkdf2-sha256:i=600000' or 'scrypt:n=32768,r=8,p=1'"""
+    algorithm, _, settings = spec.strip().partition(':')
+    if algorithm not in KDF_IDS:
+        raise ValueError(f"Unknown KDF: {algorithm}")
+    names = KDF_ALGORITHMS[KDF_IDS[algorithm]][1]
+    try:
+        values = dict(setting.split('=', 1) for setting in settings.split(',') if setting)
+        params = KdfParams(algorithm, tuple(int(values.pop(name)) for name in names))
+    except (KeyError, ValueError):
+        raise ValueError(f"KDF {algorithm} needs {', '.join(f'{name}=<int>' for name in names)}")
+    if values:
+        raise ValueError(f"Unknown {algorithm} parameters: {', '.join(values)}")
+    check_kdf_params(params)
+    return params
+
+def format_kdf_params(params: KdfParams) -> str:
+    names = KDF_ALGORITHMS[KDF_IDS[params.algorithm]][1]
+    return f"{params.algorithm}:{','.join(f'{n}={v}' for n, v in zip(names, params.params))}"
+
+def check_kdf_params(params: KdfParams):
+    """Raise ValueError unless params are usable and within the limits above"""
+    if params.algorithm == 'pbkdf2-sha256':
+        (iterations,) = params.params
+        valid = 0 < iterations <= MAX_PBKDF2_ITERATIONS
+    elif params.algorithm == 'scrypt':
+        n, r, p = params.params
+        valid = (n > 1 and n & (n - 1) == 0 and 0 < r and 0 < p <= MAX_KDF_PARALLELISM
+                 and 128 * n * r <= MAX_KDF_MEMORY)
+    elif params.algorithm == 'argon2id':
+        t, m, p = params.params
+        valid = 0 < t <= 100 and 8 * p <= m <= MAX_KDF_MEMORY // 1024 and 0 < p <= MAX_KDF_PARALLELISM
+    else:
+        valid = False
+    if not valid:
+        raise ValueError(f"Invalid KDF parameters: {params}")
+
+def _derive(params: KdfParams, password: str, salt: bytes) -> bytes:
+    # 256-bit keys for AES-256
+    if params.algorithm == 'pbkdf2-sha256':
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=params.params[0],
+            backend=default_backend()
+        )
+    elif params.algorithm == 'scrypt':
+        n, r, p = params.params
+        kdf = Scrypt(salt=salt, length=32, n=n, r=r, p=p, backend=default_backend())
+    else:
+        try:
+            from cryptography.hazmat.primitives.kdf.argon2 import Argon2id
+        except ImportError:
+            raise RuntimeError("KDF argon2id requires cryptography 44 or later")
+        t, m, p = params.params
+        kdf = Argon2id(salt=salt, length=32, iterations=t, lanes=p, memory_cost=m)
     return kdf.derive(password.encode('utf-8'))
 
+def set_kdf_executor(executor):
+    """Run key derivations on executor (a CryptoExecutor), or inline if None"""
+    global _kdf_executor
+    _kdf_executor = executor
+
+def key_cache_stats() -> dict:
+    """Hit/miss/eviction counters of the derived key cache"""
+    stats = _key_cache.stats()
+    stats['enabled'] = _key_cache_enabled
+    return stats
+
+def _compute_key(password: str, salt: bytes, params: KdfParams) -> bytes:
+    started = time.perf_counter()
+    if _kdf_executor is None:
+        key = _derive(params, password, bytes(salt))
+    else:
+        key = _kdf_executor.run('kdf', _derive, params, password, bytes(salt))
+    observe_stage('derive_key', 'kdf', started)
+    return key
+
+def derive_key(password: str, salt: bytes, params: KdfParams = None) -> bytes:
+    """Derive encryption key from password with params (LEGACY_KDF by default)"""
+    params = params or LEGACY_KDF
+    if not _key_cache_enabled:
+        return _compute_key(password, salt, params)
+    
+    password_hash = hmac.new(_password_hash_key, password.encode('utf-8'), hashlib.sha256).digest()
+    return _key_cache.get_or_compute((bytes(salt), password_hash, params),
+                                     lambda: _compute_key(password, salt, params))
+
+# Chunked on-disk format (version 3), integers big-endian:
+#   [4 bytes magic][1 byte version][4 bytes chunk size][1 byte KDF id][3 x 4 bytes KDF params]
+#   [16 bytes salt][7 bytes nonce prefix][16 bytes key check]
+# followed by AES-256-GCM segments of `chunk size` plaintext bytes (the last one
+# may be shorter or empty), each with a 16-byte tag appended. The segment nonce
+# is nonce prefix + 4-byte segment counter + 1-byte final flag, and the whole
+# header is passed as associated data so it cannot be altered or truncated.
+# The key check is a truncated HMAC of the derived key, so a password can be
+# verified from the header alone. Version 2 is the same without the KDF fields
+# (always LEGACY_KDF), and version 1 without the key check as well.
+#
+# Version 4 files are encrypted with a random data key instead of a password:
+#   [4 bytes magic][1 byte version][4 bytes chunk size][7 bytes nonce prefix][16 bytes key check]
+# and the data key is kept elsewhere, wrapped by one key slot per password
+# (see wrap_data_key), so passwords change without touching the file. The
+# functions below accept a DataKey wherever they take a password.
+#
+# Files without the magic are the legacy format:
+#   [16 bytes salt][16 bytes IV][AES-256-CBC PKCS7 padded data]
+FORMAT_MAGIC = b'SEXD'
+FORMAT_VERSION = 3
+CHUNK_SIZE = 64 * 1024
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+KEY_CHECK_SIZE = 16
+KEY_CHECK_LABEL = b'secure-exam-distribution key check'
+HEADER_STRUCTS = {
+    1: struct.Struct('>4sBI16s7s'),
+    2: struct.Struct('>4sBI16s7s16s'),
+    3: struct.Struct('>4sBIBIII16s7s16s'),
+    4: struct.Struct('>4sBI7s16s'),
+}
+ENVELOPE_VERSION = 4
+DATA_KEY_SIZE = 32
+HEADER_SIZE = HEADER_STRUCTS[FORMAT_VERSION].size
+LEGACY_HEADER_SIZE = 32
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+FileHeader = namedtuple('FileHeader', ['version', 'chunk_size', 'salt', 'nonce_prefix', 'key_check', 'raw', 'kdf'])
+
+# A data key wrapped by a password: the KDF parameters and salt giving the
+# key-encryption key, and the AES-GCM nonce + encrypted data key + tag
+KeySlot = namedtuple('KeySlot', ['kdf', 'salt', 'wrapped'])
+KEY_SLOT_LABEL = b'secure-exam-distribution key slot'
+
+
+class DataKey(bytes):
+    """A version 4 file's random data key, passed where a password is accepted"""
+
+    def __repr__(self) -> str:
+        return 'DataKey(...)'
+
+
+def generate_data_key() -> DataKey:
+    return DataKey(os.urandom(DATA_KEY_SIZE))
+
+
+def _key_slot_aad(kdf: KdfParams, salt: bytes) -> bytes:
+    return KEY_SLOT_LABEL + format_kdf_params(kdf).encode() + bytes(salt)
+
+
+def wrap_data_key(data_key: DataKey, password: str, kdf: KdfParams = None) -> KeySlot:
+    """Key slot opening data_key with password, derived with kdf (by default configure_kdf()'s)"""
+    kdf = kdf or _kdf_params
+    salt = os.urandom(SALT_SIZE)
+    nonce = os.urandom(12)
+    aead = AESGCM(derive_key(password, salt, kdf))
+    return KeySlot(kdf, salt, nonce + aead.encrypt(nonce, bytes(data_key), _key_slot_aad(kdf, salt)))
+
+
+def unwrap_data_key(slot: KeySlot, password: str) -> DataKey:
+    """The data key in slot; raises ValueError if password does not open it"""
+    check_kdf_params(slot.kdf)
+    aead = AESGCM(derive_key(password, slot.salt, slot.kdf))
+    wrapped = bytes(slot.wrapped)
+    try:
+        return DataKey(aead.decrypt(wrapped[:12], wrapped[12:], _key_slot_aad(slot.kdf, slot.salt)))
+    except InvalidTag:
+        raise ValueError("invalid password")
+
+
+def _file_key(header, password) -> bytes:
+    """The AES key of a chunked file: its data key for version 4, else derived from password"""
+    if header.version >= ENVELOPE_VERSION:
+        if not isinstance(password, DataKey):
+            raise ValueError("File is encrypted with a data key, not a password")
+        return bytes(password)
+    if isinstance(password, DataKey):
+        raise ValueError("File is encrypted with a password, not a data key")
+    return derive_key(password, header.salt, header.kdf)
+
+
+class _IterReader:
+    """Minimal file-like reader over an iterable of byte strings"""
+
+    def __init__(self, iterable):
+        self._iter = iter(iterable)
+        self._buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                piece = next(self._iter)
+            except StopIteration:
+                break
+            self._buffer += piece
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _as_reader(source):
+    """Accept bytes, a file-like object or an iterable of bytes"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # Reads are slices, not copies
+        return BufferReader(source)
+    if hasattr(source, 'read'):
+        return source
+    return _IterReader(source)
+
+
+def _read_exact(reader, size: int) -> bytes:
+    """
+    Read up to `size` bytes, looping over short reads until EOF
+    A memoryview from a BufferReader is passed through as it is.
+    """
+    data = reader.read(size)
+    if not data or len(data) == size:
+        return data
+    parts = [data]
+    remaining = size - len(data)
+    while remaining:
+        piece = reader.read(remaining)
+        if not piece:
+            break
+        parts.append(piece)
+        remaining -= len(piece)
+    return b''.join(parts)
+
+
+def _segment_nonce(nonce_prefix: bytes, counter: int, final: bool) -> bytes:
+    return nonce_prefix + struct.pack('>IB', counter, 1 if final else 0)
+
+
+def encrypt_stream(source, password: str, chunk_size: int = CHUNK_SIZE, kdf: KdfParams = None):
+    """
+    Encrypt a file-like object or iterable of bytes in constant memory
+    Yields the header followed by one encrypted segment per chunk. The key
+    is derived with kdf, by default the parameters set by configure_kdf(),
+    unless password is a DataKey, which writes a version 4 file.
+    """
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError("Invalid chunk size")
+
+    reader = _as_reader(source)
+    nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+    if isinstance(password, DataKey):
+        key = bytes(password)
+        header = HEADER_STRUCTS[ENVELOPE_VERSION].pack(
+            FORMAT_MAGIC, ENVELOPE_VERSION, chunk_size, nonce_prefix, _key_check(key)
+        )
+    else:
+        kdf = kdf or _kdf_params
+        salt = os.urandom(SALT_SIZE)
+        key = derive_key(password, salt, kdf)
+        kdf_values = kdf.params + (0,) * (3 - len(kdf.params))
+        header = HEADER_STRUCTS[FORMAT_VERSION].pack(
+            FORMAT_MAGIC, FORMAT_VERSION, chunk_size, KDF_IDS[kdf.algorithm], *kdf_values,
+            salt, nonce_prefix, _key_check(key)
+        )
+    aead = AESGCM(key)
+
+    yield header
+
+    # Look one chunk ahead so the last segment can be flagged as final
+    timer = StageTimer('encrypt')
+    try:
+        counter = 0
+        pending = _read_exact(reader, chunk_size)
+        while True:
+            following = _read_exact(reader, chunk_size) if len(pending) == chunk_size else b''
+            final = not following
+            started = time.perf_counter()
+            segment = aead.encrypt(_segment_nonce(nonce_prefix, counter, final), pending, header)
+            timer.add('cipher', started)
+            yield segment
+            if final:
+                return
+            counter += 1
+            pending = following
+    finally:
+        timer.finish()
+
+
+def _key_check(key: bytes) -> bytes:
+    return hmac.new(key, KEY_CHECK_LABEL, hashlib.sha256).digest()[:KEY_CHECK_SIZE]
+
+
+def _read_header(reader) -> tuple:
+    """
+    Read the file header, returns (preamble, header)
+    header is None for legacy files, whose salt and IV are the 32-byte preamble
+    Both are bytes, so parsed headers never keep a shared mapping alive.
+    """
+    preamble = bytes(_read_exact(reader, LEGACY_HEADER_SIZE))
+    if len(preamble) < LEGACY_HEADER_SIZE:
+        raise ValueError("Invalid encrypted file format")
+    if preamble[:len(FORMAT_MAGIC)] != FORMAT_MAGIC:
+        return preamble, None
+
+    version = preamble[len(FORMAT_MAGIC)]
+    header_struct = HEADER_STRUCTS.get(version)
+    if header_struct is None:
+        raise ValueError(f"Unsupported encrypted file version: {version}")
+
+    raw = preamble + bytes(_read_exact(reader, header_struct.size - LEGACY_HEADER_SIZE))
+    if len(raw) < header_struct.size:
+        raise ValueError("Encrypted file is truncated")
+
+    fields = header_struct.unpack(raw)
+    chunk_size = fields[2]
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError("Invalid chunk size in header")
+    if version >= ENVELOPE_VERSION:
+        nonce_prefix, key_check = fields[3:]
+        return preamble, FileHeader(version, chunk_size, None, nonce_prefix, key_check, raw, None)
+    if version >= 3:
+        kdf_id, *kdf_values = fields[3:7]
+        if kdf_id not in KDF_ALGORITHMS:
+            raise ValueError(f"Unknown KDF in header: {kdf_id}")
+        algorithm, names = KDF_ALGORITHMS[kdf_id]
+        kdf = KdfParams(algorithm, tuple(kdf_values[:len(names)]))
+        check_kdf_params(kdf)
+        fields = fields[:3] + fields[7:]
+    else:
+        kdf = LEGACY_KDF
+    salt, nonce_prefix, *rest = fields[3:]
+    key_check = rest[0] if rest else None
+    return preamble, FileHeader(version, chunk_size, salt, nonce_prefix, key_check, raw, kdf)
+
+
+def key_check_matches(header, password: str) -> bool:
+    """Check password (or DataKey) against a header's key check value (version 2 and later)"""
+    if header is None or header.key_check is None:
+        raise ValueError("Header has no key check")
+    return hmac.compare_digest(_key_check(_file_key(header, password)), header.key_check)
+
+
+def read_header(source):
+    """Parse the header of an encrypted file, returns None for legacy files"""
+    return _read_header(_as_reader(source))[1]
+
+
+def plaintext_size(header, encrypted_size: int):
+    """Exact plaintext size of a chunked file, None for legacy files"""
+    if header is None:
+        return None
+    body = encrypted_size - len(header.raw)
+    if body < TAG_SIZE:
+        raise ValueError("Encrypted file is truncated")
+    segments = -(-body // (header.chunk_size + TAG_SIZE))
+    return body - segments * TAG_SIZE
+
+
+def _decrypt_segments(reader, header: bytes, aead, chunk_size: int, nonce_prefix: bytes):
+    segment_size = chunk_size + TAG_SIZE
+    timer = StageTimer('decrypt')
+    try:
+        counter = 0
+        started = time.perf_counter()
+        pending = _read_exact(reader, segment_size)
+        timer.add('disk_read', started)
+        if len(pending) < TAG_SIZE:
+            raise ValueError("Encrypted file is truncated")
+        while True:
+            started = time.perf_counter()
+            following = _read_exact(reader, segment_size) if len(pending) == segment_size else b''
+            timer.add('disk_read', started)
+            final = not following
+            if not final and len(following) < TAG_SIZE:
+                raise ValueError("Encrypted file is truncated")
+            started = time.perf_counter()
+            plaintext = aead.decrypt(_segment_nonce(nonce_prefix, counter, final), pending, header)
+            timer.add('cipher', started)
+            yield plaintext
+            if final:
+                return
+            counter += 1
+            pending = following
+    finally:
+        timer.finish()
+
+
+def _legacy_cipher(key: bytes, iv: bytes):
+    return Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+
+
+def _check_legacy_tail(reader, key: bytes):
+    """
+    Check the padding of the last CBC block of a seekable legacy file, which is
+    what the full decrypt would reject on a wrong password, without reading the
+    rest of the file
+    """
+    position = reader.tell()
+    end = reader.seek(0, io.SEEK_END)
+    data_size = end - LEGACY_HEADER_SIZE
+    if data_size <= 0 or data_size % 16:
+        raise ValueError("Invalid encrypted file format")
+
+    # The block before the last one (or the IV) is the CBC input for the last
+    reader.seek(end - 32)
+    tail = bytes(_read_exact(reader, 32))
+    reader.seek(position)
+
+    decryptor = _legacy_cipher(key, tail[:16]).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    unpadder.update(decryptor.update(tail[16:]) + decryptor.finalize())
+    unpadder.finalize()
+
+
+def _decrypt_legacy(reader, preamble: bytes, key: bytes):
+    """Stream-decrypt the legacy whole-file AES-256-CBC format"""
+    decryptor = _legacy_cipher(key, preamble[16:32]).decryptor()
+    unpadder = padding.PKCS7(128).unpadder()
+    timer = StageTimer('decrypt')
+
+    try:
+        while True:
+            started = time.perf_counter()
+            block = reader.read(CHUNK_SIZE)
+            timer.add('disk_read', started)
+            if not block:
+                break
+            started = time.perf_counter()
+            data = unpadder.update(decryptor.update(block))
+            timer.add('cipher', started)
+            if data:
+                yield data
+        yield unpadder.update(decryptor.finalize()) + unpadder.finalize()
+    finally:
+        timer.finish()
+
+
+def _is_seekable(reader) -> bool:
+    seekable = getattr(reader, 'seekable', None)
+    return bool(seekable and seekable())
+
+
+def decrypt_stream(source, password: str):
+    """
+    Decrypt a file-like object or iterable of bytes in constant memory
+    The header is parsed and the first segment authenticated before this
+    returns, so a wrong password raises here rather than mid-stream.
+    Legacy salt+IV files are decrypted through the CBC code path; when the
+    source is seekable their final padding is checked up front as well.
+    """
+    try:
+        reader = _as_reader(source)
+        preamble, header = _read_header(reader)
+
+        if header is None:
+            key = derive_key(password, preamble[:16])
+            if _is_seekable(reader):
+                _check_legacy_tail(reader, key)
+            return _decrypt_legacy(reader, preamble, key)
+
+        key = _file_key(header, password)
+        if header.key_check is not None and not hmac.compare_digest(_key_check(key), header.key_check):
+            raise ValueError("invalid password")
+
+        aead = AESGCM(key)
+        segments = _decrypt_segments(reader, header.raw, aead, header.chunk_size, header.nonce_prefix)
+        first = next(segments)
+    except InvalidTag:
+        raise Exception("Decryption failed: authentication failed")
+    except CryptoBusyError:
+        raise
+    except Exception as e:
+        raise Exception(f"Decryption failed: {str(e)}")
+
+    return _chain_first(first, segments)
+
+
+def verify_password(source, password: str) -> bool:
+    """
+    Check a password against an encrypted file without decrypting it
+    Only the header is read for the current format. Version 1 files need their
+    first segment, and legacy files their last block (or a full pass when the
+    source cannot seek).
+    """
+    reader = _as_reader(source)
+    preamble, header = _read_header(reader)
+
+    try:
+        if header is None:
+            key = derive_key(password, preamble[:16])
+            if _is_seekable(reader):
+                _check_legacy_tail(reader, key)
+            else:
+                for _ in _decrypt_legacy(reader, preamble, key):
+                    pass
+            return True
+
+        if header.key_check is not None:
+            return key_check_matches(header, password)
+
+        aead = AESGCM(_file_key(header, password))
+        next(_decrypt_segments(reader, header.raw, aead, header.chunk_size, header.nonce_prefix))
+        return True
+    except (InvalidTag, ValueError):
+        return False
+
+
+def _chain_first(first: bytes, segments):
+    yield first
+    try:
+        yield from segments
+    except InvalidTag:
+        raise Exception("Decryption failed: authentication failed")
+
+
+def decrypt_range(source, password: str, start: int, stop: int, encrypted_size: int):
+    """
+    Decrypt plaintext bytes [start, stop) of a seekable chunked file
+    Only the segments covering the range are read and authenticated. The
+    password is checked before this returns, like decrypt_stream.
+    """
+    try:
+        reader = _as_reader(source)
+        reader.seek(0)
+        _, header = _read_header(reader)
+        if header is None:
+            raise ValueError("Legacy files do not support ranges")
+
+        size = plaintext_size(header, encrypted_size)
+        if not 0 <= start < stop <= size:
+            raise ValueError("Range not satisfiable")
+
+        key = _file_key(header, password)
+        if header.key_check is not None and not hmac.compare_digest(_key_check(key), header.key_check):
+            raise ValueError("invalid password")
+    except CryptoBusyError:
+        raise
+    except Exception as e:
+        raise Exception(f"Decryption failed: {str(e)}")
+
+    return _decrypt_segment_range(reader, header, AESGCM(key), start, stop, size)
+
+
+def _decrypt_segment_range(reader, header, aead, start: int, stop: int, size: int):
+    chunk_size = header.chunk_size
+    segment_size = chunk_size + TAG_SIZE
+    last_segment = max(size - 1, 0) // chunk_size
+    timer = StageTimer('decrypt')
+
+    try:
+        for index in range(start // chunk_size, (stop - 1) // chunk_size + 1):
+            started = time.perf_counter()
+            reader.seek(len(header.raw) + index * segment_size)
+            segment = _read_exact(reader, segment_size)
+            timer.add('disk_read', started)
+            nonce = _segment_nonce(header.nonce_prefix, index, index == last_segment)
+            started = time.perf_counter()
+            try:
+                plaintext = aead.decrypt(nonce, segment, header.raw)
+            except InvalidTag:
+                raise Exception("Decryption failed: authentication failed")
+            timer.add('cipher', started)
+
+            segment_start = index * chunk_size
+            yield plaintext[max(start - segment_start, 0):stop - segment_start]
+    finally:
+        timer.finish()
+
+
 def encrypt_file(file_content: bytes, password: str) -> bytes:
     """
-    Encrypt file content using AES-256-CBC
-    Returns encrypted content with salt and IV prepended
+    Encrypt file content using chunked AES-256-GCM
+    Returns the header followed by the encrypted segments
     """
     try:
-        # Generate random salt and IV
-        salt = os.urandom(16)  # 128-bit salt
-        iv = os.urandom(16)    # 128-bit IV for AES
-        
-        # Derive key from password
-        key = derive_key(password, salt)
-        
-        # Create cipher
-        cipher = Cipher(
-            algorithms.AES(key),
-            modes.CBC(iv),
-            backend=default_backend()
-        )
-        encryptor = cipher.encryptor()
-        
-        # Pad data to be multiple of 16 bytes (AES block size)
-        padder = padding.PKCS7(128).padder()
-        padded_data = padder.update(file_content)
-        padded_data += padder.finalize()
-        
-        # Encrypt the data
-        encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-        
-        # Combine salt + IV + encrypted_data
-        # Format: [16 bytes salt][16 bytes IV][encrypted data]
-        result = salt + iv + encrypted_data
-        
-        return result
-        
+        return b''.join(encrypt_stream(file_content, password))
+    except CryptoBusyError:
+        raise
     except Exception as e:
         raise Exception(f"Encryption failed: {str(e)}")
 
 def decrypt_file(encrypted_content: bytes, password: str) -> bytes:
     """
-    Decrypt file content using AES-256-CBC
-    Expects encrypted content with salt and IV prepended
+    Decrypt file content produced by encrypt_file
+    Accepts both the chunked format and legacy salt+IV files
     """
     try:
-        # Extract salt, IV, and encrypted data
-        if len(encrypted_content) < 32:  # At least salt + IV
-            raise ValueError("Invalid encrypted file format")
-        
-        salt = encrypted_content[:16]
-        iv = encrypted_content[16:32]
-        encrypted_data = encrypted_content[32:]
-        
-        # Derive key from password
-        key = derive_key(password, salt)
-        
-        # Create cipher
-        cipher = Cipher(
-            algorithms.AES(key),
-            modes.CBC(iv),
-            backend=default_backend()
-        )
-        decryptor = cipher.decryptor()
-        
-        # Decrypt the data
-        padded_data = decryptor.update(encrypted_data) + decryptor.finalize()
-        
-        # Remove padding
-        unpadder = padding.PKCS7(128).unpadder()
-        file_content = unpadder.update(padded_data)
-        file_content += unpadder.finalize()
-        
-        return file_content
-        
+        return b''.join(decrypt_stream(encrypted_content, password))
+    except CryptoBusyError:
+        raise
     except Exception as e:
+        if str(e).startswith("Decryption failed"):
+            raise
         raise Exception(f"Decryption failed: {str(e)}")
 
 def generate_file_hash(file_content: bytes) -> str:
@@ -0,0 +1,598 @@
+import os
+import base64
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from encryption import (read_header, plaintext_size, KeySlot, format_kdf_params, parse_kdf_params,
+                        ENVELOPE_VERSION)
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        file_id TEXT PRIMARY KEY,
+        original_filename TEXT NOT NULL,
+        secure_filename TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        exam_date TEXT NOT NULL,
+        upload_time TEXT NOT NULL,
+        file_size INTEGER NOT NULL,
+        content_hash TEXT,
+        encrypted_path TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_files_subject ON files(subject);
+    CREATE INDEX IF NOT EXISTS idx_files_exam_date ON files(exam_date);
+    CREATE INDEX IF NOT EXISTS idx_files_upload_time ON files(upload_time);
+    """,
+    # Keyset pagination indexes and a change counter for list ETags
+    """
+    CREATE INDEX IF NOT EXISTS idx_files_upload_time_id ON files(upload_time, file_id);
+    CREATE INDEX IF NOT EXISTS idx_files_exam_date_id ON files(exam_date, file_id);
+    CREATE INDEX IF NOT EXISTS idx_files_subject_upload_time ON files(subject, upload_time, file_id);
+    CREATE TABLE IF NOT EXISTS store_state (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    INSERT OR IGNORE INTO store_state (name, value) VALUES ('files_version', 0);
+    CREATE TRIGGER IF NOT EXISTS files_version_insert AFTER INSERT ON files BEGIN
+        UPDATE store_state SET value = value + 1 WHERE name = 'files_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_version_update AFTER UPDATE ON files BEGIN
+        UPDATE store_state SET value = value + 1 WHERE name = 'files_version';
+    END;
+    CREATE TRIGGER IF NOT EXISTS files_version_delete AFTER DELETE ON files BEGIN
+        UPDATE store_state SET value = value + 1 WHERE name = 'files_version';
+    END;
+    """,
+    # Deduplicated storage: each file references a stored blob, and blobs are
+    # reference counted. Existing files each own the blob named after them.
+    """
+    CREATE TABLE IF NOT EXISTS blobs (
+        blob_id TEXT PRIMARY KEY,
+        content_address TEXT,
+        ref_count INTEGER NOT NULL,
+        encrypted_size INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_blobs_content_address ON blobs(content_address);
+    ALTER TABLE files ADD COLUMN blob_id TEXT;
+    UPDATE files SET blob_id = secure_filename;
+    INSERT OR IGNORE INTO blobs (blob_id, ref_count) SELECT blob_id, COUNT(*) FROM files GROUP BY blob_id;
+    CREATE INDEX IF NOT EXISTS idx_files_blob_id ON files(blob_id);
+    """,
+    # Scheduled release: downloads of a paper open at its release_time (NULL: always open)
+    """
+    ALTER TABLE files ADD COLUMN release_time TEXT;
+    CREATE INDEX IF NOT EXISTS idx_files_release_time ON files(release_time);
+    """,
+    # Envelope encryption: a paper whose blob is encrypted with a data key has
+    # that key wrapped once per password (kdf is a KDF_PARAMS spec)
+    """
+    CREATE TABLE IF NOT EXISTS key_slots (
+        slot_id TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        label TEXT,
+        kdf TEXT NOT NULL,
+        salt BLOB NOT NULL,
+        wrapped_key BLOB NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_key_slots_file_id ON key_slots(file_id);
+    """,
+    # files_version starts at 0 in every database, so list ETags also hash a
+    # random epoch drawn once per database
+    """
+    INSERT OR IGNORE INTO store_state (name, value) VALUES ('epoch', random());
+    """,
+]
+
+# Columns /api/files may sort on, and the filters it understands
+SORT_COLUMNS = ('upload_time', 'exam_date')
+FILTERS = {
+    'subject': 'subject = ?',
+    'exam_date_from': 'exam_date >= ?',
+    'exam_date_to': 'exam_date <= ?',
+    'uploaded_after': 'upload_time >= ?',
+    'uploaded_before': 'upload_time < ?',
+}
+
+FILE_COLUMNS = (
+    'file_id', 'original_filename', 'secure_filename', 'subject', 'exam_date',
+    'upload_time', 'file_size', 'content_hash', 'encrypted_path', 'blob_id', 'release_time'
+)
+
+KEY_SLOT_COLUMNS = ('slot_id', 'file_id', 'label', 'kdf', 'salt', 'wrapped_key', 'created_at')
+
+# A blob is stored just before its record is written, and another worker may
+# be in between: rebuild_from_storage leaves blobs younger than this alone
+REBUILD_MIN_AGE_SECONDS = 600
+
+class MetadataStore:
+    """
+    Persistent exam paper metadata in SQLite (WAL mode)
+    One connection is kept per thread and reopened after a fork, so every
+    gunicorn worker reads the same committed state.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._migrate()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction holding the database lock from the start"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _migrate(self):
+        with self._transaction() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in _split_statements(script):
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {number}')
+
+    def add(self, file_id: str, metadata: dict, blob: dict = None, key_slot: dict = None) -> bool:
+        """
+        Insert the record for file_id, referencing the blob in metadata['blob_id']
+        With blob (content_address and encrypted_size) the blob is new and
+        starts with one reference; otherwise the existing blob gains one.
+        key_slot, if given, is the paper's first key slot. Returns False,
+        inserting nothing, if that blob has been garbage collected in the
+        meantime.
+        """
+        record = dict(metadata, file_id=file_id)
+        columns = [c for c in FILE_COLUMNS if c in record]
+        with self._transaction() as conn:
+            if blob is not None:
+                conn.execute(
+                    'INSERT INTO blobs (blob_id, content_address, ref_count, encrypted_size) VALUES (?, ?, 1, ?)',
+                    (record['blob_id'], blob['content_address'], blob['encrypted_size'])
+                )
+            else:
+                cursor = conn.execute(
+                    'UPDATE blobs SET ref_count = ref_count + 1 WHERE blob_id = ? AND ref_count > 0',
+                    (record['blob_id'],)
+                )
+                if cursor.rowcount == 0:
+                    return False
+            conn.execute(
+                f"INSERT INTO files ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [record[c] for c in columns]
+            )
+            if key_slot is not None:
+                _insert_key_slot(conn, dict(key_slot, file_id=file_id))
+        return True
+
+    def find_blobs(self, content_address: str) -> list:
+        """Live blobs holding the content with this address, one per key"""
+        rows = self._connection().execute(
+            'SELECT * FROM blobs WHERE content_address = ? AND ref_count > 0', (content_address,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_blob(self, blob_id: str):
+        row = self._connection().execute('SELECT * FROM blobs WHERE blob_id = ?', (blob_id,)).fetchone()
+        return dict(row) if row else None
+
+    def blob_content_hash(self, blob_id: str):
+        """The content hash recorded at upload by one of blob_id's papers, or None"""
+        row = self._connection().execute(
+            'SELECT content_hash FROM files WHERE blob_id = ? AND content_hash IS NOT NULL LIMIT 1', (blob_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get(self, file_id: str):
+        """Return the metadata dict for file_id, or None"""
+        row = self._connection().execute(
+            'SELECT * FROM files WHERE file_id = ?', (file_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def delete(self, file_id: str, collect=None) -> bool:
+        """
+        Remove the record for file_id and drop its blob reference
+        When that was the last reference the blob row goes too, and
+        collect(blob_id) is called before committing so the stored blob is
+        removed while no upload can take a new reference to it.
+        """
+        with self._transaction() as conn:
+            row = conn.execute('SELECT blob_id FROM files WHERE file_id = ?', (file_id,)).fetchone()
+            if row is None:
+                return False
+            blob_id = row[0]
+            conn.execute('DELETE FROM key_slots WHERE file_id = ?', (file_id,))
+            conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+            conn.execute('UPDATE blobs SET ref_count = ref_count - 1 WHERE blob_id = ?', (blob_id,))
+            garbage = conn.execute(
+                'DELETE FROM blobs WHERE blob_id = ? AND ref_count <= 0', (blob_id,)
+            ).rowcount
+            if garbage and collect is not None:
+                collect(blob_id)
+        return True
+
+    def replace_blob(self, blob_id: str, new_blob_id: str, encrypted_size: int, location: str,
+                     collect=None, key_slot: dict = None, content_address: str = None) -> bool:
+        """
+        Point every file referencing blob_id at new_blob_id, the same content
+        stored again (re-encrypted), which takes over all its references and
+        its content address unless given a new one. With key_slot each of
+        those files gets a copy of it, replacing any slots it had. The old
+        blob row goes, and collect(blob_id) is called before committing, as
+        in delete(). Returns False, changing nothing, if blob_id has no
+        references left.
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT content_address, ref_count FROM blobs WHERE blob_id = ? AND ref_count > 0', (blob_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            conn.execute(
+                'INSERT INTO blobs (blob_id, content_address, ref_count, encrypted_size) VALUES (?, ?, ?, ?)',
+                (new_blob_id, content_address or row[0], row[1], encrypted_size)
+            )
+            if key_slot is not None:
+                file_ids = [r[0] for r in conn.execute('SELECT file_id FROM files WHERE blob_id = ?', (blob_id,))]
+                conn.executemany('DELETE FROM key_slots WHERE file_id = ?', [(f,) for f in file_ids])
+                for file_id in file_ids:
+                    _insert_key_slot(conn, dict(key_slot, slot_id=_slot_id(), file_id=file_id))
+            conn.execute('UPDATE files SET blob_id = ?, encrypted_path = ? WHERE blob_id = ?',
+                         (new_blob_id, location, blob_id))
+            conn.execute('DELETE FROM blobs WHERE blob_id = ?', (blob_id,))
+            if collect is not None:
+                collect(blob_id)
+        return True
+
+    def key_slots(self, file_id: str) -> list:
+        """file_id's key slots, oldest first"""
+        rows = self._connection().execute(
+            'SELECT * FROM key_slots WHERE file_id = ? ORDER BY created_at, slot_id', (file_id,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def blob_key_slots(self, blob_id: str, limit: int = None) -> list:
+        """
+        The key slots of the papers referencing blob_id, oldest first and at
+        most limit. Copies of one slot (same KDF and salt, given to papers
+        sharing the blob) are returned once.
+        """
+        rows = self._connection().execute(
+            'SELECT key_slots.* FROM key_slots JOIN files USING (file_id) WHERE files.blob_id = ? '
+            'GROUP BY key_slots.kdf, key_slots.salt ORDER BY MIN(key_slots.created_at) LIMIT ?',
+            (blob_id, -1 if limit is None else limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def add_key_slot(self, file_id: str, key_slot: dict):
+        """Give file_id another key slot, returning its slot_id (None if there is no such file)"""
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM files WHERE file_id = ?', (file_id,)).fetchone() is None:
+                return None
+            return _insert_key_slot(conn, dict(key_slot, file_id=file_id))
+
+    def update_key_slot(self, slot_id: str, key_slot: dict, wrapped_key: bytes) -> bool:
+        """
+        Rewrite a slot (a new password, or new KDF settings) if it still holds
+        wrapped_key, so a slot revoked or changed meanwhile stays that way
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                'UPDATE key_slots SET kdf = ?, salt = ?, wrapped_key = ?, created_at = ? '
+                'WHERE slot_id = ? AND wrapped_key = ?',
+                (key_slot['kdf'], key_slot['salt'], key_slot['wrapped_key'], key_slot['created_at'],
+                 slot_id, wrapped_key)
+            ).rowcount > 0
+
+    def delete_key_slot(self, file_id: str, slot_id: str) -> bool:
+        """Remove one of file_id's key slots, never its last one; False if nothing was removed"""
+        with self._transaction() as conn:
+            return conn.execute(
+                'DELETE FROM key_slots WHERE file_id = ? AND slot_id = ? '
+                'AND (SELECT COUNT(*) FROM key_slots WHERE file_id = ?) > 1',
+                (file_id, slot_id, file_id)
+            ).rowcount > 0
+
+    def set_release_time(self, file_id: str, release_time: str, now: str = None) -> bool:
+        """
+        Reschedule file_id (None releases it now); False if there is no such
+        file. Given now, a release still pending at now is only ever moved
+        later: bringing it forward or clearing it returns False as well.
+        """
+        with self._transaction() as conn:
+            if now is None:
+                return conn.execute(
+                    'UPDATE files SET release_time = ? WHERE file_id = ?', (release_time, file_id)
+                ).rowcount > 0
+            return conn.execute(
+                'UPDATE files SET release_time = ? WHERE file_id = ? '
+                'AND (release_time IS NULL OR release_time <= ? OR ? >= release_time)',
+                (release_time, file_id, now, release_time)
+            ).rowcount > 0
+
+    def releasing_between(self, start: str, end: str, limit: int = 500) -> list:
+        """Records with a release_time in [start, end], soonest first"""
+        rows = self._connection().execute(
+            'SELECT * FROM files WHERE release_time BETWEEN ? AND ? ORDER BY release_time LIMIT ?',
+            (start, end, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def version(self) -> int:
+        """Counter bumped by every change to the files table, in any worker"""
+        return self._connection().execute(
+            "SELECT value FROM store_state WHERE name = 'files_version'"
+        ).fetchone()[0]
+
+    def epoch(self) -> int:
+        """Random number drawn when this database was created, telling its versions from another's"""
+        return self._connection().execute(
+            "SELECT value FROM store_state WHERE name = 'epoch'"
+        ).fetchone()[0]
+
+    def query_files(self, filters: dict = None, sort: str = 'upload_time', descending: bool = False,
+                    after: tuple = None, limit: int = 100) -> list:
+        """
+        One page of records matching filters, ordered by (sort, file_id)
+        after is the (sort value, file_id) of the last record of the previous
+        page, so each page is an index range scan rather than an OFFSET.
+        """
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Cannot sort by {sort}")
+        where, params = _where(filters)
+        if after is not None:
+            where.append(f"({sort}, file_id) {'<' if descending else '>'} (?, ?)")
+            params.extend(after)
+        direction = 'DESC' if descending else 'ASC'
+
+        rows = self._connection().execute(
+            f"SELECT * FROM files {_where_sql(where)} "
+            f"ORDER BY {sort} {direction}, file_id {direction} LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count_files(self, filters: dict = None) -> int:
+        where, params = _where(filters)
+        return self._connection().execute(
+            f'SELECT COUNT(*) FROM files {_where_sql(where)}', params
+        ).fetchone()[0]
+
+    def iter_files(self, page_size: int = 500):
+        """Iterate over all records by upload time, one page in memory at a time"""
+        after = None
+        while True:
+            rows = self.query_files(after=after, limit=page_size)
+            if not rows:
+                return
+            yield from rows
+            after = (rows[-1]['upload_time'], rows[-1]['file_id'])
+
+    def rebuild_from_storage(self, blob_store, batch_size: int = 500,
+                             min_age: float = REBUILD_MIN_AGE_SECONDS) -> dict:
+        """
+        Reconcile the store with the blobs in blob_store
+        Blobs without a record get a placeholder one (their original name and
+        subject are not recoverable) once they are min_age seconds old, so an
+        upload still committing in another worker is not taken over. Records
+        whose blob is gone are dropped. A data key encrypted blob gets its key
+        slots back from the copy kept next to it (see BlobStore.put_key_slots);
+        one without that copy could never be opened, so it is reported rather
+        than adopted. Works in batches so memory does not grow with the archive.
+        """
+        added = 0
+        removed = 0
+        unrecoverable = 0
+        conn = self._connection()
+
+        def flush(batch):
+            nonlocal unrecoverable
+            placeholders = ', '.join('?' * len(batch))
+            known = {
+                row[0] for row in conn.execute(
+                    f'SELECT blob_id FROM blobs WHERE blob_id IN ({placeholders})', batch
+                )
+            }
+            adopted = 0
+            cutoff = time.time() - min_age
+            for blob_id in batch:
+                if blob_id in known:
+                    continue
+                try:
+                    if blob_store.modified(blob_id) > cutoff:
+                        continue
+                    record, key_slots = _recovered_record(blob_id, blob_store)
+                except Exception:
+                    # Removed meanwhile
+                    continue
+                if key_slots == []:
+                    print(f"WARNING: blob {blob_id} is data key encrypted but its key slots are lost; "
+                          f"it cannot be opened and was not adopted")
+                    unrecoverable += 1
+                    continue
+                key_slots = key_slots or [None]
+                try:
+                    self.add(record['file_id'], record, {
+                        'content_address': None, 'encrypted_size': record['encrypted_size']
+                    }, key_slots[0])
+                except sqlite3.IntegrityError:
+                    # Its upload committed the record after all
+                    continue
+                for key_slot in key_slots[1:]:
+                    self.add_key_slot(record['file_id'], key_slot)
+                adopted += 1
+            return adopted
+
+        batch = []
+        for blob_id in blob_store.iter_blob_ids():
+            batch.append(blob_id)
+            if len(batch) >= batch_size:
+                added += flush(batch)
+                batch = []
+        if batch:
+            added += flush(batch)
+
+        missing = []
+        for blob_id in self._iter_blob_ids(batch_size):
+            if not blob_store.exists(blob_id):
+                missing.append(blob_id)
+            if len(missing) >= batch_size:
+                removed += self._delete_blobs(missing)
+                missing = []
+        if missing:
+            removed += self._delete_blobs(missing)
+
+        return {'added': added, 'removed': removed, 'unrecoverable': unrecoverable}
+
+    def set_locations(self, locations: dict):
+        """Record new encrypted_path values for the files of each blob_id"""
+        with self._transaction() as conn:
+            conn.executemany(
+                'UPDATE files SET encrypted_path = ? WHERE blob_id = ?',
+                [(location, blob_id) for blob_id, location in locations.items()]
+            )
+
+    def _iter_blob_ids(self, page_size: int):
+        after = ''
+        while True:
+            rows = self._connection().execute(
+                'SELECT blob_id FROM blobs WHERE blob_id > ? ORDER BY blob_id LIMIT ?', (after, page_size)
+            ).fetchall()
+            if not rows:
+                return
+            yield from (row[0] for row in rows)
+            after = rows[-1][0]
+
+    def _delete_blobs(self, blob_ids: list) -> int:
+        """Drop blobs and every record referencing them; returns records removed"""
+        with self._transaction() as conn:
+            conn.executemany(
+                'DELETE FROM key_slots WHERE file_id IN (SELECT file_id FROM files WHERE blob_id = ?)',
+                [(blob_id,) for blob_id in blob_ids]
+            )
+            removed = conn.executemany(
+                'DELETE FROM files WHERE blob_id = ?', [(blob_id,) for blob_id in blob_ids]
+            ).rowcount
+            conn.executemany('DELETE FROM blobs WHERE blob_id = ?', [(blob_id,) for blob_id in blob_ids])
+        return removed
+
+def _split_statements(script: str):
+    """Split a migration script into statements, keeping trigger bodies whole"""
+    statement = ''
+    for line in script.strip().splitlines():
+        statement += line + '\n'
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+
+def key_slot_record(slot: KeySlot, label: str = None) -> dict:
+    """A new key_slots row for slot (file_id and slot_id are filled in when it is stored)"""
+    return {
+        'label': label,
+        'kdf': format_kdf_params(slot.kdf),
+        'salt': slot.salt,
+        'wrapped_key': slot.wrapped,
+        'created_at': datetime.now().isoformat()
+    }
+
+def key_slot_from_record(record: dict) -> KeySlot:
+    """The KeySlot in a key_slots row; raises ValueError for unusable KDF settings"""
+    return KeySlot(parse_kdf_params(record['kdf']), record['salt'], record['wrapped_key'])
+
+def encode_key_slots(records: list) -> bytes:
+    """key_slots rows as the JSON kept next to their blob (without slot and file ids)"""
+    return json.dumps([{
+        'label': record['label'],
+        'kdf': record['kdf'],
+        'salt': base64.b64encode(record['salt']).decode(),
+        'wrapped_key': base64.b64encode(record['wrapped_key']).decode(),
+        'created_at': record['created_at']
+    } for record in records]).encode()
+
+def decode_key_slots(data: bytes) -> list:
+    """New key_slots rows from encode_key_slots output"""
+    return [dict(record, salt=base64.b64decode(record['salt']), wrapped_key=base64.b64decode(record['wrapped_key']))
+            for record in json.loads(data)]
+
+def _slot_id() -> str:
+    return uuid.uuid4().hex
+
+def _insert_key_slot(conn, key_slot: dict):
+    record = dict(key_slot)
+    record.setdefault('slot_id', _slot_id())
+    record.setdefault('label', None)
+    conn.execute(
+        f"INSERT INTO key_slots ({', '.join(KEY_SLOT_COLUMNS)}) VALUES ({', '.join('?' * len(KEY_SLOT_COLUMNS))})",
+        [record[c] for c in KEY_SLOT_COLUMNS]
+    )
+    return record['slot_id']
+
+def _where(filters: dict) -> tuple:
+    clauses = []
+    params = []
+    for name, value in (filters or {}).items():
+        if name not in FILTERS:
+            raise ValueError(f"Unknown filter: {name}")
+        clauses.append(FILTERS[name])
+        params.append(value)
+    return clauses, params
+
+def _where_sql(clauses: list) -> str:
+    return f"WHERE {' AND '.join(clauses)}" if clauses else ''
+
+def _recovered_record(blob_id: str, blob_store) -> tuple:
+    """
+    Placeholder metadata for a stored blob found without a record, and its
+    key slots: None if it is not data key encrypted, [] if they are lost
+    """
+    encrypted_size = blob_store.size(blob_id)
+    modified = datetime.fromtimestamp(blob_store.modified(blob_id))
+    key_slots = None
+    try:
+        with blob_store.open(blob_id) as f:
+            header = read_header(f)
+        size = plaintext_size(header, encrypted_size)
+    except Exception:
+        header = None
+        size = None
+    if header is not None and header.version >= ENVELOPE_VERSION:
+        data = blob_store.get_key_slots(blob_id)
+        key_slots = decode_key_slots(data) if data is not None else []
+
+    record = {
+        'file_id': blob_id,
+        'original_filename': blob_id,
+        'secure_filename': blob_id,
+        'subject': 'Unknown',
+        'exam_date': modified.strftime('%Y-%m-%d'),
+        'upload_time': modified.isoformat(),
+        # Legacy files only reveal their size to within one AES block
+        'file_size': size if size is not None else max(encrypted_size - 32, 0),
+        'content_hash': None,
+        'encrypted_path': blob_store.location(blob_id),
+        'blob_id': blob_id,
+        'encrypted_size': encrypted_size
+    }
+    return record, key_slots
@@ -0,0 +1,227 @@
+import bisect
+import threading
+import time
+
+# Request latency buckets (seconds); downloads of large papers can stream for a while
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Per-operation stage buckets, down to a single small segment
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class _Metric:
+    """
+    A metric family in process memory, one value per label combination
+    Label values are passed positionally in the order of labels. Updates
+    take one short lock, so recording stays cheap enough to leave on.
+    """
+
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self.samples(), key=lambda sample: sorted(sample[0].items())):
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = REQUEST_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(dict(zip(self.labels, key)), (list(counts), total))
+                    for key, (counts, total) in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.samples(), key=lambda sample: sorted(sample[0].items())):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bucket_labels = dict(labels, le=_format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+HTTP_REQUESTS = Counter('exam_http_requests_total', 'HTTP requests handled', ('route', 'method', 'status'))
+HTTP_DURATION = Histogram('exam_http_request_duration_seconds',
+                          'Time from receiving a request until its response body was sent', ('route', 'method'))
+HTTP_IN_FLIGHT = Gauge('exam_http_requests_in_flight', 'Requests being handled', ('route',))
+HTTP_BYTES_IN = Counter('exam_http_request_bytes_total', 'Request body bytes received', ('route',))
+HTTP_BYTES_OUT = Counter('exam_http_response_bytes_total', 'Response body bytes sent', ('route',))
+STAGE_DURATION = Histogram('exam_stage_duration_seconds',
+                           'Time one operation spent in each stage (kdf, cipher, disk_read, disk_write, commit)',
+                           ('operation', 'stage'), STAGE_BUCKETS)
+
+CLEANUP_RUNS = Counter('exam_cleanup_runs_total',
+                       'Cleanup runs by result (done, partial when a limit left work for the next run, failed)',
+                       ('result',))
+CLEANUP_REMOVED = Counter('exam_cleanup_removed_total', 'Files and papers removed by cleanup', ('kind',))
+CLEANUP_BYTES = Counter('exam_cleanup_reclaimed_bytes_total', 'Bytes reclaimed by cleanup', ('kind',))
+CLEANUP_LAST_RUN = Gauge('exam_cleanup_last_run_timestamp_seconds', 'When this process last finished a cleanup run')
+
+RATE_LIMITED = Counter('exam_rate_limited_total', 'Requests refused with 429', ('endpoint',))
+RATE_LIMIT_ERRORS = Counter('exam_rate_limit_errors_total', 'Rate limit checks that failed and let the request through')
+
+RELEASE_REFUSED = Counter('exam_release_refused_total', 'Requests refused with 403 because a paper was not released yet')
+RELEASE_WARMED = Counter('exam_release_warmed_total', 'Papers prepared ahead of their release, by result', ('result',))
+RELEASE_WARM_HITS = Counter('exam_release_warm_hits_total', 'Downloads and verifies served from a prepared paper',
+                            ('operation',))
+
+REKEYED = Counter('exam_rekeyed_total',
+                  'Papers offered for conversion to data keys or for new key slot KDF settings, '
+                  'by result (done, skipped, deferred, dropped, busy, failed)', ('result',))
+
+_registry = [HTTP_REQUESTS, HTTP_DURATION, HTTP_IN_FLIGHT, HTTP_BYTES_IN, HTTP_BYTES_OUT, STAGE_DURATION,
+             CLEANUP_RUNS, CLEANUP_REMOVED, CLEANUP_BYTES, CLEANUP_LAST_RUN, RATE_LIMITED, RATE_LIMIT_ERRORS,
+             RELEASE_REFUSED, RELEASE_WARMED, RELEASE_WARM_HITS, REKEYED]
+
+class StageTimer:
+    """
+    Time spent in each stage of one operation (an encryption, a download...)
+    Stages are added up locally as the operation runs, per chunk, and each
+    is observed once when finish() is called, so the per-chunk cost is two
+    perf_counter() calls.
+    """
+
+    __slots__ = ('operation', 'seconds')
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.seconds = {}
+
+    def add(self, stage: str, started: float):
+        """Count the time since started (a perf_counter() value) towards stage"""
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - started
+
+    def finish(self):
+        for stage, seconds in self.seconds.items():
+            STAGE_DURATION.observe(seconds, self.operation, stage)
+        self.seconds = {}
+
+def observe_stage(operation: str, stage: str, started: float):
+    """Record a single-step stage that began at started (a perf_counter() value)"""
+    STAGE_DURATION.observe(time.perf_counter() - started, operation, stage)
+
+class RequestTimer:
+    """
+    Metrics for one HTTP request, from its arrival until the last byte of the
+    response has been sent (streamed downloads included)
+    """
+
+    __slots__ = ('route', 'method', 'started', 'bytes_out', '_finished')
+
+    def __init__(self, route: str, method: str, bytes_in: int = 0):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.bytes_out = 0
+        self._finished = False
+        HTTP_IN_FLIGHT.inc(route)
+        if bytes_in:
+            HTTP_BYTES_IN.inc(route, amount=bytes_in)
+
+    def received(self, size: int):
+        """Count request body bytes read after the request started"""
+        HTTP_BYTES_IN.inc(self.route, amount=size)
+
+    def counted(self, chunks):
+        """Pass response chunks through, counting the bytes sent"""
+        try:
+            for chunk in chunks:
+                self.bytes_out += len(chunk)
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def finish(self, status: int):
+        if self._finished:
+            return
+        self._finished = True
+        HTTP_IN_FLIGHT.dec(self.route)
+        HTTP_REQUESTS.inc(self.route, self.method, str(status))
+        HTTP_DURATION.observe(time.perf_counter() - self.started, self.route, self.method)
+        if self.bytes_out:
+            HTTP_BYTES_OUT.inc(self.route, amount=self.bytes_out)
+
+def render_metrics(families: list = ()) -> str:
+    """
+    Prometheus text exposition of the recorded metrics and of families,
+    point-in-time values given as (name, kind, help, [(labels, value), ...])
+    Everything is per process: with several workers each reports its own.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,73 @@
+"""
+Convert a flat STORAGE_FOLDER to the sharded layout in place
+
+    python migrate_storage.py [--batch-size 500] [--dry-run]
+
+Each blob is renamed within the same filesystem, so every move is atomic
+and the server can keep running meanwhile: LocalBlobStore finds blobs in
+either layout. The directories touched by a batch are fsynced together,
+then the batch's new paths are recorded in the metadata store. Listing a
+directory while moving entries out of it may skip some, so passes repeat
+until one moves nothing.
+"""
+import argparse
+import os
+from dotenv import load_dotenv
+from config import DevelopmentConfig, ProductionConfig
+from metadata_store import MetadataStore
+from storage import LocalBlobStore, FsyncBatcher
+
+def migrate(blob_store: LocalBlobStore, metadata_store: MetadataStore, batch_size: int = 500,
+            dry_run: bool = False) -> int:
+    """Move every flat-layout blob to its sharded path; returns the number moved"""
+    fsync_batcher = FsyncBatcher()
+    moved = 0
+
+    def flush(batch):
+        if not batch:
+            return
+        directories = {os.path.dirname(blob_store.path(blob_id)) for blob_id in batch}
+        directories |= {os.path.dirname(d) for d in directories} | {blob_store.root}
+        fsync_batcher.sync(sorted(directories))
+        metadata_store.set_locations({blob_id: blob_store.path(blob_id) for blob_id in batch})
+
+    while True:
+        moved_this_pass = 0
+        batch = []
+        with os.scandir(blob_store.root) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.enc') or not entry.is_file():
+                    continue
+                blob_id = entry.name[:-len('.enc')]
+                if dry_run:
+                    print(f"{entry.path} -> {blob_store.path(blob_id)}")
+                    moved_this_pass += 1
+                    continue
+                if blob_store.move(blob_id):
+                    batch.append(blob_id)
+                    moved_this_pass += 1
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = []
+        flush(batch)
+        moved += moved_this_pass
+        if dry_run or moved_this_pass == 0:
+            return moved
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Move STORAGE_FOLDER to the sharded layout')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--dry-run', action='store_true', help='list the moves without making them')
+    args = parser.parse_args()
+
+    # Same config selection as app.py
+    config = DevelopmentConfig if os.getenv('FLASK_ENV') == 'development' else ProductionConfig
+    blob_store = LocalBlobStore(config.STORAGE_FOLDER, layout='sharded', fsync='off')
+    metadata_store = MetadataStore(config.METADATA_DB_PATH)
+
+    moved = migrate(blob_store, metadata_store, args.batch_size, args.dry_run)
+    print(f"{'Would move' if args.dry_run else 'Moved'} {moved} blobs into {config.STORAGE_FOLDER}")
+
+if __name__ == '__main__':
+    main()
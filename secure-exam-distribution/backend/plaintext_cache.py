@@ -0,0 +1,182 @@
+import ctypes
+import ctypes.util
+import threading
+from cache import TTLCache
+from encryption import decrypt_stream, key_check_matches, CHUNK_SIZE
+
+_libc = None
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+class LockedBuffer:
+    """
+    Fixed-size bytearray pinned in RAM with mlock where the platform allows
+    (so decrypted papers are never written to swap) and zeroed on release
+    """
+
+    def __init__(self, size: int):
+        self.data = bytearray(size)
+        self.size = size
+        self.locked = False
+        if size:
+            self._address = ctypes.addressof((ctypes.c_char * size).from_buffer(self.data))
+            libc = _load_libc()
+            if libc and hasattr(libc, 'mlock'):
+                self.locked = libc.mlock(ctypes.c_void_p(self._address), ctypes.c_size_t(size)) == 0
+
+    def wipe(self):
+        if not self.size:
+            return
+        ctypes.memset(self._address, 0, self.size)
+        if self.locked:
+            _load_libc().munlock(ctypes.c_void_p(self._address), ctypes.c_size_t(self.size))
+            self.locked = False
+
+class CachedPaper:
+    """
+    A decrypted paper plus the header needed to check passwords against it
+    The buffer is wiped once the entry has been evicted and the last reader
+    still streaming from it has finished.
+    """
+
+    def __init__(self, header, buffer: LockedBuffer):
+        self.header = header
+        self.buffer = buffer
+        self._readers = 0
+        self._evicted = False
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            if self._evicted:
+                return False
+            self._readers += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._readers -= 1
+            wipe = self._evicted and not self._readers
+        if wipe:
+            self.buffer.wipe()
+
+    def evict(self):
+        with self._lock:
+            self._evicted = True
+            wipe = not self._readers
+        if wipe:
+            self.buffer.wipe()
+
+    def iter_chunks(self, start: int = 0, stop: int = None, chunk_size: int = CHUNK_SIZE):
+        """
+        Iterator over plaintext bytes [start, stop); releases the reader hold
+        when exhausted or closed
+        """
+        return _PaperReader(self, start, self.buffer.size if stop is None else stop, chunk_size)
+
+class _PaperReader:
+    def __init__(self, paper: CachedPaper, start: int, stop: int, chunk_size: int):
+        self._paper = paper
+        self._view = memoryview(paper.buffer.data)
+        self._chunk_size = chunk_size
+        self._offset = start
+        self._stop = stop
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        if self._closed or self._offset >= self._stop:
+            self.close()
+            raise StopIteration
+        chunk = bytes(self._view[self._offset:min(self._offset + self._chunk_size, self._stop)])
+        self._offset += len(chunk)
+        return chunk
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._view.release()
+            self._paper.release()
+
+class PlaintextCache:
+    """
+    Opt-in, size-bounded LRU of decrypted papers for release-window bursts
+    The first download of a paper decrypts it into locked memory; later
+    downloads are served from there once their password has been checked
+    against the paper's key check (one cached KDF, no disk read, no AES).
+    Entries expire after ttl_seconds, or the ttl open() is given: ExamService
+    passes the time left in the paper's release window. Only chunked files
+    with a key check are cached.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float, max_entry_bytes: int = None):
+        self.max_entry_bytes = max_entry_bytes or max_bytes
+        self._cache = TTLCache(
+            max_entries=1 << 30,
+            ttl_seconds=ttl_seconds,
+            max_size=max_bytes,
+            sizeof=lambda paper: paper.buffer.size,
+            on_evict=lambda paper: paper.evict()
+        )
+        self.lock_failures = 0
+
+    def open(self, blob_id: str, header, size: int, open_encrypted, password: str,
+             start: int = 0, stop: int = None, ttl: float = None):
+        """
+        Return a chunk iterator over bytes [start, stop) of blob_id's plaintext,
+        or None if it cannot be cached. Raises ValueError if the password does
+        not match. open_encrypted() must return a fresh binary file object.
+        """
+        if header is None or header.key_check is None or size > self.max_entry_bytes:
+            return None
+
+        # Check the caller's password before touching (or filling) the cache
+        if not key_check_matches(header, password):
+            raise ValueError("invalid password")
+
+        while True:
+            paper = self._cache.get_or_compute(
+                (blob_id, header.raw),
+                lambda: self._load(header, size, open_encrypted, password),
+                ttl
+            )
+            if paper.acquire():
+                return paper.iter_chunks(start, stop)
+
+    def _load(self, header, size: int, open_encrypted, password: str) -> CachedPaper:
+        buffer = LockedBuffer(size)
+        if size and not buffer.locked:
+            self.lock_failures += 1
+        try:
+            offset = 0
+            with open_encrypted() as encrypted_file:
+                for chunk in decrypt_stream(encrypted_file, password):
+                    if offset + len(chunk) > size:
+                        raise ValueError("Decrypted size does not match header")
+                    buffer.data[offset:offset + len(chunk)] = chunk
+                    offset += len(chunk)
+            if offset != size:
+                raise ValueError("Decrypted size does not match header")
+        except BaseException:
+            buffer.wipe()
+            raise
+        return CachedPaper(header, buffer)
+
+    def invalidate(self, blob_id: str):
+        """Drop every cached version of blob_id"""
+        for key in [key for key in self._cache.keys() if key[0] == blob_id]:
+            self._cache.pop(key)
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        stats['lock_failures'] = self.lock_failures
+        return stats
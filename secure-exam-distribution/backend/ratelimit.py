@@ -0,0 +1,159 @@
+import os
+import math
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+# Buckets untouched this long are full again, so they can be dropped
+IDLE_SECONDS = 120
+
+# How many take() calls between drops of idle buckets
+PRUNE_EVERY = 1000
+
+def _refill(tokens: float, updated: float, now: float, limit: int) -> float:
+    """Tokens in a bucket of limit per minute last left at tokens at time updated"""
+    return min(float(limit), tokens + max(now - updated, 0.0) * limit / 60.0)
+
+def _retry_after(tokens: float, limit: int) -> int:
+    """Whole seconds until a bucket holding tokens has one to spare"""
+    return max(1, math.ceil((1.0 - tokens) * 60.0 / limit))
+
+class RateLimiter(ABC):
+    """
+    Token buckets of limit requests per minute, up to limit at once
+    take() spends a token from the bucket for key and returns (allowed,
+    retry_after seconds). Each call is one read-modify-write of one bucket.
+    """
+
+    @abstractmethod
+    def take(self, key: str, limit: int) -> tuple:
+        """Spend one of key's tokens; returns (allowed, retry_after seconds)"""
+
+class MemoryRateLimiter(RateLimiter):
+    """Buckets in this process only; each worker enforces its own limits"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def take(self, key: str, limit: int) -> tuple:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (float(limit), now))
+            tokens = _refill(tokens, updated, now, limit)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < IDLE_SECONDS}
+        return allowed, 0 if allowed else _retry_after(tokens, limit)
+
+class SQLiteRateLimiter(RateLimiter):
+    """
+    Buckets in a SQLite database shared by every worker on the host
+    Kept apart from the metadata database, with synchronous=OFF: losing the
+    last few updates in a crash only refills some buckets early.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._calls = 0
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID'
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key: str, limit: int) -> tuple:
+        now = time.time()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = _refill(*row, now, limit) if row else float(limit)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+
+            self._calls += 1
+            if self._calls % PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - IDLE_SECONDS,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, 0 if allowed else _retry_after(tokens, limit)
+
+# Same bucket arithmetic as _refill, run atomically inside Redis on its own clock
+_REDIS_TAKE = """
+-- Redis before 5 only lets a script write after TIME with effects replication
+if redis.replicate_commands then redis.replicate_commands() end
+local limit = tonumber(ARGV[1])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or limit
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(limit, tokens + math.max(now - updated, 0) * limit / 60)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+return {allowed, tostring(tokens)}
+"""
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Buckets in Redis (or anything speaking its protocol and Lua scripting),
+    shared by every worker on every host
+    """
+
+    def __init__(self, url: str = None, prefix: str = 'ratelimit:', client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("RATE_LIMIT_BACKEND 'redis' requires redis (pip install redis)")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(_REDIS_TAKE)
+
+    def take(self, key: str, limit: int) -> tuple:
+        allowed, tokens = self._script(keys=[self.prefix + key], args=[limit, IDLE_SECONDS])
+        allowed = bool(int(allowed))
+        return allowed, 0 if allowed else _retry_after(float(tokens), limit)
+
+def create_rate_limiter(config):
+    """Rate limiter selected by RATE_LIMIT_BACKEND, None when it is 'off'"""
+    backend = config['RATE_LIMIT_BACKEND']
+    if backend == 'off':
+        return None
+    if backend == 'memory':
+        return MemoryRateLimiter()
+    if backend == 'sqlite':
+        return SQLiteRateLimiter(config['RATE_LIMIT_DB_PATH'])
+    if backend == 'redis':
+        return RedisRateLimiter(config['RATE_LIMIT_REDIS_URL'])
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
@@ -0,0 +1,185 @@
+import os
+import queue
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+from encryption import (encrypt_stream, decrypt_stream, kdf_params, format_kdf_params, generate_data_key,
+                        wrap_data_key, ENVELOPE_VERSION)
+from streaming import write_temp
+from utils import generate_secure_filename, StreamMeter, content_address
+from metadata_store import key_slot_record
+from crypto_executor import CryptoBusyError
+from audit import audit_log
+from metrics import REKEYED
+
+# A paper someone just opened: its blob's header, the password, and for data
+# key encrypted blobs the DataKey and the key slot record the password opened
+RekeyJob = namedtuple('RekeyJob', ['file_id', 'blob_id', 'header', 'password', 'data_key', 'key_slot'])
+
+class Rekeyer:
+    """
+    Brings papers stored under older settings up to date
+    Passwords are never stored, so a paper can only be re-keyed once someone
+    has proven its password: a successful download offers it, and a
+    background thread does the work. A paper whose blob is encrypted with
+    its password (older formats) is converted: the blob is decrypted and
+    encrypted again with a random data key, stored as a new blob that takes
+    over the old one's papers in one transaction, each of them getting a key
+    slot for the password. The old blob is then collected like a deleted
+    one (see BlobStore.collect), so downloads already reading it finish
+    undisturbed. For data key encrypted blobs only the key slot is
+    rewritten, when its KDF settings are not the current ones.
+
+    Offers beyond queue_size are dropped; the paper is offered again on its
+    next download. Passwords wait in the queue only until their job runs.
+    Offers made while any paper is within quiet_minutes of its release are
+    dropped too, as are queued jobs when such a window opens: a release
+    burst is when most offers come, and re-encrypting then would compete
+    with its downloads for CPU and storage.
+    """
+
+    def __init__(self, service, queue_size: int = 100, quiet_minutes: float = 60):
+        self.service = service
+        self.quiet = timedelta(minutes=quiet_minutes)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = set()
+        self._thread_pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the re-keying thread in this process, and in every process forked from it"""
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            if self._thread_pid is None:
+                os.register_at_fork(after_in_child=self.start)
+            # A forked child inherits the parent's queue but not its thread
+            self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._pending = set()
+            threading.Thread(target=self._run, name='rekey', daemon=True).start()
+            self._thread_pid = os.getpid()
+
+    def needs_rekey(self, header, key_slot: dict = None) -> bool:
+        """Whether a blob with this header (None for legacy files), opened through key_slot, is out of date"""
+        if header is None or header.version < ENVELOPE_VERSION:
+            return True
+        return key_slot is not None and key_slot['kdf'] != format_kdf_params(kdf_params())
+
+    def offer(self, file_id: str, blob_id: str, header, password: str, data_key=None, key_slot: dict = None):
+        """Queue a paper password has just opened for re-keying, if it is out of date"""
+        if self._thread_pid != os.getpid() or not self.needs_rekey(header, key_slot):
+            return
+        if self.in_release_window():
+            REKEYED.inc('deferred')
+            return
+        pending_key = key_slot['slot_id'] if key_slot is not None else blob_id
+        with self._lock:
+            if pending_key in self._pending:
+                return
+            try:
+                self._queue.put_nowait((pending_key, RekeyJob(file_id, blob_id, header, password, data_key, key_slot)))
+            except queue.Full:
+                REKEYED.inc('dropped')
+                return
+            self._pending.add(pending_key)
+
+    def _run(self):
+        jobs = self._queue
+        while True:
+            pending_key, job = jobs.get()
+            try:
+                REKEYED.inc('deferred' if self.in_release_window() else self.rekey(job))
+            except CryptoBusyError:
+                REKEYED.inc('busy')
+            except Exception as e:
+                REKEYED.inc('failed')
+                print(f"Re-keying {job.file_id} failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._pending.discard(pending_key)
+
+    def in_release_window(self) -> bool:
+        """Whether any paper is released within quiet_minutes of now"""
+        if not self.quiet:
+            return False
+        now = datetime.now()
+        return bool(self.service.metadata_store.releasing_between(
+            (now - self.quiet).isoformat(timespec='seconds'), (now + self.quiet).isoformat(timespec='seconds'), 1
+        ))
+
+    def rekey(self, job: RekeyJob) -> str:
+        """Bring the paper in job up to date; returns 'done' or 'skipped'"""
+        if job.key_slot is None:
+            return self.convert(job.blob_id, job.header, job.password)
+
+        params = kdf_params()
+        key_slot = job.key_slot
+        replacement = dict(key_slot_record(wrap_data_key(job.data_key, job.password, params), key_slot['label']),
+                           created_at=key_slot['created_at'])
+        # A slot changed or revoked meanwhile stays that way
+        if not self.service.metadata_store.update_key_slot(key_slot['slot_id'], replacement,
+                                                           key_slot['wrapped_key']):
+            return 'skipped'
+        self.service._save_key_slots(file_id=job.file_id)
+        audit_log('rekey', file_id=job.file_id, slot_id=key_slot['slot_id'], kdf=params.algorithm, success=True)
+        return 'done'
+
+    def convert(self, blob_id: str, header, password: str) -> str:
+        """
+        Re-encrypt blob_id, stored with header and opened by password, with a
+        new data key, giving each of its papers a key slot for password
+        Returns 'done', or 'skipped' if it is gone or cannot be checked; raises
+        ValueError if the content it decrypts to does not match its hash.
+        """
+        service = self.service
+        blob_store = service.blob_store
+        blob = service.metadata_store.get_blob(blob_id)
+        if blob is None:
+            return 'skipped'
+        # Checked against the content hash its papers kept from upload where
+        # there is one: unlike the content address it does not depend on DEDUP_KEY
+        expected_hash = service.metadata_store.blob_content_hash(blob_id)
+        expected_address = blob['content_address'] if expected_hash is None else None
+        # Legacy CBC files are not authenticated: a wrong password can decrypt
+        # to garbage, so they are only rewritten if the content hash confirms it
+        if header is None and expected_hash is None and expected_address is None:
+            return 'skipped'
+
+        params = kdf_params()
+        data_key = generate_data_key()
+        key_slot = key_slot_record(wrap_data_key(data_key, password, params))
+        meter = StreamMeter(max_size=float('inf'))
+        with blob_store.open(blob_id) as f:
+            staged_path, encrypted_size = write_temp(
+                encrypt_stream(meter.wrap(decrypt_stream(f, password)), data_key), service.storage_folder
+            )
+        content_hash = meter.content_hash()
+        address = content_address(content_hash, service.config['DEDUP_KEY'])
+        if expected_hash not in (None, content_hash) or expected_address not in (None, address):
+            os.remove(staged_path)
+            raise ValueError('Decrypted content does not match the stored content hash')
+
+        new_blob_id = generate_secure_filename('')
+        try:
+            blob_store.put(staged_path, new_blob_id)
+        except BaseException:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
+
+        try:
+            replaced = service.metadata_store.replace_blob(
+                blob_id, new_blob_id, encrypted_size, blob_store.location(new_blob_id), service._collect_blob,
+                key_slot, address
+            )
+        except BaseException:
+            blob_store.delete(new_blob_id)
+            raise
+        if not replaced:
+            # Its papers were deleted, or another worker converted it, meanwhile
+            blob_store.delete(new_blob_id)
+            return 'skipped'
+
+        service._save_key_slots(new_blob_id)
+        audit_log('rekey', blob_id=blob_id, new_blob_id=new_blob_id, kdf=params.algorithm, success=True)
+        return 'done'
@@ -0,0 +1,1330 @@
+import os
+import json
+import time
+import hashlib
+import hmac
+import itertools
+import contextvars
+import queue
+import threading
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from werkzeug.http import parse_range_header, parse_if_range_header
+from encryption import (encrypt_stream, decrypt_stream, decrypt_range, verify_password, read_header,
+                        key_check_matches, plaintext_size, configure_key_cache, set_kdf_executor, key_cache_stats,
+                        configure_kdf, parse_kdf_params, generate_data_key, wrap_data_key, unwrap_data_key,
+                        ENVELOPE_VERSION)
+from utils import (generate_secure_filename, validate_file_type, validate_file_size,
+                   StreamMeter, FileTooLargeError, content_address, encode_cursor, decode_cursor,
+                   parse_release_time, parse_networks, client_address)
+from streaming import (iter_multipart, read_field, spool_chunks, write_temp, stream_zip,
+                       attachment_headers, READ_SIZE)
+from crypto_executor import CryptoExecutor, CryptoBusyError
+from metadata_store import (MetadataStore, FILTERS, SORT_COLUMNS, key_slot_record, key_slot_from_record,
+                            encode_key_slots)
+from plaintext_cache import PlaintextCache
+from audit import AuditLogger, configure_audit_logger, audit_logger, audited
+from storage import create_blob_store
+from metrics import (StageTimer, observe_stage, render_metrics, RATE_LIMITED, RATE_LIMIT_ERRORS,
+                     RELEASE_REFUSED, RELEASE_WARM_HITS)
+from cleanup import CleanupScheduler
+from release import ReleaseWarmer
+from rekey import Rekeyer
+from ratelimit import create_rate_limiter
+
+# Fields /api/files can return, and its page sizes
+LIST_FIELDS = ('file_id', 'original_filename', 'subject', 'exam_date', 'upload_time', 'file_size',
+               'release_time')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Per-file settings a batch upload's metadata field may override, and how
+# often a paper waits out a busy crypto executor before failing
+BATCH_SETTINGS = ('password', 'subject', 'exam_date', 'release_time')
+BATCH_BUSY_RETRIES = 3
+
+# Which RATE_LIMIT_* setting applies to each endpoint (the view function
+# name, the same in app.py and asgi.py); others get RATE_LIMIT_GENERAL
+RATE_LIMIT_CLASSES = {
+    'upload_file': 'RATE_LIMIT_UPLOAD',
+    'upload_batch': 'RATE_LIMIT_UPLOAD',
+    'download_file': 'RATE_LIMIT_DOWNLOAD',
+    'download_bundle': 'RATE_LIMIT_DOWNLOAD',
+    # Every verify costs a key derivation, like a download, and so does
+    # each password change or reschedule
+    'verify_file': 'RATE_LIMIT_DOWNLOAD',
+    'set_release': 'RATE_LIMIT_DOWNLOAD',
+    'add_password': 'RATE_LIMIT_DOWNLOAD',
+    'change_password': 'RATE_LIMIT_DOWNLOAD',
+    'revoke_password': 'RATE_LIMIT_DOWNLOAD',
+}
+
+# Decrypted chunks a bundle paper may run ahead of the zip writer, and the
+# marker ending each paper's queue
+BUNDLE_QUEUE_CHUNKS = 16
+_END = object()
+
+# An open download: metadata, decrypted chunk iterator, HTTP status and
+# headers, and a callable releasing the file handle
+Download = namedtuple('Download', ['metadata', 'chunks', 'status', 'headers', 'close'])
+
+class ServiceError(Exception):
+    """A request failure carrying the HTTP status and JSON body to return"""
+
+    def __init__(self, message: str, status: int = 400, body: dict = None, headers: dict = None):
+        super().__init__(message)
+        self.status = status
+        self.body = body if body is not None else {'error': message}
+        self.headers = headers or {}
+
+class ExamService:
+    """
+    The /api/* operations, independent of the web framework serving them
+    Both the Flask app (app.py) and the ASGI app (asgi.py) are thin layers
+    over one of these, built from a Flask-style config mapping.
+    """
+
+    def __init__(self, config):
+        if not config['DEDUP_KEY'] and not config.get('TESTING'):
+            raise ValueError("DEDUP_KEY must be set: it keys the content addresses uploads are deduplicated by")
+        self.config = config
+        self.storage_folder = config['STORAGE_FOLDER']
+
+        # Key derivation runs on a bounded executor so a burst of downloads cannot
+        # take every worker thread and CPU with it
+        self.crypto_executor = CryptoExecutor(
+            kind=config['CRYPTO_EXECUTOR'],
+            max_workers=config['CRYPTO_WORKERS'],
+            max_pending=config['CRYPTO_MAX_PENDING'],
+            timeout=config['CRYPTO_JOB_TIMEOUT'],
+            retry_after=config['CRYPTO_RETRY_AFTER']
+        )
+        set_kdf_executor(self.crypto_executor)
+
+        configure_key_cache(
+            enabled=config['KDF_CACHE_ENABLED'],
+            max_entries=config['KDF_CACHE_MAX_ENTRIES'],
+            ttl_seconds=config['KDF_CACHE_TTL_SECONDS']
+        )
+        # New papers use KDF_PARAMS; each file's header records its own
+        configure_kdf(parse_kdf_params(config['KDF_PARAMS']))
+
+        # Ensure directories exist
+        os.makedirs(config['STORAGE_FOLDER'], exist_ok=True)
+        os.makedirs(config['DECRYPTED_FOLDER'], exist_ok=True)
+
+        # Decrypt-once cache for release-window bursts (opt-in)
+        self.plaintext_cache = None
+        if config['PLAINTEXT_CACHE_ENABLED']:
+            self.plaintext_cache = PlaintextCache(
+                max_bytes=config['PLAINTEXT_CACHE_MAX_BYTES'],
+                ttl_seconds=config['PLAINTEXT_CACHE_TTL_SECONDS'],
+                max_entry_bytes=config['PLAINTEXT_CACHE_MAX_ENTRY_BYTES']
+            )
+
+        # Audit records go to a JSON-lines log written by a background thread
+        configure_audit_logger(AuditLogger(
+            os.path.join(config['LOG_FOLDER'], 'audit.jsonl'),
+            max_bytes=config['LOG_MAX_BYTES'],
+            backup_count=config['LOG_BACKUP_COUNT'],
+            queue_size=config['AUDIT_QUEUE_SIZE'],
+            overflow=config['AUDIT_OVERFLOW'],
+            block_timeout=config['AUDIT_BLOCK_TIMEOUT']
+        ))
+
+        # Bulk uploads encrypt papers concurrently on their own pool
+        self._batch_pool = None
+        self._batch_pool_pid = None
+        self._batch_pool_lock = threading.Lock()
+
+        # Per-client request limits, shared between workers. Clients behind
+        # TRUSTED_PROXIES are told apart by X-Forwarded-For (see client_address)
+        self.rate_limiter = create_rate_limiter(config)
+        self.trusted_proxies = parse_networks(config['TRUSTED_PROXIES'])
+
+        # Encrypted papers are deduplicated blobs; uploads are staged in STORAGE_FOLDER.
+        # File metadata lives in SQLite so it survives restarts and is shared by
+        # all workers. Both are opened on first use (see blob_store, metadata_store)
+        self._blob_store = None
+        self._metadata_store = None
+        self._stores_lock = threading.Lock()
+
+        # Stale temp files, orphaned blobs and expired papers are removed in the
+        # background, by one worker at a time
+        self.cleanup = CleanupScheduler(
+            self,
+            os.path.join(config['STORAGE_FOLDER'], '.cleanup.lock'),
+            interval_hours=config['AUTO_CLEANUP_INTERVAL_HOURS'],
+            temp_max_age_hours=config['TEMP_FILE_MAX_AGE_HOURS'],
+            retention_days=config['RETENTION_DAYS'],
+            log_retention_days=config['LOG_RETENTION_DAYS'],
+            batch_size=config['CLEANUP_BATCH_SIZE'],
+            pause=config['CLEANUP_PAUSE_SECONDS']
+        )
+
+        # Papers about to be released are checked and paged in ahead of the rush
+        self.release_warmer = ReleaseWarmer(
+            self,
+            lead_minutes=config['RELEASE_WARMUP_MINUTES'],
+            poll_seconds=config['RELEASE_WARMUP_POLL_SECONDS']
+        )
+
+        # Papers stored under older KDF settings are re-encrypted once downloaded
+        self.rekeyer = Rekeyer(self, queue_size=config['REKEY_QUEUE_SIZE'],
+                               quiet_minutes=config['REKEY_QUIET_MINUTES'])
+
+        # The threads above are started by start_background(), in each worker
+        self._background_pid = None
+        self._background_lock = threading.Lock()
+
+    @property
+    def blob_store(self):
+        """The blob store selected by STORAGE_BACKEND, created on first use"""
+        if self._blob_store is None:
+            with self._stores_lock:
+                if self._blob_store is None:
+                    self._blob_store = create_blob_store(self.config)
+        return self._blob_store
+
+    @property
+    def metadata_store(self):
+        """
+        The metadata store, opened on first use: migrated, then reconciled
+        with the blob store. Processes forked after that inherit it open.
+        """
+        if self._metadata_store is None:
+            blob_store = self.blob_store
+            with self._stores_lock:
+                if self._metadata_store is None:
+                    metadata_store = MetadataStore(self.config['METADATA_DB_PATH'])
+                    metadata_store.rebuild_from_storage(blob_store)
+                    self._metadata_store = metadata_store
+        return self._metadata_store
+
+    def start_background(self):
+        """
+        Start the enabled background threads (cleanup, release warm-up,
+        re-keying) in this process; later calls in the same process return
+        at once. Call it in each worker, never before forking them: a child
+        forked while one of these threads holds a lock would inherit it held.
+        """
+        if self._background_pid == os.getpid():
+            return
+        with self._background_lock:
+            if self._background_pid == os.getpid():
+                return
+            if self.config['AUTO_CLEANUP_ENABLED']:
+                self.cleanup.start()
+            if self.config['RELEASE_WARMUP_ENABLED']:
+                self.release_warmer.start()
+            if self.config['REKEY_ENABLED']:
+                self.rekeyer.start()
+            self._background_pid = os.getpid()
+
+    def warm_up(self) -> float:
+        """
+        Do now what the first requests would otherwise wait for: open the
+        stores and run the cipher once. It starts no threads, so it can run
+        before forking workers, which then all start ready. Returns the
+        seconds it took.
+        """
+        started = time.perf_counter()
+        self.metadata_store
+        data_key = generate_data_key()
+        b''.join(decrypt_stream(b''.join(encrypt_stream(b'warm-up', data_key)), data_key))
+        return time.perf_counter() - started
+
+    def health(self) -> dict:
+        return {
+            'status': 'healthy',
+            'timestamp': datetime.now().isoformat(),
+            'message': 'Secure Exam Distribution System is running'
+        }
+
+    def client_address(self, remote_addr: str, forwarded_for: str = None) -> str:
+        """The client a request is rate limited and audited as (see utils.client_address)"""
+        return client_address(remote_addr, forwarded_for, self.trusted_proxies)
+
+    def check_rate_limit(self, client: str, endpoint: str):
+        """
+        Spend one of client's requests to endpoint, raising a 429 with
+        Retry-After once its bucket is empty. If the limiter's store fails
+        the request is let through rather than refused.
+        """
+        if self.rate_limiter is None:
+            return
+        limit = self.config[RATE_LIMIT_CLASSES.get(endpoint, 'RATE_LIMIT_GENERAL')]
+        try:
+            allowed, retry_after = self.rate_limiter.take(f"{client}|{endpoint}", limit)
+        except Exception:
+            RATE_LIMIT_ERRORS.inc()
+            return
+        if not allowed:
+            RATE_LIMITED.inc(endpoint)
+            raise ServiceError('Rate limit exceeded, please retry later', 429,
+                               headers={'Retry-After': str(retry_after)})
+
+    def metrics(self) -> str:
+        """
+        Prometheus text for /api/metrics: the request and stage metrics
+        recorded as requests run, plus cache, executor and audit counters
+        read from their stats at scrape time
+        """
+        caches = [('kdf', key_cache_stats())]
+        if self.plaintext_cache is not None:
+            caches.append(('plaintext', self.plaintext_cache.stats()))
+        mappings = getattr(self.blob_store, 'mappings', None)
+        if mappings is not None:
+            caches.append(('mmap', mappings.stats()))
+        executor = self.crypto_executor.stats()
+        audit = audit_logger().stats()
+
+        families = [
+            ('exam_cache_lookups_total', 'counter', 'Cache lookups by result',
+             [({'cache': name, 'result': result}, stats[key])
+              for name, stats in caches for result, key in (('hit', 'hits'), ('miss', 'misses'))]),
+            ('exam_cache_hit_ratio', 'gauge', 'Share of cache lookups that were hits',
+             [({'cache': name}, stats['hit_ratio']) for name, stats in caches]),
+            ('exam_cache_entries', 'gauge', 'Entries held in the cache',
+             [({'cache': name}, stats['size']) for name, stats in caches]),
+            ('exam_cache_evictions_total', 'counter', 'Entries evicted to make room',
+             [({'cache': name}, stats['evictions']) for name, stats in caches]),
+            ('exam_crypto_jobs_in_flight', 'gauge', 'Jobs running or queued on the crypto executor',
+             [({}, executor['in_flight'])]),
+            ('exam_crypto_jobs_rejected_total', 'counter', 'Jobs refused with 503 because the executor was full',
+             [({}, executor['rejected'])]),
+            ('exam_crypto_jobs_total', 'counter', 'Jobs finished on the crypto executor',
+             [({'job': name}, job['count']) for name, job in executor['jobs'].items()]),
+            ('exam_crypto_job_wait_seconds_total', 'counter', 'Time jobs spent queued before running',
+             [({'job': name}, job['wait_seconds']) for name, job in executor['jobs'].items()]),
+            ('exam_audit_records_queued', 'gauge', 'Audit records waiting to be written',
+             [({}, audit['queued'])]),
+            ('exam_audit_records_total', 'counter', 'Audit records by outcome',
+             [({'outcome': outcome}, audit[outcome]) for outcome in ('written', 'dropped')]),
+        ]
+
+        fsync_batcher = getattr(self.blob_store, 'fsync_batcher', None)
+        if fsync_batcher is not None:
+            families.append(('exam_fsync_batches_total', 'counter', 'Group-committed fsync batches',
+                             [({}, fsync_batcher.flushes)]))
+            families.append(('exam_fsync_paths_total', 'counter', 'Files and directories fsynced',
+                             [({}, fsync_batcher.synced)]))
+        return render_metrics(families)
+
+    def upload(self, stream, boundary: bytes) -> dict:
+        """
+        Encrypt and store the paper in a multipart/form-data body
+        The body is parsed as it arrives, so the paper is encrypted straight
+        from the request stream.
+        """
+        with audited('upload') as record:
+            result = self._upload(stream, boundary)
+            record.update(file_id=result['file_id'], filename=result['original_filename'],
+                          subject=result['subject'], exam_date=result['exam_date'],
+                          release_time=result['release_time'])
+            return result
+
+    def _upload(self, stream, boundary: bytes) -> dict:
+        fields = {}
+        original_filename = None
+        password = None
+        spooled = None
+        stored = None
+        parsed = False
+
+        try:
+            for name, filename, chunks in iter_multipart(stream, boundary):
+                if filename is None:
+                    if name == 'password' and name in fields:
+                        raise ServiceError('Send the password once')
+                    fields[name] = read_field(chunks)
+                    continue
+
+                if name != 'file' or original_filename is not None:
+                    continue
+
+                original_filename = filename
+                if original_filename == '':
+                    raise ServiceError('No file selected')
+
+                if not validate_file_type(original_filename):
+                    raise ServiceError('Invalid file type. Only PDF, DOC, DOCX allowed')
+
+                # The paper is encrypted with the password sent so far, and
+                # that is the password it is recorded with
+                password = fields.get('password')
+                if password:
+                    stored = self._store_encrypted(chunks, password, original_filename)
+                else:
+                    # Older clients send the file before the password field
+                    spooled = spool_chunks(chunks)
+
+            if original_filename is None:
+                raise ServiceError('No file provided')
+
+            if spooled is not None:
+                password = fields.get('password')
+            subject = fields.get('subject', 'Unknown')
+            exam_date = fields.get('exam_date', datetime.now().strftime('%Y-%m-%d'))
+
+            release_time = fields.get('release_time')
+
+            if not password:
+                raise ServiceError('Password is required')
+
+            if spooled is not None:
+                chunks = iter(lambda: spooled.read(READ_SIZE), b'')
+                stored = self._store_encrypted(chunks, password, original_filename)
+            parsed = True
+        except FileTooLargeError as e:
+            raise ServiceError(str(e), 413)
+        except ValueError as e:
+            # A malformed body, as for upload_batch
+            raise ServiceError(str(e))
+        finally:
+            if spooled is not None:
+                spooled.close()
+            # A paper encrypted before the rest of the body failed is not kept
+            if not parsed and stored is not None and os.path.exists(stored['staged_path']):
+                os.remove(stored['staged_path'])
+
+        return self._finish_upload(stored, original_filename, password, subject, exam_date, release_time)
+
+    def _finish_upload(self, stored: dict, original_filename: str, password: str,
+                       subject: str, exam_date: str, release_time: str = None) -> dict:
+        """Check an encrypted upload and record it, returning the upload response"""
+        if not validate_file_size(stored['file_size']):
+            os.remove(stored['staged_path'])
+            raise ServiceError('File is empty')
+
+        try:
+            release_time = self._release_time(release_time, exam_date)
+        except ServiceError:
+            os.remove(stored['staged_path'])
+            raise
+
+        # Store the blob (unless an identical one exists) and its metadata
+        file_id = stored['secure_filename']
+        self._commit_upload(file_id, {
+            'original_filename': original_filename,
+            'secure_filename': stored['secure_filename'],
+            'subject': subject,
+            'exam_date': exam_date,
+            'upload_time': datetime.now().isoformat(),
+            'file_size': stored['file_size'],
+            'content_hash': stored['content_hash'],
+            'release_time': release_time
+        }, stored, password)
+
+        return {
+            'message': 'File uploaded and encrypted successfully',
+            'file_id': file_id,
+            'original_filename': original_filename,
+            'subject': subject,
+            'exam_date': exam_date,
+            'release_time': release_time
+        }
+
+    def _release_time(self, value: str, exam_date: str):
+        """
+        Stored release time for an upload: value normalised, else the start of
+        exam_date if RELEASE_ON_EXAM_DATE is set, else None (released at once)
+        """
+        if not value and self.config['RELEASE_ON_EXAM_DATE']:
+            value = f'{exam_date}T00:00:00'
+        try:
+            return parse_release_time(value)
+        except (TypeError, ValueError):
+            raise ServiceError('Invalid release_time, expected an ISO 8601 date and time')
+
+    def upload_batch(self, stream, boundary: bytes):
+        """
+        Encrypt and store many papers from one multipart/form-data body
+        Plain fields (password, subject, exam_date, release_time, and metadata:
+        a JSON object of per-file overrides of those, keyed by file name)
+        apply to the files after them, and a .zip part is expanded into its
+        members. Papers are spooled as they arrive and encrypted concurrently
+        on the batch pool.
+        The fields before the first file are checked before this returns;
+        after that it yields progress events, and a paper that fails is
+        reported without stopping the rest.
+        """
+        parts = iter_multipart(stream, boundary)
+        fields = {}
+        first = None
+        try:
+            for name, filename, chunks in parts:
+                if filename is None:
+                    fields[name] = read_field(chunks)
+                    continue
+                first = (name, filename, chunks)
+                break
+        except ValueError as e:
+            raise ServiceError(str(e))
+
+        if first is None:
+            raise ServiceError('No file provided')
+        overrides = _batch_overrides(fields.get('metadata'))
+        return self._run_batch(itertools.chain([first], parts), fields, overrides)
+
+    def _run_batch(self, parts, fields: dict, overrides: dict):
+        pool = self._get_batch_pool()
+        pending = set()
+        archives = []
+        summary = {'event': 'summary', 'received': 0, 'stored': 0, 'failed': 0}
+
+        def collect(block):
+            if block:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            else:
+                done = [future for future in pending if future.done()]
+            for future in done:
+                pending.discard(future)
+                event = future.result()
+                summary[event['event']] += 1
+                yield event
+
+        try:
+            for name, filename, chunks in parts:
+                if filename is None:
+                    fields[name] = read_field(chunks)
+                    if name == 'metadata':
+                        overrides = _batch_overrides(fields[name])
+                    continue
+
+                try:
+                    if filename.lower().endswith('.zip'):
+                        spooled = spool_chunks(chunks)
+                        archives.append(spooled)
+                        archive = zipfile.ZipFile(spooled)
+                        items = ((info.filename, lambda info=info: archive.open(info))
+                                 for info in archive.infolist() if not info.is_dir())
+                    else:
+                        spooled = spool_chunks(StreamMeter().wrap(chunks))
+                        items = [(filename, lambda: spooled)]
+                except (FileTooLargeError, zipfile.BadZipFile) as e:
+                    status = 413 if isinstance(e, FileTooLargeError) else 400
+                    summary['received'] += 1
+                    summary['failed'] += 1
+                    yield {'event': 'failed', 'index': summary['received'] - 1, 'filename': filename,
+                           'status': status, 'error': str(e)}
+                    continue
+
+                for item_name, open_data in items:
+                    if summary['received'] >= self.config['BATCH_MAX_FILES']:
+                        raise ServiceError('Too many files in one batch', 413)
+                    # Stop reading the body while the workers are this far behind
+                    while len(pending) >= 2 * self.config['BATCH_UPLOAD_WORKERS']:
+                        yield from collect(True)
+
+                    index = summary['received']
+                    summary['received'] += 1
+                    settings = {
+                        'password': fields.get('password'),
+                        'subject': fields.get('subject', 'Unknown'),
+                        'exam_date': fields.get('exam_date', datetime.now().strftime('%Y-%m-%d')),
+                        'release_time': fields.get('release_time')
+                    }
+                    settings.update(overrides.get(item_name) or overrides.get(os.path.basename(item_name)) or {})
+                    # The copied context keeps the request's audit fields in the worker
+                    pending.add(pool.submit(contextvars.copy_context().run,
+                                            self._batch_item, index, item_name, open_data(), settings))
+                    yield {'event': 'received', 'index': index, 'filename': item_name}
+                    yield from collect(False)
+        except ServiceError as e:
+            yield {'event': 'error', 'status': e.status, 'error': str(e)}
+        except Exception as e:
+            yield {'event': 'error', 'status': 400, 'error': f'Batch upload stopped: {e}'}
+
+        try:
+            while pending:
+                yield from collect(True)
+        finally:
+            # Papers not started yet are dropped if the client goes away
+            for future in pending:
+                future.cancel()
+            for spooled in archives:
+                spooled.close()
+        yield summary
+
+    def _batch_item(self, index: int, filename: str, data, settings: dict) -> dict:
+        """Encrypt and store one paper of a batch, as a progress event"""
+        item = {'index': index, 'filename': filename}
+        original_filename = os.path.basename(filename)
+        try:
+            with audited('upload', filename=original_filename, batch_index=index) as record:
+                if not validate_file_type(original_filename):
+                    raise ServiceError('Invalid file type. Only PDF, DOC, DOCX allowed')
+                if not settings['password']:
+                    raise ServiceError('Password is required')
+
+                # The key is derived before any data is read, so a busy executor
+                # can be waited out and retried with the same data
+                for attempt in range(BATCH_BUSY_RETRIES + 1):
+                    try:
+                        chunks = iter(lambda: data.read(READ_SIZE), b'')
+                        stored = self._store_encrypted(chunks, settings['password'], original_filename)
+                        break
+                    except CryptoBusyError as e:
+                        if attempt == BATCH_BUSY_RETRIES:
+                            raise
+                        time.sleep(e.retry_after)
+
+                result = self._finish_upload(stored, original_filename, settings['password'],
+                                             settings['subject'], settings['exam_date'],
+                                             settings['release_time'])
+                record.update(file_id=result['file_id'], subject=result['subject'], exam_date=result['exam_date'],
+                              release_time=result['release_time'])
+        except ServiceError as e:
+            return dict({'event': 'failed'}, **item, status=e.status, error=str(e))
+        except FileTooLargeError as e:
+            return dict({'event': 'failed'}, **item, status=413, error=str(e))
+        except CryptoBusyError as e:
+            return dict({'event': 'failed'}, **item, status=503, error=str(e))
+        except Exception as e:
+            return dict({'event': 'failed'}, **item, status=500, error=f'Upload failed: {str(e)}')
+        finally:
+            data.close()
+
+        del result['message']
+        return dict({'event': 'stored'}, **item, **result)
+
+    def _get_batch_pool(self) -> ThreadPoolExecutor:
+        """Shared pool for batch papers, created on first use and again after a fork"""
+        with self._batch_pool_lock:
+            if self._batch_pool is None or self._batch_pool_pid != os.getpid():
+                self._batch_pool = ThreadPoolExecutor(
+                    max_workers=self.config['BATCH_UPLOAD_WORKERS'], thread_name_prefix='batch-upload'
+                )
+                self._batch_pool_pid = os.getpid()
+            return self._batch_pool
+
+    def _store_encrypted(self, chunks, password, original_filename):
+        """
+        Encrypt plaintext chunks into a staged file in one pass, measuring and
+        hashing the content on the way through
+        The paper gets a random data key, wrapped for password in its first
+        key slot before any data is read.
+        """
+        secure_filename = generate_secure_filename(original_filename)
+        data_key = generate_data_key()
+        key_slot = key_slot_record(wrap_data_key(data_key, password))
+        meter = StreamMeter()
+        timer = StageTimer('upload')
+
+        try:
+            staged_path, encrypted_size = write_temp(
+                encrypt_stream(meter.wrap(chunks), data_key), self.storage_folder, timer
+            )
+        finally:
+            timer.finish()
+
+        return {
+            'secure_filename': secure_filename,
+            'staged_path': staged_path,
+            'encrypted_size': encrypted_size,
+            'file_size': meter.size,
+            'content_hash': meter.content_hash(),
+            'key_slot': key_slot
+        }
+
+    def _commit_upload(self, file_id: str, metadata: dict, stored: dict, password: str):
+        """
+        Record a staged upload, keeping its blob only if no identical one exists
+        A blob is shared when it holds the same content and the uploader's
+        password opens it (for a data key encrypted blob, a key slot of one of
+        its papers, which the new paper gets a copy of), so every paper keeps
+        the password it was uploaded with. Otherwise the staged file becomes a
+        new blob named after file_id.
+        """
+        address = content_address(stored['content_hash'], self.config['DEDUP_KEY'])
+        staged_path = stored['staged_path']
+        try:
+            # Each attempt is a key derivation, so a popular blob cannot make
+            # an upload cost one per password it has
+            attempts = self.config['DEDUP_MAX_ATTEMPTS']
+            for blob in self.metadata_store.find_blobs(address):
+                if attempts <= 0:
+                    break
+                blob_id = blob['blob_id']
+                record = dict(metadata, blob_id=blob_id, encrypted_path=self.blob_store.location(blob_id))
+                opens, key_slot, tried = self._share_blob(blob_id, password, attempts)
+                attempts -= tried
+                if opens and self.metadata_store.add(file_id, record, key_slot=key_slot):
+                    os.remove(staged_path)
+                    if key_slot is not None:
+                        self._save_key_slots(blob_id)
+                    return
+
+            # fsync and rename into place, or the upload to S3
+            started = time.perf_counter()
+            self.blob_store.put(staged_path, file_id)
+            observe_stage('upload', 'commit', started)
+        except BaseException:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
+
+        record = dict(metadata, blob_id=file_id, encrypted_path=self.blob_store.location(file_id))
+        try:
+            self.metadata_store.add(file_id, record, {
+                'content_address': address, 'encrypted_size': stored['encrypted_size']
+            }, stored['key_slot'])
+        except BaseException:
+            self.blob_store.delete(file_id)
+            raise
+        self._save_key_slots(file_id)
+
+    def _save_key_slots(self, blob_id: str = None, file_id: str = None):
+        """
+        Copy the key slots of blob_id (or of file_id's blob) next to it in the
+        blob store, for rebuild_from_storage, after any change to them. The
+        database stays authoritative, so a failure is only logged.
+        """
+        if blob_id is None:
+            metadata = self.metadata_store.get(file_id)
+            if metadata is None:
+                return
+            blob_id = metadata['blob_id']
+        # None for a blob collected meanwhile or encrypted with its password
+        records = self.metadata_store.blob_key_slots(blob_id)
+        if not records:
+            return
+        try:
+            self.blob_store.put_key_slots(blob_id, encode_key_slots(records))
+        except Exception as e:
+            print(f"Error saving key slots of {blob_id}: {str(e)}")
+
+    def _share_blob(self, blob_id: str, password: str, max_attempts: int) -> tuple:
+        """
+        Whether password opens blob_id, trying at most max_attempts of its
+        key slots (oldest first), and the key slot record a new paper sharing
+        it needs (None for password encrypted blobs), as (opens, key slot,
+        attempts made). A busy executor just skips deduplication.
+        """
+        try:
+            with self.blob_store.open(blob_id) as f:
+                header = read_header(f)
+                if not _is_envelope(header):
+                    f.seek(0)
+                    return verify_password(f, password), None, 1
+            records = self.metadata_store.blob_key_slots(blob_id, max_attempts)
+            _, record = self._open_key_slots(records, header, password)
+        except Exception:
+            return False, None, max_attempts
+        if record is None:
+            return False, None, len(records)
+        key_slot = {name: record[name] for name in ('label', 'kdf', 'salt', 'wrapped_key', 'created_at')}
+        return True, key_slot, len(records)
+
+    def _open_key_slots(self, records: list, header, password: str) -> tuple:
+        """(DataKey, record) of the first key slot in records that password opens for header's file, or (None, None)"""
+        for record in records:
+            try:
+                data_key = unwrap_data_key(key_slot_from_record(record), password)
+            except ValueError:
+                continue
+            if key_check_matches(header, data_key):
+                return data_key, record
+        return None, None
+
+    def _unlock(self, file_id: str, header, password: str) -> tuple:
+        """
+        What opens file_id's blob, given its header, for password: password
+        itself, or for data key encrypted blobs the DataKey in the first of
+        the paper's key slots password opens. Returns (secret, key slot
+        record or None); raises ValueError if no key slot opens.
+        """
+        if not _is_envelope(header):
+            return password, None
+        data_key, record = self._open_key_slots(self.metadata_store.key_slots(file_id), header, password)
+        if data_key is None:
+            raise ValueError("invalid password")
+        return data_key, record
+
+    def list_etag(self, query_string: str) -> str:
+        """
+        ETag for a /api/files response
+        The store version changes on every write from any worker, so an
+        unchanged version and query means the client's copy is current. The
+        store's epoch keeps a new database's versions from matching.
+        """
+        store = self.metadata_store
+        etag_source = f"{store.epoch()}.{store.version()}?{query_string}"
+        return hashlib.sha256(etag_source.encode()).hexdigest()[:32]
+
+    def list_files(self, args) -> dict:
+        """
+        One page of uploaded files
+        args holds the filters in metadata_store.FILTERS, sort (upload_time or
+        exam_date), order (asc or desc), limit, cursor (the next_cursor of the
+        previous page) and fields (comma separated).
+        """
+        filters = {name: args[name] for name in FILTERS if args.get(name)}
+        sort = args.get('sort', 'upload_time')
+        descending = args.get('order', 'asc') == 'desc'
+        fields = args.get('fields')
+        fields = fields.split(',') if fields else list(LIST_FIELDS)
+
+        try:
+            limit = min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            after = decode_cursor(args['cursor'], sort) if args.get('cursor') else None
+        except ValueError:
+            raise ServiceError('Invalid limit or cursor')
+
+        if sort not in SORT_COLUMNS or limit < 1 or not set(fields) <= set(LIST_FIELDS):
+            raise ServiceError('Invalid sort, limit or fields')
+
+        rows = self.metadata_store.query_files(filters, sort, descending, after, limit)
+        return {
+            'files': [{field: row[field] for field in fields} for row in rows],
+            'total_files': self.metadata_store.count_files(filters),
+            'next_cursor': encode_cursor(rows[-1], sort) if len(rows) == limit else None
+        }
+
+    def _get_stored(self, file_id: str) -> dict:
+        """
+        Metadata for file_id, raising 404 if it or its blob is missing and
+        403 before its release_time
+        """
+        metadata = self.metadata_store.get(file_id)
+        if metadata is None:
+            raise ServiceError('File not found', 404)
+        self._check_released(metadata)
+
+        # A paper prepared for its release is known to be there
+        if self.release_warmer.lookup(metadata['blob_id']) is None \
+                and not self.blob_store.exists(metadata['blob_id']):
+            raise ServiceError('Encrypted file not found on disk', 404)
+        return metadata
+
+    def _check_released(self, metadata: dict):
+        """Refuse a paper before its release_time, without touching its blob"""
+        if not _is_released(metadata):
+            RELEASE_REFUSED.inc()
+            raise ServiceError('Paper not released yet', 403, {
+                'error': 'Paper not released yet', 'release_time': metadata['release_time']
+            })
+
+    def set_release_time(self, file_id: str, release_time: str, password: str = None,
+                         admin_token: str = None) -> dict:
+        """
+        Schedule file_id's release (None or '' releases it now)
+        With the RELEASE_ADMIN_TOKEN any change is allowed. Otherwise password
+        must open the paper, and a pending release can only be postponed:
+        students hold the password ahead of the release.
+        """
+        with audited('schedule', file_id=file_id) as record:
+            try:
+                release_time = parse_release_time(release_time)
+            except (TypeError, ValueError):
+                raise ServiceError('Invalid release_time, expected an ISO 8601 date and time')
+            record['release_time'] = release_time
+            admin = self._is_admin(admin_token)
+            record['admin'] = admin
+            if admin:
+                if not self.metadata_store.set_release_time(file_id, release_time):
+                    raise ServiceError('File not found', 404)
+            else:
+                self._check_password(file_id, password)
+                now = datetime.now().isoformat(timespec='seconds')
+                if not self.metadata_store.set_release_time(file_id, release_time, now):
+                    if self.metadata_store.get(file_id) is None:
+                        raise ServiceError('File not found', 404)
+                    raise ServiceError('Only an administrator can bring a pending release forward', 403)
+
+        return {'message': 'Release time updated', 'file_id': file_id, 'release_time': release_time}
+
+    def open_download(self, file_id: str, password: str, range_header: str = None,
+                      if_range: str = None) -> Download:
+        """
+        Start decrypting a paper for download
+        The password is checked before this returns, so a wrong one is a 401
+        rather than a broken stream. For chunked files a single byte range
+        (honouring If-Range against the paper's ETag) decrypts only the
+        segments it covers; legacy files are always sent whole and chunked,
+        as their exact size is not recorded.
+        """
+        with audited('download', file_id=file_id) as record:
+            download = self._open_download(file_id, password, range_header, if_range)
+            record.update(status=download.status, range=download.headers.get('Content-Range'))
+            return download
+
+    def _open_download(self, file_id: str, password: str, range_header: str = None,
+                       if_range: str = None) -> Download:
+        if not password:
+            raise ServiceError('Password is required')
+
+        metadata = self._get_stored(file_id)
+        blob_id = metadata['blob_id']
+        warm = self.release_warmer.lookup(blob_id)
+        encrypted_file = self.blob_store.open(blob_id)
+        try:
+            if warm is not None:
+                RELEASE_WARM_HITS.inc('download')
+                encrypted_size, header = warm.encrypted_size, warm.header
+            else:
+                # Sized through the open file: on S3 that is the GET the read needs anyway
+                encrypted_size = encrypted_file.seek(0, os.SEEK_END)
+                encrypted_file.seek(0)
+                header = read_header(encrypted_file)
+            size = plaintext_size(header, encrypted_size)
+            headers = attachment_headers(metadata['original_filename'])
+
+            secret, key_slot = self._unlock(file_id, header, password)
+            byte_range = None
+            if header is not None:
+                # The password is checked before the Range header, so a 416
+                # never tells a client without it the paper's size
+                if header.key_check is not None:
+                    valid = key_check_matches(header, secret)
+                else:
+                    encrypted_file.seek(0)
+                    valid = verify_password(encrypted_file, secret)
+                if not valid:
+                    raise ServiceError('Invalid password', 401)
+                # The header's salt and nonce are unique per encryption
+                etag = hashlib.sha256(header.raw).hexdigest()[:32]
+                headers['ETag'] = f'"{etag}"'
+                headers['Accept-Ranges'] = 'bytes'
+                byte_range = _requested_range(range_header, if_range, etag, size)
+            start, stop = byte_range or (0, size)
+
+            ttl = self._plaintext_ttl(metadata)
+            if self.plaintext_cache is not None and ttl > 0:
+                # Keyed by blob, so every paper sharing it shares the cached copy
+                chunks = self.plaintext_cache.open(
+                    blob_id, header, size, lambda: self.blob_store.open(blob_id), secret, start, stop, ttl
+                )
+            else:
+                chunks = None
+
+            if chunks is not None:
+                encrypted_file.close()
+                close = chunks.close
+            elif byte_range:
+                chunks = decrypt_range(encrypted_file, secret, start, stop, encrypted_size)
+                close = encrypted_file.close
+            else:
+                encrypted_file.seek(0)
+                chunks = decrypt_stream(encrypted_file, secret)
+                close = encrypted_file.close
+            self.rekeyer.offer(file_id, blob_id, header, password, secret, key_slot)
+        except (CryptoBusyError, ServiceError):
+            encrypted_file.close()
+            raise
+        except Exception:
+            encrypted_file.close()
+            raise ServiceError('Invalid password or corrupted file', 401)
+
+        if size is not None:
+            headers['Content-Length'] = str(stop - start)
+        if byte_range:
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            return Download(metadata, chunks, 206, headers, close)
+        return Download(metadata, chunks, 200, headers, close)
+
+    def _plaintext_ttl(self, metadata: dict) -> float:
+        """
+        How long a paper's plaintext may stay cached: until its release window,
+        the PLAINTEXT_CACHE_TTL_SECONDS after its release_time, closes (0 once
+        it has). A paper without a release time opens one on first download.
+        """
+        window = self.config['PLAINTEXT_CACHE_TTL_SECONDS']
+        if not metadata['release_time']:
+            return window
+        elapsed = (datetime.now() - datetime.fromisoformat(metadata['release_time'])).total_seconds()
+        return min(window, max(window - elapsed, 0))
+
+    def open_bundle(self, selection: dict) -> Download:
+        """
+        Start a zip of several decrypted papers
+        selection holds file_ids, or subject and exam_date selecting every
+        paper of that session, and the password (or passwords, mapping
+        file_id to password). Every paper is opened and its password checked
+        in parallel before this returns, so a wrong one is a 401 naming the
+        papers rather than a broken zip. While the zip is written out in
+        order, up to BUNDLE_PARALLEL papers decrypt ahead of it.
+        """
+        with audited('bundle') as record:
+            download = self._open_bundle(selection)
+            record['file_ids'] = [metadata['file_id'] for metadata in download.metadata['files']]
+            return download
+
+    def _open_bundle(self, selection: dict) -> Download:
+        records = self._bundle_records(selection)
+        passwords = selection.get('passwords') or {}
+        if not isinstance(passwords, dict):
+            raise ServiceError('passwords must map file_id to password')
+
+        pool = ThreadPoolExecutor(max_workers=self.config['BUNDLE_PARALLEL'], thread_name_prefix='bundle')
+        stop = threading.Event()
+        opened = [None] * len(records)
+
+        def open_paper(index, record):
+            password = passwords.get(record['file_id']) or selection.get('password')
+            if not password:
+                raise ServiceError('Password is required')
+            encrypted_file = self.blob_store.open(record['blob_id'])
+            opened[index] = encrypted_file
+            secret, _ = self._unlock(record['file_id'], read_header(encrypted_file), password)
+            encrypted_file.seek(0)
+            return decrypt_stream(encrypted_file, secret)
+
+        def close():
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            for encrypted_file in opened:
+                if encrypted_file is not None:
+                    encrypted_file.close()
+
+        futures = [pool.submit(open_paper, i, record) for i, record in enumerate(records)]
+        streams = []
+        refused = []
+        try:
+            for record, future in zip(records, futures):
+                try:
+                    streams.append(future.result())
+                except (CryptoBusyError, ServiceError):
+                    raise
+                except Exception:
+                    refused.append(record['file_id'])
+        except BaseException:
+            close()
+            raise
+        if refused:
+            close()
+            raise ServiceError('Invalid password or corrupted file', 401, {
+                'error': 'Invalid password or corrupted file', 'file_ids': refused
+            })
+
+        def entries():
+            parallel = self.config['BUNDLE_PARALLEL']
+            queues = {}
+            used_names = set()
+
+            def start(index):
+                queues[index] = queue.Queue(BUNDLE_QUEUE_CHUNKS)
+                pool.submit(_pump, streams[index], queues[index], stop)
+
+            for index in range(min(parallel, len(records))):
+                start(index)
+            for index, record in enumerate(records):
+                if index + parallel < len(records):
+                    start(index + parallel)
+                upload_time = datetime.fromisoformat(record['upload_time'])
+                yield (_unique_name(record['original_filename'], used_names),
+                       upload_time.timetuple()[:6], record['file_size'], _drain(queues.pop(index)))
+
+        name = (f"{selection['subject']}_{selection['exam_date']}.zip"
+                if not selection.get('file_ids') else 'exam_bundle.zip')
+        headers = attachment_headers(name)
+        return Download({'files': records}, stream_zip(entries()), 200, headers, close)
+
+    def _bundle_records(self, selection: dict) -> list:
+        """The papers a bundle request selects, in a stable order"""
+        file_ids = selection.get('file_ids')
+        limit = self.config['BUNDLE_MAX_FILES']
+        if file_ids:
+            if not isinstance(file_ids, list) or not all(isinstance(f, str) for f in file_ids):
+                raise ServiceError('file_ids must be a list of file ids')
+            if len(file_ids) > limit:
+                raise ServiceError(f'At most {limit} files per bundle', 413)
+
+            records = []
+            missing = []
+            for file_id in dict.fromkeys(file_ids):
+                metadata = self.metadata_store.get(file_id)
+                if metadata is None or not self.blob_store.exists(metadata['blob_id']):
+                    missing.append(file_id)
+                else:
+                    records.append(metadata)
+            if missing:
+                raise ServiceError('File not found', 404, {'error': 'File not found', 'file_ids': missing})
+            self._check_bundle_released(records)
+            return records
+
+        if not selection.get('subject') or not selection.get('exam_date'):
+            raise ServiceError('Provide file_ids, or subject and exam_date')
+        filters = {
+            'subject': selection['subject'],
+            'exam_date_from': selection['exam_date'],
+            'exam_date_to': selection['exam_date']
+        }
+        records = self.metadata_store.query_files(filters, limit=limit + 1)
+        if not records:
+            raise ServiceError('No files match', 404)
+        if len(records) > limit:
+            raise ServiceError(f'At most {limit} files per bundle', 413)
+        self._check_bundle_released(records)
+        return records
+
+    def _check_bundle_released(self, records: list):
+        """403 naming the papers not released yet, before any is opened"""
+        unreleased = [record['file_id'] for record in records if not _is_released(record)]
+        if unreleased:
+            RELEASE_REFUSED.inc()
+            raise ServiceError('Paper not released yet', 403, {
+                'error': 'Paper not released yet', 'file_ids': unreleased
+            })
+
+    def delete(self, file_id: str, event: str = 'delete') -> dict:
+        # Remove from metadata; the blob goes with its last reference.
+        # Retention cleanup deletes papers audited as event='expire'
+        with audited(event, file_id=file_id):
+            metadata = self.metadata_store.get(file_id)
+            if metadata is None or not self.metadata_store.delete(file_id, self._collect_blob):
+                raise ServiceError('File not found', 404)
+            # Papers sharing the blob keep it, without this paper's key slot
+            self._save_key_slots(metadata['blob_id'])
+
+        return {'message': 'File deleted successfully'}
+
+    def _collect_blob(self, blob_id: str):
+        """Remove a blob no paper references any more"""
+        self.blob_store.collect(blob_id)
+        self.release_warmer.discard(blob_id)
+        if self.plaintext_cache is not None:
+            self.plaintext_cache.invalidate(blob_id)
+
+    def verify(self, file_id: str, password: str) -> dict:
+        """Check a password reading only the file header"""
+        with audited('verify', file_id=file_id):
+            if not password:
+                raise ServiceError('Password is required')
+
+            metadata = self._get_stored(file_id)
+            blob_id = metadata['blob_id']
+            warm = self.release_warmer.lookup(blob_id)
+
+            try:
+                if warm is not None:
+                    header = warm.header
+                else:
+                    with self.blob_store.open(blob_id) as f:
+                        header = read_header(f)
+                if header is not None and header.key_check is not None:
+                    if warm is not None:
+                        # Nothing to read: the header came from the warm-up
+                        RELEASE_WARM_HITS.inc('verify')
+                    secret, _ = self._unlock(file_id, header, password)
+                    valid = key_check_matches(header, secret)
+                else:
+                    # Legacy and version 1 files are checked against their data
+                    with self.blob_store.open(blob_id) as f:
+                        valid = verify_password(f, password)
+            except CryptoBusyError:
+                raise
+            except Exception:
+                valid = False
+
+            if not valid:
+                raise ServiceError('Invalid password', 401, {'valid': False, 'message': 'Invalid password'})
+
+        return {
+            'valid': True,
+            'message': 'Password is correct',
+            'file_info': {
+                'original_filename': metadata['original_filename'],
+                'subject': metadata['subject'],
+                'exam_date': metadata['exam_date'],
+                'file_size': metadata['file_size']
+            }
+        }
+
+    def list_passwords(self, file_id: str) -> dict:
+        """
+        file_id's key slots, without their keys. A paper stored before data
+        keys has none: it opens with the password it was uploaded with.
+        """
+        if self.metadata_store.get(file_id) is None:
+            raise ServiceError('File not found', 404)
+        return {
+            'file_id': file_id,
+            'passwords': [{
+                'slot_id': record['slot_id'],
+                'label': record['label'],
+                'kdf': record['kdf'].partition(':')[0],
+                'created_at': record['created_at']
+            } for record in self.metadata_store.key_slots(file_id)]
+        }
+
+    def add_password(self, file_id: str, password: str, new_password: str, label: str = None) -> dict:
+        """Let new_password open file_id as well as password, which must open it already"""
+        with audited('password_add', file_id=file_id, label=label) as record:
+            if not new_password:
+                raise ServiceError('new_password is required')
+            data_key, _ = self._unlock_envelope(file_id, password)
+            slot_id = self.metadata_store.add_key_slot(
+                file_id, key_slot_record(wrap_data_key(data_key, new_password), label)
+            )
+            if slot_id is None:
+                raise ServiceError('File not found', 404)
+            record['slot_id'] = slot_id
+            self._save_key_slots(file_id=file_id)
+
+        return {'message': 'Password added', 'file_id': file_id, 'slot_id': slot_id}
+
+    def change_password(self, file_id: str, password: str, new_password: str) -> dict:
+        """Replace the key slot password opens with one for new_password; the paper itself is untouched"""
+        with audited('password_change', file_id=file_id) as record:
+            if not new_password:
+                raise ServiceError('new_password is required')
+            data_key, key_slot = self._unlock_envelope(file_id, password)
+            record['slot_id'] = key_slot['slot_id']
+            replacement = key_slot_record(wrap_data_key(data_key, new_password), key_slot['label'])
+            if not self.metadata_store.update_key_slot(key_slot['slot_id'], replacement, key_slot['wrapped_key']):
+                raise ServiceError('Password was changed or revoked meanwhile', 409)
+            self._save_key_slots(file_id=file_id)
+
+        return {'message': 'Password changed', 'file_id': file_id, 'slot_id': key_slot['slot_id']}
+
+    def revoke_password(self, file_id: str, slot_id: str, password: str) -> dict:
+        """
+        Remove one of file_id's key slots. password must open one of them
+        (the revoked one included); the last one cannot be removed.
+        """
+        with audited('password_revoke', file_id=file_id, slot_id=slot_id):
+            self._unlock_envelope(file_id, password)
+            if not self.metadata_store.delete_key_slot(file_id, slot_id):
+                if any(r['slot_id'] == slot_id for r in self.metadata_store.key_slots(file_id)):
+                    raise ServiceError('Cannot revoke the last password, change it instead', 409)
+                raise ServiceError('Password not found', 404)
+            self._save_key_slots(file_id=file_id)
+
+        return {'message': 'Password revoked', 'file_id': file_id, 'slot_id': slot_id}
+
+    def _is_admin(self, admin_token: str) -> bool:
+        expected = self.config['RELEASE_ADMIN_TOKEN']
+        return bool(expected and admin_token) and hmac.compare_digest(expected.encode(), admin_token.encode())
+
+    def _check_password(self, file_id: str, password: str) -> tuple:
+        """
+        Check password opens file_id, regardless of its release time; returns
+        (metadata, header, unlocked), unlocked being the (DataKey, key slot
+        record) of a data key encrypted paper and None for older ones
+        """
+        if not password:
+            raise ServiceError('Password is required')
+
+        metadata = self.metadata_store.get(file_id)
+        if metadata is None or not self.blob_store.exists(metadata['blob_id']):
+            raise ServiceError('File not found', 404)
+        with self.blob_store.open(metadata['blob_id']) as f:
+            header = read_header(f)
+            if not _is_envelope(header):
+                f.seek(0)
+                if not verify_password(f, password):
+                    raise ServiceError('Invalid password', 401)
+                return metadata, header, None
+
+        try:
+            return metadata, header, self._unlock(file_id, header, password)
+        except ValueError:
+            raise ServiceError('Invalid password', 401)
+
+    def _unlock_envelope(self, file_id: str, password: str) -> tuple:
+        """
+        The (DataKey, key slot record) password opens for file_id, regardless
+        of its release time. A paper stored before data keys is converted
+        first, a one-off re-encryption (see Rekeyer.convert). A legacy paper
+        with no content hash on record (one recovered by rebuild_from_storage)
+        cannot be: its password is not authenticated well enough to rewrite
+        it, so it is a 409 and the paper has to be uploaded again.
+        """
+        for attempt in range(2):
+            metadata, header, unlocked = self._check_password(file_id, password)
+            if unlocked is not None:
+                return unlocked
+            if attempt == 0:
+                try:
+                    self.rekeyer.convert(metadata['blob_id'], header, password)
+                except ValueError:
+                    # A wrong password that passed the legacy padding check
+                    raise ServiceError('Invalid password', 401)
+
+        raise ServiceError('This paper predates password management and has no content hash to convert it '
+                           'safely; upload it again to manage its passwords', 409)
+
+def _is_envelope(header) -> bool:
+    """Whether a blob with this header is encrypted with a data key opened through key slots"""
+    return header is not None and header.version >= ENVELOPE_VERSION
+
+def _is_released(metadata: dict) -> bool:
+    # Stored release times are local ISO 8601 to the second, so they compare as strings
+    release_time = metadata['release_time']
+    return not release_time or release_time <= datetime.now().isoformat(timespec='seconds')
+
+def _batch_overrides(value: str) -> dict:
+    """Parse the metadata field of a batch upload"""
+    try:
+        overrides = json.loads(value or '{}')
+    except ValueError:
+        overrides = None
+    if not isinstance(overrides, dict) or not all(isinstance(v, dict) for v in overrides.values()):
+        raise ServiceError('metadata must be a JSON object of per-file settings keyed by file name')
+    return {name: {k: v for k, v in settings.items() if k in BATCH_SETTINGS}
+            for name, settings in overrides.items()}
+
+def _pump(chunks, out: queue.Queue, stop: threading.Event):
+    """Move a paper's decrypted chunks into out, ending with _END or the error raised"""
+    def put(item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for chunk in chunks:
+            if not put(chunk):
+                return
+    except Exception as e:
+        put(e)
+        return
+    put(_END)
+
+def _drain(out: queue.Queue):
+    """Iterate over the chunks _pump puts in out"""
+    while True:
+        item = out.get()
+        if item is _END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def _unique_name(name: str, used: set) -> str:
+    """name, or name with a (n) suffix if the archive already has it"""
+    stem, ext = os.path.splitext(name)
+    candidate = name
+    n = 1
+    while candidate in used:
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    used.add(candidate)
+    return candidate
+
+def _requested_range(range_header: str, if_range: str, etag: str, size: int):
+    """
+    The (start, stop) a Range header asks for, or None to send the whole file
+    Multiple ranges and a stale If-Range fall back to the whole file; an
+    unsatisfiable range is a 416.
+    """
+    if not range_header:
+        return None
+    if if_range and parse_if_range_header(if_range).etag != etag:
+        return None
+
+    parsed = parse_range_header(range_header)
+    if parsed is None or len(parsed.ranges) != 1:
+        return None
+    byte_range = parsed.range_for_length(size)
+    if byte_range is None:
+        raise ServiceError('Requested range not satisfiable', 416,
+                           headers={'Content-Range': f'bytes */{size}'})
+    return byte_range
@@ -0,0 +1,569 @@
+import io
+import os
+import mmap
+import hashlib
+import heapq
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from cache import TTLCache
+from streaming import BufferReader
+
+# Encrypted blobs are stored as <blob_id>.enc, with a copy of their key slots
+# (data key encrypted blobs only) in <blob_id>.slots
+BLOB_SUFFIX = '.enc'
+KEY_SLOTS_SUFFIX = '.slots'
+
+# Leading bytes of an S3 object a reader keeps once read (the header and more)
+S3_PREFIX_SIZE = 4096
+
+class BlobStore(ABC):
+    """
+    Where encrypted papers (blobs) live
+    Uploads are encrypted into a local staging file first and handed over with
+    put(), so a backend only has to move finished files and serve reads.
+    """
+
+    @abstractmethod
+    def put(self, staged_path: str, blob_id: str):
+        """Take ownership of a finished local file as blob_id"""
+
+    @abstractmethod
+    def open(self, blob_id: str):
+        """Seekable binary file object for blob_id"""
+
+    @abstractmethod
+    def size(self, blob_id: str) -> int:
+        """Size of blob_id in bytes"""
+
+    @abstractmethod
+    def modified(self, blob_id: str) -> float:
+        """Timestamp the blob was last written"""
+
+    @abstractmethod
+    def exists(self, blob_id: str) -> bool:
+        """Whether blob_id is stored"""
+
+    @abstractmethod
+    def delete(self, blob_id: str):
+        """Remove blob_id and its key slots"""
+
+    @abstractmethod
+    def put_key_slots(self, blob_id: str, data: bytes):
+        """
+        Store (replacing) the encoded key slots of blob_id next to it, so it
+        can still be opened after the metadata database is rebuilt
+        """
+
+    @abstractmethod
+    def get_key_slots(self, blob_id: str):
+        """The bytes last given to put_key_slots for blob_id, or None"""
+
+    @abstractmethod
+    def iter_blob_ids(self):
+        """Iterate over every stored blob id without listing them all at once"""
+
+    @abstractmethod
+    def location(self, blob_id: str) -> str:
+        """Human-readable location of blob_id, recorded in file metadata"""
+
+    def prefetch(self, blob_id: str):
+        """Hint that blob_id is about to be read a lot; nothing to do by default"""
+
+    def collect(self, blob_id: str):
+        """Delete blob_id, which no paper references any more; readers that have it open may finish"""
+        self.delete(blob_id)
+
+class FsyncBatcher:
+    """
+    Group commit for fsync
+    Callers queue files and directories and wait for the next flush. A
+    background thread fsyncs everything queued since the previous flush in
+    one go, each path once, so concurrent uploads into the same shard share
+    a directory fsync instead of each paying for their own. The thread is
+    started on first use and again after a fork.
+    """
+
+    def __init__(self, max_delay: float = 0.002):
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._batch = _FsyncBatch()
+        self._thread_pid = None
+        self.flushes = 0
+        self.synced = 0
+
+    def sync(self, paths, wait: bool = True):
+        """fsync paths in the next batch, by default waiting until it is done"""
+        with self._cond:
+            if self._thread_pid != os.getpid():
+                threading.Thread(target=self._run, name='fsync-batcher', daemon=True).start()
+                self._thread_pid = os.getpid()
+            batch = self._batch
+            batch.paths.update(paths)
+            self._cond.notify()
+        if wait:
+            batch.done.wait()
+            for path in paths:
+                if path in batch.errors:
+                    raise batch.errors[path]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._batch.paths:
+                    self._cond.wait()
+            # Give concurrent writers a moment to join this batch
+            time.sleep(self.max_delay)
+            with self._cond:
+                batch, self._batch = self._batch, _FsyncBatch()
+
+            # Files before directories, so renamed entries point at synced data
+            for path in sorted(batch.paths, key=os.path.isdir):
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    batch.errors[path] = e
+            self.flushes += 1
+            self.synced += len(batch.paths)
+            batch.done.set()
+
+class _FsyncBatch:
+    def __init__(self):
+        self.paths = set()
+        self.errors = {}
+        self.done = threading.Event()
+
+class DelayedDeleter:
+    """
+    Deletes blobs delay seconds after they are handed over
+    A background thread, started on first use and again after a fork, runs
+    the deletes when they are due. Deletes still pending when the process
+    exits are lost, leaving orphans for CleanupScheduler to remove.
+    """
+
+    def __init__(self, delete, delay: float):
+        self.delete = delete
+        self.delay = delay
+        self._cond = threading.Condition()
+        # (due time, blob_id) heap
+        self._pending = []
+        self._thread_pid = None
+
+    def schedule(self, blob_id: str):
+        with self._cond:
+            if self._thread_pid != os.getpid():
+                # The parent process still deletes what it scheduled
+                self._pending = []
+                threading.Thread(target=self._run, name='blob-collector', daemon=True).start()
+                self._thread_pid = os.getpid()
+            heapq.heappush(self._pending, (time.monotonic() + self.delay, blob_id))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending or self._pending[0][0] > time.monotonic():
+                    self._cond.wait(self._pending[0][0] - time.monotonic() if self._pending else None)
+                _, blob_id = heapq.heappop(self._pending)
+            try:
+                self.delete(blob_id)
+            except Exception as e:
+                print(f"Error deleting blob {blob_id}: {str(e)}")
+
+class LocalBlobStore(BlobStore):
+    """
+    Blobs as files in a local directory (STORAGE_FOLDER)
+    The sharded layout fans blobs out over two levels of hex prefixes of a
+    hash of the blob id (ab/cd/<blob_id>.enc), so no directory grows past a
+    few thousand entries. Blobs still in the old flat layout are found until
+    migrate_storage.py moves them. fsync is 'batch' (durable, group
+    committed), 'async' (queued but not waited for) or 'off'.
+
+    With mmap_entries set, blobs are read through read-only memory mappings
+    shared by every reader in the process: the LRU keeps up to mmap_entries
+    of them (mmap_bytes in total) for mmap_ttl seconds, and open() returns a
+    BufferReader handing out slices of the page cache instead of copies. A
+    mapping dropped from the cache is unmapped once its last reader is done.
+    """
+
+    def __init__(self, root: str, layout: str = 'sharded', fsync: str = 'batch', mmap_entries: int = 0,
+                 mmap_bytes: int = None, mmap_ttl: float = 600):
+        if layout not in ('sharded', 'flat') or fsync not in ('batch', 'async', 'off'):
+            raise ValueError(f"Unknown storage layout or fsync mode: {layout}, {fsync}")
+        self.root = root
+        self.layout = layout
+        self.fsync = fsync
+        self.fsync_batcher = FsyncBatcher() if fsync != 'off' else None
+        # blob_id -> ((inode, size, mtime), mapping)
+        self.mappings = None
+        if mmap_entries:
+            self.mappings = TTLCache(max_entries=mmap_entries, ttl_seconds=mmap_ttl, max_size=mmap_bytes,
+                                     sizeof=lambda entry: len(entry[1]))
+        os.makedirs(root, exist_ok=True)
+
+    def flat_path(self, blob_id: str) -> str:
+        return os.path.join(self.root, blob_id + BLOB_SUFFIX)
+
+    def path(self, blob_id: str) -> str:
+        """Where blob_id is written under the configured layout"""
+        if self.layout == 'flat':
+            return self.flat_path(blob_id)
+        digest = hashlib.sha256(blob_id.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], blob_id + BLOB_SUFFIX)
+
+    def _locate(self, blob_id: str) -> str:
+        """Path of an existing blob, which may not have been migrated yet"""
+        path = self.path(blob_id)
+        if self.layout == 'sharded' and not os.path.exists(path):
+            flat_path = self.flat_path(blob_id)
+            if os.path.exists(flat_path):
+                return flat_path
+        return path
+
+    def _sync(self, paths: list):
+        if self.fsync_batcher is not None:
+            self.fsync_batcher.sync(paths, wait=self.fsync == 'batch')
+
+    def put(self, staged_path: str, blob_id: str):
+        target = self.path(blob_id)
+        directory = os.path.dirname(target)
+        new_directories = []
+        parent = directory
+        while not os.path.isdir(parent):
+            new_directories.append(parent)
+            parent = os.path.dirname(parent)
+        if new_directories:
+            os.makedirs(directory, exist_ok=True)
+
+        # Data before the rename, then the directory entries that make it visible
+        self._sync([staged_path])
+        os.replace(staged_path, target)
+        self._sync([directory] + [os.path.dirname(d) for d in new_directories])
+
+    def move(self, blob_id: str) -> bool:
+        """Move a flat-layout blob to its sharded path; False if there was nothing to move"""
+        source = self.flat_path(blob_id)
+        target = self.path(blob_id)
+        if source == target or not os.path.exists(source):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(_key_slots_path(source)):
+            os.replace(_key_slots_path(source), _key_slots_path(target))
+        os.replace(source, target)
+        return True
+
+    def open(self, blob_id: str):
+        path = self._locate(blob_id)
+        if self.mappings is None:
+            return open(path, 'rb', buffering=0)
+        return BufferReader(self._mapping(blob_id, path))
+
+    def _mapping(self, blob_id: str, path: str):
+        """The shared mapping of the blob at path, mapped on first use"""
+        stat = os.stat(path)
+        if not stat.st_size:
+            # mmap refuses empty files
+            return b''
+        identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        entry = self.mappings.get_or_compute(blob_id, lambda: (identity, _map_file(path)))
+        if entry[0] != identity:
+            # Deleted and written again (by another worker) since it was mapped
+            self.mappings.pop(blob_id)
+            entry = self.mappings.get_or_compute(blob_id, lambda: (identity, _map_file(path)))
+        return entry[1]
+
+    def prefetch(self, blob_id: str):
+        """Have the kernel read the blob into the page cache in the background, and map it"""
+        path = self._locate(blob_id)
+        if hasattr(os, 'posix_fadvise'):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        if self.mappings is not None:
+            self._mapping(blob_id, path)
+
+    def size(self, blob_id: str) -> int:
+        return os.path.getsize(self._locate(blob_id))
+
+    def modified(self, blob_id: str) -> float:
+        return os.path.getmtime(self._locate(blob_id))
+
+    def exists(self, blob_id: str) -> bool:
+        return os.path.exists(self._locate(blob_id))
+
+    def delete(self, blob_id: str):
+        if self.mappings is not None:
+            self.mappings.pop(blob_id)
+        path = self._locate(blob_id)
+        for target in (path, _key_slots_path(path)):
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+
+    def put_key_slots(self, blob_id: str, data: bytes):
+        target = _key_slots_path(self._locate(blob_id))
+        directory = os.path.dirname(target)
+        fd, staged_path = tempfile.mkstemp(dir=directory, prefix='.slots-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self._sync([staged_path])
+            os.replace(staged_path, target)
+        except BaseException:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
+        self._sync([directory])
+
+    def get_key_slots(self, blob_id: str):
+        try:
+            with open(_key_slots_path(self._locate(blob_id)), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def iter_blob_ids(self):
+        """Blob ids in both layouts, one directory listing open at a time per level"""
+        if not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.endswith(BLOB_SUFFIX) and entry.is_file():
+                    yield entry.name[:-len(BLOB_SUFFIX)]
+                elif _is_shard(entry):
+                    with os.scandir(entry.path) as shards:
+                        for shard in shards:
+                            if not _is_shard(shard):
+                                continue
+                            with os.scandir(shard.path) as blobs:
+                                for blob in blobs:
+                                    if blob.name.endswith(BLOB_SUFFIX) and blob.is_file():
+                                        yield blob.name[:-len(BLOB_SUFFIX)]
+
+    def location(self, blob_id: str) -> str:
+        return self._locate(blob_id)
+
+def _map_file(path: str) -> mmap.mmap:
+    # The mapping keeps its own reference to the file, so it can be closed here
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _key_slots_path(path: str) -> str:
+    """Where the key slots of the blob at path are kept"""
+    return path[:-len(BLOB_SUFFIX)] + KEY_SLOTS_SUFFIX
+
+def _is_shard(entry) -> bool:
+    return len(entry.name) == 2 and all(c in '0123456789abcdef' for c in entry.name) and entry.is_dir()
+
+class S3BlobStore(BlobStore):
+    """
+    Blobs as objects in an S3-compatible bucket
+    endpoint_url points it at MinIO or another local stand-in for testing.
+    Reads stream ranged GETs (see _S3RangeReader), so downloads and Range
+    requests fetch only what they send, in as few requests as possible.
+    A reader asks for a new body after a seek, which fails once its object
+    is deleted, so collected blobs are only deleted collect_delay seconds
+    later.
+    """
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: str = None, client=None,
+                 collect_delay: float = 600):
+        self.collector = DelayedDeleter(self.delete, collect_delay) if collect_delay else None
+        self._new_client = None
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError("STORAGE_BACKEND 's3' requires boto3 (pip install boto3)")
+            self._new_client = lambda: boto3.client('s3', endpoint_url=endpoint_url)
+            client = self._new_client()
+        self._client = client
+        self._client_pid = os.getpid()
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @property
+    def client(self):
+        # botocore clients are not fork safe: a worker forked after the store
+        # was opened (see ExamService.warm_up) makes its own
+        if self._client_pid != os.getpid() and self._new_client is not None:
+            self._client = self._new_client()
+            self._client_pid = os.getpid()
+        return self._client
+
+    def _key(self, blob_id: str, suffix: str = BLOB_SUFFIX) -> str:
+        return f"{self.prefix}{blob_id}{suffix}"
+
+    def put(self, staged_path: str, blob_id: str):
+        self.client.upload_file(staged_path, self.bucket, self._key(blob_id))
+        os.remove(staged_path)
+
+    def open(self, blob_id: str):
+        return _S3RangeReader(self.client, self.bucket, self._key(blob_id))
+
+    def size(self, blob_id: str) -> int:
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(blob_id))['ContentLength']
+
+    def modified(self, blob_id: str) -> float:
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(blob_id))['LastModified'].timestamp()
+
+    def exists(self, blob_id: str) -> bool:
+        try:
+            self.size(blob_id)
+            return True
+        except Exception as e:
+            if _error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def delete(self, blob_id: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(blob_id))
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(blob_id, KEY_SLOTS_SUFFIX))
+
+    def collect(self, blob_id: str):
+        if self.collector is None:
+            self.delete(blob_id)
+        else:
+            self.collector.schedule(blob_id)
+
+    def put_key_slots(self, blob_id: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(blob_id, KEY_SLOTS_SUFFIX), Body=data)
+
+    def get_key_slots(self, blob_id: str):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(blob_id, KEY_SLOTS_SUFFIX))
+        except Exception as e:
+            if _error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response['Body'].read()
+
+    def iter_blob_ids(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                key = item['Key'][len(self.prefix):]
+                if key.endswith(BLOB_SUFFIX):
+                    yield key[:-len(BLOB_SUFFIX)]
+
+    def location(self, blob_id: str) -> str:
+        return f"s3://{self.bucket}/{self._key(blob_id)}"
+
+class _S3RangeReader(io.RawIOBase):
+    """
+    Seekable read-only view of an S3 object
+    Reads stream one GET body from the current position to the end of the
+    object, so a sequential read is a single request; only a read after a
+    seek elsewhere asks for a new body. The object's size comes from the
+    first response (its Content-Range), and the first bytes read are kept,
+    so going back to re-read the header costs no request.
+    """
+
+    def __init__(self, client, bucket: str, key: str, size: int = None):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._size = size
+        self._position = 0
+        self._body = None
+        self._body_position = 0
+        self._prefix = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_END:
+            base = self._object_size()
+        else:
+            base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def _open_body(self):
+        """Start a GET of the object from the current position to its end"""
+        self._close_body()
+        try:
+            response = self._client.get_object(Bucket=self._bucket, Key=self._key,
+                                               Range=f"bytes={self._position}-")
+        except Exception as e:
+            if _error_code(e) != 'InvalidRange':
+                raise
+            # At or past the end: nothing to stream, but the size is still needed
+            if self._size is None:
+                self._size = self._client.head_object(Bucket=self._bucket, Key=self._key)['ContentLength']
+            return
+        self._size = int(response['ContentRange'].rsplit('/', 1)[1])
+        self._body = response['Body']
+        self._body_position = self._position
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def _object_size(self) -> int:
+        if self._size is None:
+            self._open_body()
+        return self._size
+
+    def read(self, size: int = -1) -> bytes:
+        if self._position < len(self._prefix):
+            end = len(self._prefix) if size is None or size < 0 else self._position + size
+            data = self._prefix[self._position:end]
+            self._position += len(data)
+            return data
+
+        if self._position >= self._object_size():
+            return b''
+        if self._body is None or self._body_position != self._position:
+            self._open_body()
+        remaining = self._size - self._position
+        data = self._body.read(remaining if size is None or size < 0 else min(size, remaining))
+        if self._position == len(self._prefix) and self._position < S3_PREFIX_SIZE:
+            self._prefix += data[:S3_PREFIX_SIZE - self._position]
+        self._position += len(data)
+        self._body_position = self._position
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+def _error_code(error) -> str:
+    """The S3 error code of a botocore ClientError, if error is one"""
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+def create_blob_store(config) -> BlobStore:
+    """Blob store selected by STORAGE_BACKEND"""
+    backend = config['STORAGE_BACKEND']
+    if backend == 'local':
+        return LocalBlobStore(
+            config['STORAGE_FOLDER'], config['STORAGE_LAYOUT'], config['STORAGE_FSYNC'],
+            mmap_entries=config['STORAGE_MMAP_ENTRIES'],
+            mmap_bytes=config['STORAGE_MMAP_MAX_BYTES'],
+            mmap_ttl=config['STORAGE_MMAP_TTL_SECONDS']
+        )
+    if backend == 's3':
+        return S3BlobStore(config['S3_BUCKET'], config['S3_PREFIX'], config['S3_ENDPOINT_URL'],
+                           collect_delay=config['S3_COLLECT_DELAY_SECONDS'])
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import tempfile
+import zipfile
+import unicodedata
+from urllib.parse import quote
+from werkzeug.datastructures import Headers
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, Field, File, Data
+
+# Size of each read from the request stream
+READ_SIZE = 64 * 1024
+
+# Largest accepted value for a plain (non-file) form field
+MAX_FIELD_SIZE = 64 * 1024
+
+def _multipart_events(stream, boundary: bytes, read_size: int):
+    """Drive the sans-IO multipart decoder from a blocking stream"""
+    decoder = MultipartDecoder(boundary)
+    eof = False
+
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            if eof:
+                raise ValueError("Malformed multipart body")
+            data = stream.read(read_size)
+            eof = not data
+            decoder.receive_data(data or None)
+        elif isinstance(event, Epilogue):
+            return
+        else:
+            yield event
+
+def _part_data(events):
+    for event in events:
+        if isinstance(event, Data):
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+
+def iter_multipart(stream, boundary: bytes, read_size: int = READ_SIZE):
+    """
+    Iterate over the parts of a multipart/form-data body without buffering it
+    Yields (name, filename, chunks) where filename is None for plain fields and
+    chunks is an iterator over the part's bytes. A part that the caller does not
+    consume is skipped before the next one is produced.
+    """
+    events = _multipart_events(stream, boundary, read_size)
+
+    for event in events:
+        if isinstance(event, (Field, File)):
+            filename = event.filename if isinstance(event, File) else None
+            chunks = _part_data(events)
+            yield event.name, filename, chunks
+            for _ in chunks:
+                pass
+
+def read_field(chunks, max_size: int = MAX_FIELD_SIZE) -> str:
+    """Collect a plain form field, refusing oversized values"""
+    parts = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > max_size:
+            raise ValueError("Form field too large")
+        parts.append(chunk)
+    return b''.join(parts).decode('utf-8')
+
+def spool_chunks(chunks, max_memory: int = 500 * 1024):
+    """
+    Spool chunks to a temporary file for when the file part arrives before the
+    fields needed to process it. Same threshold as werkzeug's form parser.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+def write_temp(chunks, directory: str, timer=None) -> tuple:
+    """
+    Write chunks to a new temporary file in directory
+    Returns (temp_path, bytes written); the file is removed if writing fails.
+    Time spent writing is added to timer (a metrics.StageTimer) if given.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.tmp')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                started = time.perf_counter()
+                f.write(chunk)
+                if timer is not None:
+                    timer.add('disk_write', started)
+                written += len(chunk)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return temp_path, written
+
+def write_atomic(chunks, target_path: str) -> int:
+    """
+    Write chunks to a temporary file beside target_path, then rename it into
+    place so readers never see a partially written file. Returns bytes written.
+    """
+    temp_path, written = write_temp(chunks, os.path.dirname(target_path))
+    try:
+        os.replace(temp_path, target_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return written
+
+class BufferReader:
+    """
+    Seekable file-like reader over a bytes-like object (bytes, mmap...)
+    read() returns memoryview slices of the buffer instead of copies, so
+    several readers can share one buffer and pass what they read straight
+    to the cipher. Slices stay valid after close().
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._view is None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: len(self._view)}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def read(self, size: int = -1) -> memoryview:
+        if self._view is None:
+            raise ValueError("I/O operation on closed reader")
+        start = min(self._position, len(self._view))
+        end = len(self._view) if size is None or size < 0 else min(start + size, len(self._view))
+        self._position = end
+        return self._view[start:end]
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._view = None
+
+def ndjson_lines(events):
+    """Encode an iterator of dicts as newline-delimited JSON, one line per event"""
+    for event in events:
+        yield (json.dumps(event) + '\n').encode('utf-8')
+
+class _ZipSink:
+    """
+    Write-only file object collecting what zipfile writes
+    It can tell() but not seek(), so zipfile writes each entry's sizes in a
+    data descriptor after its data instead of going back to patch them.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.pending = 0
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        self.pending += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts = []
+        self.pending = 0
+        return data
+
+def stream_zip(entries, flush_size: int = READ_SIZE):
+    """
+    Build a zip archive on the fly, without temporary files
+    entries yields (name, date_time, size, chunks); size only has to be
+    roughly right, to decide whether the entry needs zip64. Yields the
+    archive's bytes as they are produced. Entries are stored uncompressed,
+    as papers are mostly PDFs and DOCX files, which are compressed already.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for name, date_time, size, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time)
+            info.file_size = size or 0
+            with archive.open(info, 'w', force_zip64=size is None) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    if sink.pending >= flush_size:
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+def attachment_headers(download_name: str, content_length: int = None) -> Headers:
+    """Build download headers the same way flask.send_file does"""
+    headers = Headers()
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name)
+        simple = simple.encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        headers.set('Content-Disposition', 'attachment', filename=simple,
+                    **{'filename*': f"UTF-8''{quoted}"})
+    else:
+        headers.set('Content-Disposition', 'attachment', filename=download_name)
+    
+    if content_length is not None:
+        headers['Content-Length'] = str(content_length)
+    return headers
+
@@ -0,0 +1,67 @@
+import io
+import os
+import sys
+import pytest
+
+# The backend is a flat set of modules, imported the way app.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import TestingConfig, config_to_dict
+from encryption import configure_kdf, kdf_params, parse_kdf_params
+
+# Cheap enough for tests that derive many keys
+FAST_KDF = 'pbkdf2-sha256:i=1000'
+
+@pytest.fixture(autouse=True)
+def fast_kdf():
+    previous = kdf_params()
+    configure_kdf(parse_kdf_params(FAST_KDF))
+    yield
+    configure_kdf(previous)
+
+@pytest.fixture
+def settings(tmp_path):
+    """TestingConfig as a mapping, with every path under tmp_path"""
+    return dict(
+        config_to_dict(TestingConfig),
+        STORAGE_FOLDER=str(tmp_path / 'storage'),
+        DECRYPTED_FOLDER=str(tmp_path / 'decrypted'),
+        LOG_FOLDER=str(tmp_path / 'logs'),
+        METADATA_DB_PATH=str(tmp_path / 'metadata.db'),
+        RATE_LIMIT_DB_PATH=str(tmp_path / 'ratelimit.db'),
+        RATE_LIMIT_BACKEND='off',
+        KDF_PARAMS=FAST_KDF
+    )
+
+@pytest.fixture
+def app(settings):
+    from app import create_app
+    return create_app(settings)
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def service(app):
+    return app.extensions['exam_service']
+
+@pytest.fixture
+def upload(client):
+    """Upload content with password through the API, returning the new file_id"""
+    def upload(content: bytes, password: str, filename: str = 'paper.pdf') -> str:
+        response = client.post('/api/upload', data={
+            'password': password, 'subject': 'Maths', 'exam_date': '2020-01-01',
+            'file': (io.BytesIO(content), filename)
+        }, content_type='multipart/form-data')
+        assert response.status_code == 201, response.json
+        return response.json['file_id']
+    return upload
+
+@pytest.fixture
+def download(client):
+    """(status, body) of downloading file_id with password"""
+    def download(file_id: str, password: str) -> tuple:
+        response = client.post(f'/api/download/{file_id}', json={'password': password})
+        return response.status_code, response.get_data()
+    return download
@@ -0,0 +1,96 @@
+import io
+import json
+import os
+import threading
+import pytest
+from app import create_app
+
+PATH_SETTINGS = ('STORAGE_FOLDER', 'DECRYPTED_FOLDER', 'LOG_FOLDER', 'METADATA_DB_PATH', 'RATE_LIMIT_DB_PATH')
+
+@pytest.fixture
+def app_in(settings, tmp_path):
+    """create_app with its own directory under tmp_path"""
+    def app_in(name: str, **overrides):
+        paths = {key: str(tmp_path / name / os.path.basename(settings[key])) for key in PATH_SETTINGS}
+        return create_app(dict(settings, **paths, **overrides))
+    return app_in
+
+def upload_to(app, content: bytes) -> str:
+    response = app.test_client().post('/api/upload', data={
+        'password': 'pw', 'subject': 'Maths', 'exam_date': '2020-01-01',
+        'file': (io.BytesIO(content), 'paper.pdf')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 201, response.json
+    return response.json['file_id']
+
+def thread_names() -> set:
+    return {thread.name for thread in threading.enumerate()}
+
+def test_apps_keep_their_own_stores(app_in):
+    first, second = app_in('first'), app_in('second')
+    file_id = upload_to(first, os.urandom(3000))
+
+    assert first.test_client().get('/api/files').json['total_files'] == 1
+    assert second.test_client().get('/api/files').json['total_files'] == 0
+    assert second.test_client().post(f'/api/download/{file_id}', json={'password': 'pw'}).status_code == 404
+    first_service, second_service = first.extensions['exam_service'], second.extensions['exam_service']
+    assert first_service.metadata_store is not second_service.metadata_store
+    assert first_service.blob_store.root != second_service.blob_store.root
+
+def test_apps_keep_their_own_rate_limits(app_in):
+    first = app_in('first', RATE_LIMIT_BACKEND='memory', RATE_LIMIT_GENERAL=2)
+    second = app_in('second', RATE_LIMIT_BACKEND='memory', RATE_LIMIT_GENERAL=2)
+
+    assert [first.test_client().get('/api/files').status_code for _ in range(3)] == [200, 200, 429]
+    assert second.test_client().get('/api/files').status_code == 200
+    assert first.extensions['exam_service'].rate_limiter is not second.extensions['exam_service'].rate_limiter
+
+def test_background_threads_start_per_app_on_first_request(app_in):
+    first = app_in('first', AUTO_CLEANUP_ENABLED=True)
+    second = app_in('second')
+    first_service, second_service = first.extensions['exam_service'], second.extensions['exam_service']
+
+    # Building an app starts nothing
+    assert first_service.cleanup._thread_pid is None
+    first.test_client().get('/api/health')
+    assert first_service.cleanup._thread_pid == os.getpid()
+    assert 'cleanup' in thread_names()
+
+    second.test_client().get('/api/health')
+    assert second_service.cleanup._thread_pid is None
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_threads_restart_in_forked_workers(app_in):
+    app = app_in('preloaded', AUTO_CLEANUP_ENABLED=True)
+    service = app.extensions['exam_service']
+    app.test_client().get('/api/health')
+    parent = os.getpid()
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Only the forking thread survives a fork: a cleanup thread here was started in the child
+        try:
+            os.close(read_end)
+            report = {
+                'cleanup_pid': service.cleanup._thread_pid,
+                'cleanup_running': 'cleanup' in thread_names(),
+                'first_request': app.test_client().get('/api/health').status_code,
+                'background_pid': service._background_pid,
+            }
+            os.write(write_end, json.dumps(report).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_end)
+    with os.fdopen(read_end) as f:
+        report = json.loads(f.read())
+    os.waitpid(pid, 0)
+
+    assert report['cleanup_pid'] == pid
+    assert report['cleanup_running']
+    assert report['first_request'] == 200
+    assert report['background_pid'] == pid
+    # The parent's own threads are untouched
+    assert service.cleanup._thread_pid == parent
+    assert service._background_pid == parent
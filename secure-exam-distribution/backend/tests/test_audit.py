@@ -0,0 +1,134 @@
+import glob
+import json
+import os
+import time
+import pytest
+from audit import AuditLogger, audit_logger, audited, configure_audit_logger, request_context
+from services import ServiceError
+
+# Rotation and the writer's lock rely on flock
+fcntl = pytest.importorskip('fcntl')
+
+def read_records(path: str) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+class HeldLock:
+    """Hold the audit log's file lock, so the writer stops at its next write"""
+
+    def __init__(self, logger: AuditLogger):
+        os.makedirs(os.path.dirname(logger.path), exist_ok=True)
+        self.file = open(logger.path + '.lock', 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+@pytest.fixture
+def logger_at(tmp_path):
+    previous = audit_logger()
+    def logger_at(**options) -> AuditLogger:
+        logger = AuditLogger(str(tmp_path / 'logs' / 'audit.jsonl'), **options)
+        configure_audit_logger(logger)
+        return logger
+    yield logger_at
+    configure_audit_logger(previous)
+
+def test_records_carry_the_request_context(logger_at):
+    logger = logger_at()
+    token = request_context.set({'client': '10.0.0.1', 'path': '/api/verify/x'})
+    try:
+        with audited('verify', file_id='x') as record:
+            record['extra'] = 1
+        with pytest.raises(ServiceError):
+            with audited('verify', file_id='y'):
+                raise ServiceError('File not found', 404)
+    finally:
+        request_context.reset(token)
+    assert logger.flush()
+
+    ok, failed = read_records(logger.path)
+    assert ok['event'] == 'verify' and ok['success'] and ok['extra'] == 1
+    assert ok['client'] == '10.0.0.1' and ok['path'] == '/api/verify/x'
+    assert failed['file_id'] == 'y' and not failed['success']
+    assert failed['status'] == 404 and failed['error'] == 'File not found'
+    assert logger.stats() == {'queued': 0, 'written': 2, 'dropped': 0, 'write_errors': 0}
+
+def test_log_rotates_and_keeps_backup_count_files(logger_at):
+    logger = logger_at(max_bytes=500, backup_count=2)
+    for n in range(40):
+        logger.log({'event': 'upload', 'n': n, 'padding': 'x' * 50})
+        assert logger.flush()
+
+    assert sorted(glob.glob(logger.path + '*')) == [
+        logger.path, logger.path + '.1', logger.path + '.2', logger.path + '.lock'
+    ]
+    numbers = []
+    for path in (logger.path + '.2', logger.path + '.1', logger.path):
+        assert os.path.getsize(path) <= 500
+        numbers += [record['n'] for record in read_records(path)]
+    # The newest records survive, in order, and nothing is split across files
+    assert numbers == list(range(40 - len(numbers), 40))
+
+def test_full_queue_drops_and_records_the_loss(logger_at):
+    logger = logger_at(queue_size=2)
+    lock = HeldLock(logger)
+    try:
+        logger.log({'event': 'first'})
+        # The writer has taken the first record and waits for the lock
+        wait_until(lambda: logger.stats()['queued'] == 0)
+        for n in range(5):
+            logger.log({'event': 'queued', 'n': n})
+        assert logger.stats()['queued'] == 2
+        assert logger.stats()['dropped'] == 3
+    finally:
+        lock.release()
+    assert logger.flush()
+
+    records = read_records(logger.path)
+    assert [r['event'] for r in records] == ['first', 'queued', 'queued', 'audit_overflow']
+    assert [r['n'] for r in records[1:3]] == [0, 1]
+    assert records[-1]['dropped'] == 3
+    assert logger.stats()['written'] == 4
+
+def test_block_policy_waits_before_dropping(logger_at):
+    logger = logger_at(queue_size=1, overflow='block', block_timeout=0.2)
+    lock = HeldLock(logger)
+    try:
+        logger.log({'event': 'first'})
+        wait_until(lambda: logger.stats()['queued'] == 0)
+        logger.log({'event': 'queued'})
+
+        started = time.monotonic()
+        logger.log({'event': 'lost'})
+        assert time.monotonic() - started >= 0.2
+        assert logger.stats()['dropped'] == 1
+    finally:
+        lock.release()
+    assert logger.flush()
+    assert [r['event'] for r in read_records(logger.path)] == ['first', 'queued', 'audit_overflow']
+
+def test_unknown_overflow_policy_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        AuditLogger(str(tmp_path / 'audit.jsonl'), overflow='wait')
+
+def test_api_requests_are_audited(app, client, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    client.post(f'/api/verify/{file_id}', json={'password': 'wrong'}, headers={'X-Forwarded-For': '10.0.0.9'})
+    assert audit_logger().flush()
+
+    records = read_records(os.path.join(app.config['LOG_FOLDER'], 'audit.jsonl'))
+    upload_record, verify_record = records[-2:]
+    assert upload_record['event'] == 'upload' and upload_record['file_id'] == file_id
+    assert upload_record['success']
+    assert verify_record['event'] == 'verify' and verify_record['status'] == 401
+    assert verify_record['method'] == 'POST' and verify_record['path'] == f'/api/verify/{file_id}'
+    # Not trusted as a proxy, so the forwarded address is ignored
+    assert verify_record['client'] == '127.0.0.1'
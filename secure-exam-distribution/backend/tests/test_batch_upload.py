@@ -0,0 +1,92 @@
+import io
+import json
+import os
+import zipfile
+
+def batch(client, fields: dict, files: list):
+    """Post fields, then files ((name, content) pairs), to /api/upload/batch; the response and its events"""
+    data = dict(fields, file=[(io.BytesIO(content), name) for name, content in files])
+    response = client.post('/api/upload/batch', data=data, content_type='multipart/form-data')
+    events = []
+    if response.mimetype == 'application/x-ndjson':
+        events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return response, events
+
+def by_filename(events: list, event: str) -> dict:
+    return {e['filename']: e for e in events if e['event'] == event}
+
+def test_progress_reports_each_paper_and_a_summary(client, download):
+    contents = {'a.pdf': os.urandom(3000), 'b.pdf': os.urandom(5000)}
+    response, events = batch(client, {'password': 'pw', 'subject': 'Maths', 'exam_date': '2020-01-01'},
+                             list(contents.items()))
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert [e['index'] for e in events if e['event'] == 'received'] == [0, 1]
+    stored = by_filename(events, 'stored')
+    assert set(stored) == set(contents)
+    for name, content in contents.items():
+        assert stored[name]['subject'] == 'Maths'
+        assert download(stored[name]['file_id'], 'pw') == (200, content)
+    assert events[-1] == {'event': 'summary', 'received': 2, 'stored': 2, 'failed': 0}
+
+def test_failed_papers_do_not_stop_the_rest(client, download):
+    content = os.urandom(3000)
+    response, events = batch(client, {'password': 'pw'}, [
+        ('notes.exe', b'not a paper'), ('paper.pdf', content), ('broken.zip', b'not a zip')
+    ])
+
+    assert response.status_code == 200
+    failed = by_filename(events, 'failed')
+    assert failed['notes.exe']['status'] == 400
+    assert 'Invalid file type' in failed['notes.exe']['error']
+    assert failed['broken.zip']['status'] == 400
+    stored = by_filename(events, 'stored')
+    assert download(stored['paper.pdf']['file_id'], 'pw') == (200, content)
+    assert events[-1] == {'event': 'summary', 'received': 3, 'stored': 1, 'failed': 2}
+
+def test_metadata_overrides_settings_per_file(client, download):
+    contents = {'a.pdf': os.urandom(3000), 'b.pdf': os.urandom(3000)}
+    metadata = {'b.pdf': {'subject': 'Physics', 'password': 'other', 'file_id': 'ignored'}}
+    _, events = batch(client, {'password': 'pw', 'subject': 'Maths', 'metadata': json.dumps(metadata)},
+                      list(contents.items()))
+
+    stored = by_filename(events, 'stored')
+    assert stored['a.pdf']['subject'] == 'Maths'
+    assert stored['b.pdf']['subject'] == 'Physics'
+    assert stored['b.pdf']['file_id'] != 'ignored'
+    assert download(stored['a.pdf']['file_id'], 'pw') == (200, contents['a.pdf'])
+    assert download(stored['b.pdf']['file_id'], 'other') == (200, contents['b.pdf'])
+    assert download(stored['b.pdf']['file_id'], 'pw')[0] == 401
+
+def test_zip_parts_are_expanded(client, download):
+    contents = {'a.pdf': os.urandom(3000), 'session/b.docx': os.urandom(3000)}
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for name, content in contents.items():
+            zf.writestr(name, content)
+    metadata = {'b.docx': {'subject': 'Physics'}}
+    _, events = batch(client, {'password': 'pw', 'metadata': json.dumps(metadata)},
+                      [('papers.zip', archive.getvalue())])
+
+    stored = by_filename(events, 'stored')
+    assert set(stored) == set(contents)
+    # Overrides match a member by its path or its base name
+    assert stored['session/b.docx']['subject'] == 'Physics'
+    for name, content in contents.items():
+        assert download(stored[name]['file_id'], 'pw') == (200, content)
+
+def test_papers_without_a_password_fail(client):
+    _, events = batch(client, {}, [('paper.pdf', os.urandom(3000))])
+    (failed,) = by_filename(events, 'failed').values()
+    assert failed['status'] == 400
+    assert failed['error'] == 'Password is required'
+
+def test_fields_before_the_first_file_are_checked_up_front(client):
+    response, _ = batch(client, {'password': 'pw', 'metadata': '[]'}, [('paper.pdf', os.urandom(3000))])
+    assert response.status_code == 400
+    assert 'metadata' in response.json['error']
+
+    response = client.post('/api/upload/batch', data={'password': 'pw'}, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.json['error'] == 'No file provided'
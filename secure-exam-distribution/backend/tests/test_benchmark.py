@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark.py')
+
+def results_file(tmp_path, name: str, results: dict, **meta) -> str:
+    """A results file as benchmark.py run writes it, holding results {name: (ops_per_sec, p99_ms)}"""
+    path = tmp_path / name
+    path.write_text(json.dumps({
+        'meta': dict({'quick': True, 'cpu_count': 4}, **meta),
+        'results': {
+            benchmark: {'iterations': 100, 'ops_per_sec': ops, 'mean_ms': 1.0, 'p50_ms': 1.0, 'p99_ms': p99,
+                        'max_ms': p99}
+            for benchmark, (ops, p99) in results.items()
+        }
+    }))
+    return str(path)
+
+def compare(*args) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, BENCHMARK, 'compare', *args], capture_output=True, text=True)
+
+def test_throughput_regression_fails(tmp_path):
+    baseline = results_file(tmp_path, 'baseline.json', {'derive_key': (100.0, 10.0), 'encrypt 1MB': (50.0, 20.0)})
+    current = results_file(tmp_path, 'current.json', {'derive_key': (99.0, 10.0), 'encrypt 1MB': (40.0, 20.0)})
+
+    result = compare(baseline, current)
+    assert result.returncode == 1
+    assert '1 regressed: encrypt 1MB' in result.stdout
+    (line,) = [line for line in result.stdout.splitlines() if line.startswith('encrypt 1MB')]
+    assert 'REGRESSED' in line and '-20.0%' in line
+
+def test_p99_regression_has_its_own_threshold(tmp_path):
+    baseline = results_file(tmp_path, 'baseline.json', {'download': (100.0, 10.0)})
+    current = results_file(tmp_path, 'current.json', {'download': (100.0, 11.5)})
+
+    assert compare(baseline, current).returncode == 1
+    assert compare(baseline, current, '--p99-threshold', '0.2').returncode == 0
+
+def test_unchanged_runs_pass(tmp_path):
+    baseline = results_file(tmp_path, 'baseline.json', {'derive_key': (100.0, 10.0), 'gone': (1.0, 1.0)})
+    current = results_file(tmp_path, 'current.json', {'derive_key': (95.0, 10.5), 'added': (1.0, 1.0)},
+                           cpu_count=8)
+
+    result = compare(baseline, current)
+    assert result.returncode == 0, result.stdout
+    assert 'REGRESSED' not in result.stdout
+    assert 'gone' in result.stdout and 'missing from the new run' in result.stdout
+    assert 'added' in result.stdout and 'new, no baseline' in result.stdout
+    assert 'Warning: runs differ in cpu_count (4 vs 8)' in result.stdout
@@ -0,0 +1,64 @@
+import io
+import os
+import zipfile
+
+def bundle(client, selection: dict):
+    return client.post('/api/bundle', json=selection)
+
+def zip_contents(response) -> dict:
+    with zipfile.ZipFile(io.BytesIO(response.get_data())) as archive:
+        assert archive.testzip() is None
+        return {name: archive.read(name) for name in archive.namelist()}
+
+def test_bundle_of_file_ids(client, upload):
+    first, second = os.urandom(3000), os.urandom(70000)
+    file_ids = [upload(first, 'pw', 'paper.pdf'), upload(second, 'pw', 'paper.pdf')]
+    response = bundle(client, {'file_ids': file_ids, 'password': 'pw'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    assert 'exam_bundle.zip' in response.headers['Content-Disposition']
+    # Names are kept unique, in the order asked for
+    assert zip_contents(response) == {'paper.pdf': first, 'paper (1).pdf': second}
+
+def test_bundle_of_a_session(client, upload):
+    contents = {'a.pdf': os.urandom(3000), 'b.pdf': os.urandom(3000)}
+    for name, content in contents.items():
+        upload(content, 'pw', name)
+    response = bundle(client, {'subject': 'Maths', 'exam_date': '2020-01-01', 'password': 'pw'})
+
+    assert response.status_code == 200
+    assert 'Maths_2020-01-01.zip' in response.headers['Content-Disposition']
+    assert zip_contents(response) == contents
+
+def test_bundle_with_a_password_per_paper(client, upload):
+    first, second = os.urandom(3000), os.urandom(3000)
+    file_ids = [upload(first, 'one', 'a.pdf'), upload(second, 'two', 'b.pdf')]
+    response = bundle(client, {'file_ids': file_ids, 'passwords': {file_ids[0]: 'one', file_ids[1]: 'two'}})
+
+    assert response.status_code == 200
+    assert zip_contents(response) == {'a.pdf': first, 'b.pdf': second}
+
+def test_one_wrong_password_refuses_the_whole_bundle(client, upload):
+    file_ids = [upload(os.urandom(3000), 'pw', 'a.pdf'), upload(os.urandom(3000), 'other', 'b.pdf')]
+    response = bundle(client, {'file_ids': file_ids, 'password': 'pw'})
+
+    assert response.status_code == 401
+    assert response.mimetype == 'application/json'
+    assert response.json['file_ids'] == [file_ids[1]]
+
+def test_missing_papers_are_named(client, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    response = bundle(client, {'file_ids': [file_id, 'no_such_paper'], 'password': 'pw'})
+    assert response.status_code == 404
+    assert response.json['file_ids'] == ['no_such_paper']
+
+    response = bundle(client, {'subject': 'Physics', 'exam_date': '2020-01-01', 'password': 'pw'})
+    assert response.status_code == 404
+
+def test_bad_selections_are_refused(client, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    assert bundle(client, {'password': 'pw'}).status_code == 400
+    assert bundle(client, {'file_ids': 'not a list', 'password': 'pw'}).status_code == 400
+    assert bundle(client, {'file_ids': [file_id]}).status_code == 400
+    assert bundle(client, {'file_ids': [file_id], 'passwords': ['pw']}).status_code == 400
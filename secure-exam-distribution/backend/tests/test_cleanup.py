@@ -0,0 +1,119 @@
+import io
+import os
+import threading
+import time
+from datetime import date
+import pytest
+from cleanup import CleanupScheduler
+
+# Workers share the cleanup lock through flock
+fcntl = pytest.importorskip('fcntl')
+
+@pytest.fixture
+def scheduler(service):
+    def scheduler(**options) -> CleanupScheduler:
+        options = dict({'retention_days': 30, 'batch_size': 500, 'pause': 0}, **options)
+        return CleanupScheduler(service, service.cleanup.lock_path, **options)
+    return scheduler
+
+@pytest.fixture
+def upload_on(client):
+    """Upload a paper for the exam on exam_date, returning its file_id"""
+    def upload_on(exam_date: str) -> str:
+        response = client.post('/api/upload', data={
+            'password': 'pw', 'subject': 'Maths', 'exam_date': exam_date,
+            'file': (io.BytesIO(os.urandom(3000)), 'paper.pdf')
+        }, content_type='multipart/form-data')
+        assert response.status_code == 201, response.json
+        return response.json['file_id']
+    return upload_on
+
+def age(path: str, hours: float):
+    then = time.time() - hours * 3600
+    os.utime(path, (then, then))
+
+def test_expiry_works_through_a_backlog_in_batches(service, scheduler, upload_on):
+    expired = [upload_on('2000-01-0%d' % day) for day in range(1, 6)]
+    kept = upload_on(date.today().isoformat())
+    cleanup = scheduler(batch_size=2)
+
+    removed = []
+    for _ in range(3):
+        # A capped run is partial, so the next one is due at once
+        removed.append(cleanup.run_once()['expired']['removed'])
+    assert removed == [2, 2, 1]
+    assert all(service.metadata_store.get(file_id) is None for file_id in expired)
+    assert service.metadata_store.get(kept) is not None
+    # The last run was complete: nothing is due for interval_hours
+    assert cleanup.run_once() is None
+
+def test_expiry_reclaims_blobs(service, scheduler, upload_on):
+    file_id = upload_on('2000-01-01')
+    blob_id = service.metadata_store.get(file_id)['blob_id']
+    size = service.blob_store.size(blob_id)
+
+    assert scheduler().run_once(force=True)['expired'] == {'removed': 1, 'bytes': size}
+    assert not service.blob_store.exists(blob_id)
+
+def test_expiry_is_off_without_retention(service, scheduler, upload_on):
+    file_id = upload_on('2000-01-01')
+    assert scheduler(retention_days=0).run_once(force=True)['expired'] == {'removed': 0, 'bytes': 0}
+    assert service.metadata_store.get(file_id) is not None
+
+def test_a_run_in_progress_elsewhere_is_skipped(service, scheduler, upload_on):
+    file_id = upload_on('2000-01-01')
+    # Another worker holds the lock
+    with open(service.cleanup.lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        assert scheduler().run_once(force=True) is None
+        assert service.metadata_store.get(file_id) is not None
+    assert scheduler().run_once(force=True)['expired']['removed'] == 1
+
+def test_two_workers_never_expire_at_once(service, scheduler, upload_on):
+    file_ids = [upload_on('2000-01-01') for _ in range(4)]
+    workers = [scheduler(pause=0.05), scheduler(pause=0.05)]
+    start = threading.Barrier(len(workers))
+    results = [None] * len(workers)
+
+    def run(index):
+        start.wait()
+        results[index] = workers[index].run_once(force=True)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(workers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ran = [result for result in results if result is not None]
+    assert len(ran) == 1
+    assert ran[0]['expired']['removed'] == len(file_ids)
+    assert all(service.metadata_store.get(file_id) is None for file_id in file_ids)
+
+def test_old_orphans_and_staged_files_are_removed(service, scheduler, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    referenced = service.metadata_store.get(file_id)['blob_id']
+
+    for blob_id in ('old_orphan', 'new_orphan'):
+        staged = os.path.join(service.storage_folder, 'staged')
+        with open(staged, 'wb') as f:
+            f.write(os.urandom(100))
+        service.blob_store.put(staged, blob_id)
+    age(service.blob_store.location('old_orphan'), 25)
+    age(service.blob_store.location(referenced), 25)
+
+    staged_uploads = {}
+    for name, hours in (('.upload-old.tmp', 25), ('.upload-new.tmp', 1)):
+        staged_uploads[name] = os.path.join(service.storage_folder, name)
+        with open(staged_uploads[name], 'wb') as f:
+            f.write(b'partial')
+        age(staged_uploads[name], hours)
+
+    reclaimed = scheduler(retention_days=0).run_once(force=True)
+    assert reclaimed['orphans'] == {'removed': 1, 'bytes': 100}
+    assert reclaimed['staged']['removed'] == 1
+    assert not service.blob_store.exists('old_orphan')
+    assert service.blob_store.exists('new_orphan')
+    assert service.blob_store.exists(referenced)
+    assert not os.path.exists(staged_uploads['.upload-old.tmp'])
+    assert os.path.exists(staged_uploads['.upload-new.tmp'])
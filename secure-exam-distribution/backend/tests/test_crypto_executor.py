@@ -0,0 +1,60 @@
+import os
+import threading
+import time
+import pytest
+from crypto_executor import CryptoExecutor, CryptoBusyError
+
+@pytest.fixture
+def blocked():
+    """Event holding the jobs block_on() submits until it is set"""
+    release = threading.Event()
+    yield release
+    release.set()
+
+def block_on(executor, release: threading.Event):
+    """Take every slot of executor with jobs waiting for release"""
+    return [executor.submit('block', release.wait) for _ in range(executor.max_workers + executor.max_pending)]
+
+def drain(executor, jobs):
+    for job in jobs:
+        job.result(timeout=5)
+    # Slots are given back by a done callback, just after the result is set
+    while executor.stats()['in_flight']:
+        time.sleep(0.01)
+
+def test_full_executor_refuses_jobs(blocked):
+    executor = CryptoExecutor(max_workers=1, max_pending=1, retry_after=7)
+    jobs = block_on(executor, blocked)
+    with pytest.raises(CryptoBusyError) as error:
+        executor.submit('kdf', sum, [1, 2])
+    assert error.value.retry_after == 7
+    assert executor.stats()['rejected'] == 1
+
+    blocked.set()
+    drain(executor, jobs)
+    assert executor.run('kdf', sum, [1, 2]) == 3
+
+def test_slow_job_times_out_as_busy(blocked):
+    executor = CryptoExecutor(max_workers=1, max_pending=0, timeout=0.05)
+    with pytest.raises(CryptoBusyError, match='timed out'):
+        executor.run('block', blocked.wait)
+
+@pytest.fixture
+def app(settings):
+    from app import create_app
+    # Every request derives its key, so none is answered from the key cache
+    return create_app(dict(settings, KDF_CACHE_ENABLED=False, CRYPTO_WORKERS=1, CRYPTO_MAX_PENDING=0,
+                           CRYPTO_RETRY_AFTER=5))
+
+def test_saturated_executor_answers_503(service, client, upload, blocked):
+    file_id = upload(os.urandom(3000), 'pw')
+    jobs = block_on(service.crypto_executor, blocked)
+
+    for response in (client.post(f'/api/download/{file_id}', json={'password': 'pw'}),
+                     client.post(f'/api/verify/{file_id}', json={'password': 'pw'})):
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '5'
+
+    blocked.set()
+    drain(service.crypto_executor, jobs)
+    assert client.post(f'/api/verify/{file_id}', json={'password': 'pw'}).status_code == 200
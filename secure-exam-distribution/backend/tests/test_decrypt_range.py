@@ -0,0 +1,68 @@
+import io
+import os
+import pytest
+from encryption import encrypt_stream, decrypt_range, generate_data_key
+
+CHUNK = 1024
+
+@pytest.fixture
+def paper():
+    """(plaintext, encrypted) of a paper ending in a partial chunk"""
+    plaintext = os.urandom(4 * CHUNK + 300)
+    return plaintext, b''.join(encrypt_stream(io.BytesIO(plaintext), 'pw', CHUNK))
+
+def read_range(encrypted: bytes, start: int, stop: int, password='pw') -> bytes:
+    return b''.join(decrypt_range(io.BytesIO(encrypted), password, start, stop, len(encrypted)))
+
+@pytest.mark.parametrize('start, stop', [
+    (0, 1),                        # first byte
+    (0, CHUNK),                    # exactly the first chunk
+    (CHUNK - 1, CHUNK + 1),        # across a chunk boundary
+    (CHUNK, 2 * CHUNK),            # exactly a middle chunk
+    (CHUNK - 1, 3 * CHUNK + 1),    # spanning several chunks
+    (4 * CHUNK, 4 * CHUNK + 300),  # the whole final, partial chunk
+    (4 * CHUNK + 299, 4 * CHUNK + 300),  # last byte
+    (0, 4 * CHUNK + 300),          # everything
+])
+def test_range_matches_plaintext(paper, start, stop):
+    plaintext, encrypted = paper
+    assert read_range(encrypted, start, stop) == plaintext[start:stop]
+
+def test_range_ending_on_the_last_full_chunk():
+    # The final segment is a full one, so no shorter segment follows it
+    plaintext = os.urandom(3 * CHUNK)
+    encrypted = b''.join(encrypt_stream(io.BytesIO(plaintext), 'pw', CHUNK))
+    assert read_range(encrypted, 2 * CHUNK, 3 * CHUNK) == plaintext[2 * CHUNK:]
+    assert read_range(encrypted, 3 * CHUNK - 1, 3 * CHUNK) == plaintext[-1:]
+
+def test_range_with_a_data_key():
+    data_key = generate_data_key()
+    plaintext = os.urandom(2 * CHUNK + 5)
+    encrypted = b''.join(encrypt_stream(io.BytesIO(plaintext), data_key, CHUNK))
+    assert read_range(encrypted, CHUNK - 3, CHUNK + 3, data_key) == plaintext[CHUNK - 3:CHUNK + 3]
+
+@pytest.mark.parametrize('start, stop', [
+    (0, 0),                        # empty
+    (10, 5),                       # reversed
+    (-1, 10),                      # negative start
+    (0, 4 * CHUNK + 301),          # one past the end
+    (4 * CHUNK + 300, 4 * CHUNK + 301),  # starting at the end
+])
+def test_unsatisfiable_ranges_are_refused(paper, start, stop):
+    _, encrypted = paper
+    with pytest.raises(Exception, match='Range not satisfiable'):
+        decrypt_range(io.BytesIO(encrypted), 'pw', start, stop, len(encrypted))
+
+def test_wrong_password_is_refused_before_reading(paper):
+    _, encrypted = paper
+    with pytest.raises(Exception, match='invalid password'):
+        decrypt_range(io.BytesIO(encrypted), 'wrong', 0, 10, len(encrypted))
+
+def test_altered_segment_in_range_is_detected(paper):
+    _, encrypted = paper
+    altered = bytearray(encrypted)
+    altered[-20] ^= 1
+    # Segments outside the range are not read, so the start still decrypts
+    assert read_range(bytes(altered), 0, CHUNK) == paper[0][:CHUNK]
+    with pytest.raises(Exception, match='authentication failed'):
+        read_range(bytes(altered), 4 * CHUNK, 4 * CHUNK + 300)
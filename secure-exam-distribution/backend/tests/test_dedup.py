@@ -0,0 +1,97 @@
+import os
+import pytest
+from utils import content_address
+
+def blob_of(service, file_id: str) -> str:
+    return service.metadata_store.get(file_id)['blob_id']
+
+def test_same_content_and_password_share_a_blob(service, upload, download):
+    content = os.urandom(5000)
+    first = upload(content, 'pw')
+    second = upload(content, 'pw')
+
+    blob_id = blob_of(service, first)
+    assert blob_of(service, second) == blob_id
+    assert service.metadata_store.get_blob(blob_id)['ref_count'] == 2
+    assert download(second, 'pw') == (200, content)
+
+def test_other_password_gets_its_own_blob(service, upload, download):
+    content = os.urandom(5000)
+    first = upload(content, 'pw')
+    second = upload(content, 'other')
+
+    assert blob_of(service, first) != blob_of(service, second)
+    assert download(first, 'other')[0] == 401
+    assert download(second, 'other') == (200, content)
+
+def test_delete_drops_one_reference(service, client, upload, download):
+    content = os.urandom(5000)
+    first = upload(content, 'pw')
+    second = upload(content, 'pw')
+    blob_id = blob_of(service, first)
+
+    assert client.delete(f'/api/delete/{first}').status_code == 200
+    assert service.metadata_store.get(first) is None
+    assert service.metadata_store.get_blob(blob_id)['ref_count'] == 1
+    assert service.blob_store.exists(blob_id)
+    assert download(second, 'pw') == (200, content)
+
+def test_last_delete_collects_the_blob(service, client, upload):
+    content = os.urandom(5000)
+    file_ids = [upload(content, 'pw') for _ in range(3)]
+    blob_id = blob_of(service, file_ids[0])
+
+    for file_id in file_ids:
+        assert client.delete(f'/api/delete/{file_id}').status_code == 200
+    assert service.metadata_store.get_blob(blob_id) is None
+    assert not service.blob_store.exists(blob_id)
+    assert client.delete(f'/api/delete/{file_ids[0]}').status_code == 404
+
+def test_upload_after_collection_stores_a_new_blob(service, client, upload, download):
+    content = os.urandom(5000)
+    first = upload(content, 'pw')
+    client.delete(f'/api/delete/{first}')
+
+    second = upload(content, 'pw')
+    blob_id = blob_of(service, second)
+    assert service.metadata_store.get_blob(blob_id)['ref_count'] == 1
+    assert download(second, 'pw') == (200, content)
+
+def test_shared_blob_outlives_the_paper_it_was_stored_for(service, client, upload, download):
+    # The blob is named after the first paper, which goes first
+    content = os.urandom(5000)
+    first = upload(content, 'pw')
+    second = upload(content, 'pw')
+    assert blob_of(service, second) == first
+
+    client.delete(f'/api/delete/{first}')
+    assert download(second, 'pw') == (200, content)
+    client.delete(f'/api/delete/{second}')
+    assert not service.blob_store.exists(first)
+
+def test_matching_key_slots_tried_are_capped(service, upload, monkeypatch):
+    import services
+    content = os.urandom(5000)
+    first = upload(content, 'pw')
+    for i in range(10):
+        service.add_password(first, 'pw', f'extra {i}')
+
+    unwraps = []
+    real_unwrap = services.unwrap_data_key
+    monkeypatch.setattr(services, 'unwrap_data_key', lambda *args: unwraps.append(1) or real_unwrap(*args))
+    second = upload(content, 'not any of them')
+    assert blob_of(service, second) != blob_of(service, first)
+    assert len(unwraps) == service.config['DEDUP_MAX_ATTEMPTS']
+
+def test_addresses_are_keyed_with_dedup_key(app, service, upload):
+    file_id = upload(os.urandom(5000), 'pw')
+    content_hash = service.metadata_store.get(file_id)['content_hash']
+    address = service.metadata_store.get_blob(blob_of(service, file_id))['content_address']
+
+    assert address == content_address(content_hash, app.config['DEDUP_KEY'])
+    assert address != content_address(content_hash, app.config['SECRET_KEY'])
+
+def test_dedup_key_is_required_outside_testing(settings):
+    from app import create_app
+    with pytest.raises(ValueError, match='DEDUP_KEY'):
+        create_app(dict(settings, TESTING=False, DEDUP_KEY=None))
@@ -0,0 +1,77 @@
+import io
+import os
+import pytest
+from encryption import (encrypt_stream, decrypt_stream, verify_password, read_header, plaintext_size,
+                        generate_data_key, FORMAT_VERSION, ENVELOPE_VERSION)
+
+CHUNK = 1024
+
+def encrypt(plaintext: bytes, password, chunk_size: int = CHUNK) -> list:
+    """The header followed by each encrypted segment"""
+    return list(encrypt_stream(io.BytesIO(plaintext), password, chunk_size))
+
+def decrypt(parts, password) -> bytes:
+    return b''.join(decrypt_stream(io.BytesIO(b''.join(parts)), password))
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 3 * CHUNK, 3 * CHUNK + 17])
+@pytest.mark.parametrize('key', ['password', 'data key'])
+def test_round_trip(size, key):
+    password = generate_data_key() if key == 'data key' else 'correct horse'
+    plaintext = os.urandom(size)
+    parts = encrypt(plaintext, password)
+    encrypted = b''.join(parts)
+
+    header = read_header(encrypted)
+    assert header.version == (ENVELOPE_VERSION if key == 'data key' else FORMAT_VERSION)
+    assert plaintext_size(header, len(encrypted)) == size
+    assert decrypt(parts, password) == plaintext
+    assert verify_password(encrypted, password)
+
+def test_wrong_password_is_rejected_up_front():
+    parts = encrypt(os.urandom(3 * CHUNK), 'right')
+    assert not verify_password(b''.join(parts), 'wrong')
+    with pytest.raises(Exception, match='Decryption failed'):
+        decrypt_stream(io.BytesIO(b''.join(parts)), 'wrong')
+
+def test_wrong_data_key_is_rejected():
+    parts = encrypt(os.urandom(CHUNK), generate_data_key())
+    with pytest.raises(Exception, match='Decryption failed'):
+        decrypt(parts, generate_data_key())
+
+@pytest.mark.parametrize('dropped', [1, 2])
+def test_dropping_final_segments_is_detected(dropped):
+    # Whole segments off the end: what is left still parses, but its last
+    # segment was not encrypted as the final one
+    parts = encrypt(os.urandom(3 * CHUNK + 100), 'pw')
+    with pytest.raises(Exception, match='Decryption failed'):
+        decrypt(parts[:-dropped], 'pw')
+
+def test_truncation_within_a_segment_is_detected():
+    encrypted = b''.join(encrypt(os.urandom(3 * CHUNK), 'pw'))
+    with pytest.raises(Exception, match='Decryption failed'):
+        b''.join(decrypt_stream(io.BytesIO(encrypted[:-10]), 'pw'))
+
+def test_truncation_to_the_header_is_detected():
+    header = encrypt(os.urandom(CHUNK), 'pw')[0]
+    with pytest.raises(Exception, match='truncated'):
+        decrypt([header], 'pw')
+
+def test_reordered_segments_are_detected():
+    parts = encrypt(os.urandom(3 * CHUNK + 100), 'pw')
+    header, first, second, *rest = parts
+    with pytest.raises(Exception, match='Decryption failed'):
+        decrypt([header, second, first] + rest, 'pw')
+
+def test_segment_from_another_file_is_detected():
+    # Same password and layout, but each file has its own nonce prefix and header
+    parts = encrypt(os.urandom(2 * CHUNK + 1), 'pw')
+    other = encrypt(os.urandom(2 * CHUNK + 1), 'pw')
+    with pytest.raises(Exception, match='Decryption failed'):
+        decrypt([parts[0], other[1]] + parts[2:], 'pw')
+
+def test_altered_ciphertext_is_detected():
+    parts = encrypt(os.urandom(2 * CHUNK), 'pw')
+    altered = bytearray(parts[2])
+    altered[0] ^= 1
+    with pytest.raises(Exception, match='Decryption failed'):
+        decrypt(parts[:2] + [bytes(altered)] + parts[3:], 'pw')
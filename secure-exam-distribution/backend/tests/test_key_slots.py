@@ -0,0 +1,146 @@
+import io
+import os
+import pytest
+from encryption import (encrypt_stream, read_header, generate_data_key, wrap_data_key, unwrap_data_key,
+                        parse_kdf_params, KeySlot, ENVELOPE_VERSION, FORMAT_VERSION)
+from metadata_store import MetadataStore
+from services import ServiceError
+from storage import BLOB_SUFFIX, KEY_SLOTS_SUFFIX
+from utils import StreamMeter, content_address
+
+def test_wrap_unwrap_round_trip():
+    data_key = generate_data_key()
+    slot = wrap_data_key(data_key, 'pw', parse_kdf_params('pbkdf2-sha256:i=1000'))
+    assert unwrap_data_key(slot, 'pw') == data_key
+    assert bytes(data_key) not in slot.wrapped
+
+def test_unwrap_with_wrong_password_fails():
+    slot = wrap_data_key(generate_data_key(), 'pw')
+    with pytest.raises(ValueError):
+        unwrap_data_key(slot, 'wrong')
+
+def test_slot_settings_are_authenticated():
+    # A slot cannot be moved to another salt or weaker KDF settings
+    slot = wrap_data_key(generate_data_key(), 'pw')
+    with pytest.raises(ValueError):
+        unwrap_data_key(KeySlot(slot.kdf, os.urandom(len(slot.salt)), slot.wrapped), 'pw')
+    with pytest.raises(ValueError):
+        unwrap_data_key(KeySlot(parse_kdf_params('pbkdf2-sha256:i=999'), slot.salt, slot.wrapped), 'pw')
+
+def test_upload_is_data_key_encrypted_with_one_slot(service, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    with service.blob_store.open(service.metadata_store.get(file_id)['blob_id']) as f:
+        assert read_header(f).version == ENVELOPE_VERSION
+    assert len(service.list_passwords(file_id)['passwords']) == 1
+
+def test_add_password(service, upload, download):
+    content = os.urandom(3000)
+    file_id = upload(content, 'pw')
+    service.add_password(file_id, 'pw', 'second', label='invigilator')
+
+    assert download(file_id, 'pw') == (200, content)
+    assert download(file_id, 'second') == (200, content)
+    labels = [slot['label'] for slot in service.list_passwords(file_id)['passwords']]
+    assert labels == [None, 'invigilator']
+
+def test_add_password_needs_a_password_that_opens_the_paper(service, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    with pytest.raises(ServiceError) as error:
+        service.add_password(file_id, 'wrong', 'second')
+    assert error.value.status == 401
+
+def test_change_password(service, upload, download):
+    content = os.urandom(3000)
+    file_id = upload(content, 'pw')
+    blob_id = service.metadata_store.get(file_id)['blob_id']
+    service.change_password(file_id, 'pw', 'new')
+
+    assert download(file_id, 'pw')[0] == 401
+    assert download(file_id, 'new') == (200, content)
+    # Only the slot was rewritten
+    assert service.metadata_store.get(file_id)['blob_id'] == blob_id
+
+def test_revoke_password(service, upload, download):
+    content = os.urandom(3000)
+    file_id = upload(content, 'pw')
+    slot_id = service.add_password(file_id, 'pw', 'second')['slot_id']
+    service.revoke_password(file_id, slot_id, 'pw')
+
+    assert download(file_id, 'second')[0] == 401
+    assert download(file_id, 'pw') == (200, content)
+
+def test_last_password_cannot_be_revoked(service, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    (slot,) = service.list_passwords(file_id)['passwords']
+    with pytest.raises(ServiceError) as error:
+        service.revoke_password(file_id, slot['slot_id'], 'pw')
+    assert error.value.status == 409
+
+def add_password_paper(service, content: bytes, content_hash: str = None, address: str = None):
+    """Store a paper as it was before data keys, its blob encrypted with 'pw'"""
+    staged = os.path.join(service.storage_folder, 'staged')
+    with open(staged, 'wb') as f:
+        f.writelines(encrypt_stream(io.BytesIO(content), 'pw'))
+    service.blob_store.put(staged, 'old_paper')
+    service.metadata_store.add('old_paper', {
+        'original_filename': 'paper.pdf', 'secure_filename': 'old_paper', 'subject': 'Maths',
+        'exam_date': '2020-01-01', 'upload_time': '2020-01-01T00:00:00', 'file_size': len(content),
+        'content_hash': content_hash, 'encrypted_path': service.blob_store.location('old_paper'),
+        'blob_id': 'old_paper'
+    }, {'content_address': address, 'encrypted_size': service.blob_store.size('old_paper')})
+
+def test_password_paper_is_converted_on_first_change(service, download):
+    content = os.urandom(3000)
+    add_password_paper(service, content)
+    with service.blob_store.open('old_paper') as f:
+        assert read_header(f).version == FORMAT_VERSION
+
+    service.add_password('old_paper', 'pw', 'second')
+    blob_id = service.metadata_store.get('old_paper')['blob_id']
+    with service.blob_store.open(blob_id) as f:
+        assert read_header(f).version == ENVELOPE_VERSION
+    assert not service.blob_store.exists('old_paper')
+    assert download('old_paper', 'pw') == (200, content)
+    assert download('old_paper', 'second') == (200, content)
+
+def test_conversion_moves_the_address_to_dedup_key(app, service, download):
+    # Addressed with SECRET_KEY, as blobs were before DEDUP_KEY
+    content = os.urandom(3000)
+    meter = StreamMeter()
+    list(meter.wrap([content]))
+    content_hash = meter.content_hash()
+    add_password_paper(service, content, content_hash, content_address(content_hash, app.config['SECRET_KEY']))
+
+    service.add_password('old_paper', 'pw', 'second')
+    blob = service.metadata_store.get_blob(service.metadata_store.get('old_paper')['blob_id'])
+    assert blob['content_address'] == content_address(content_hash, app.config['DEDUP_KEY'])
+    assert download('old_paper', 'second') == (200, content)
+
+def test_rebuild_restores_key_slots(service, upload, tmp_path):
+    content = os.urandom(3000)
+    file_id = upload(content, 'pw')
+    service.add_password(file_id, 'pw', 'second')
+    slot_id = service.add_password(file_id, 'pw', 'revoked')['slot_id']
+    service.revoke_password(file_id, slot_id, 'pw')
+
+    # The metadata database is lost
+    rebuilt = MetadataStore(str(tmp_path / 'rebuilt.db'))
+    assert rebuilt.rebuild_from_storage(service.blob_store, min_age=0)['added'] == 1
+    service._metadata_store = rebuilt
+
+    assert len(rebuilt.key_slots(file_id)) == 2
+    assert service.verify(file_id, 'pw')['valid']
+    assert service.verify(file_id, 'second')['valid']
+    with pytest.raises(ServiceError):
+        service.verify(file_id, 'revoked')
+
+def test_rebuild_refuses_blobs_without_key_slots(service, upload, tmp_path):
+    file_id = upload(os.urandom(3000), 'pw')
+    blob_id = service.metadata_store.get(file_id)['blob_id']
+    os.remove(service.blob_store.location(blob_id)[:-len(BLOB_SUFFIX)] + KEY_SLOTS_SUFFIX)
+
+    rebuilt = MetadataStore(str(tmp_path / 'rebuilt.db'))
+    assert rebuilt.rebuild_from_storage(service.blob_store, min_age=0) == {
+        'added': 0, 'removed': 0, 'unrecoverable': 1
+    }
+    assert rebuilt.get(blob_id) is None
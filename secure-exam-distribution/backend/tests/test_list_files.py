@@ -0,0 +1,78 @@
+import io
+import pytest
+from metadata_store import MetadataStore
+
+@pytest.fixture
+def papers(client):
+    """Upload six papers over two subjects and three exam dates, returning their file_ids"""
+    file_ids = []
+    for i in range(6):
+        response = client.post('/api/upload', data={
+            'password': 'pw', 'subject': 'Maths' if i % 2 else 'Physics', 'exam_date': f'2020-01-0{i % 3 + 1}',
+            'file': (io.BytesIO(f'paper {i}'.encode()), f'paper{i}.pdf')
+        }, content_type='multipart/form-data')
+        assert response.status_code == 201, response.json
+        file_ids.append(response.json['file_id'])
+    return file_ids
+
+def all_pages(client, query: str) -> list:
+    """Every page of /api/files?query, following next_cursor"""
+    pages, cursor = [], None
+    while True:
+        response = client.get(f'/api/files?{query}' + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200, response.json
+        pages.append(response.json)
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            return pages
+
+def test_cursor_pages_through_every_file_once(client, papers):
+    pages = all_pages(client, 'limit=4')
+    assert [len(page['files']) for page in pages] == [4, 2]
+    assert [f['file_id'] for page in pages for f in page['files']] == papers
+    assert all(page['total_files'] == 6 for page in pages)
+
+    pages = all_pages(client, 'limit=2&sort=exam_date&order=desc')
+    dates = [f['exam_date'] for page in pages for f in page['files']]
+    assert len(pages) == 4 and len(dates) == 6
+    assert dates == sorted(dates, reverse=True)
+
+def test_filters(client, papers):
+    files = client.get('/api/files?subject=Maths').json['files']
+    assert [f['file_id'] for f in files] == papers[1::2]
+
+    response = client.get('/api/files?subject=Physics&exam_date_from=2020-01-02&exam_date_to=2020-01-03')
+    assert [f['exam_date'] for f in response.json['files']] == ['2020-01-03', '2020-01-02']
+    assert response.json['total_files'] == 2
+
+def test_fields_projection(client, papers):
+    files = client.get('/api/files?fields=file_id,subject').json['files']
+    assert files[0] == {'file_id': papers[0], 'subject': 'Physics'}
+    assert client.get('/api/files?fields=file_id,encrypted_path').status_code == 400
+
+@pytest.mark.parametrize('query', [
+    'cursor=not-a-cursor', 'sort=exam_date&cursor=WyJ1cGxvYWRfdGltZSIsICJ4IiwgInkiXQ==', 'limit=0', 'limit=x',
+    'sort=subject'
+])
+def test_bad_query_is_400(client, papers, query):
+    assert client.get(f'/api/files?{query}').status_code == 400
+
+def test_unchanged_list_is_304(client, papers):
+    response = client.get('/api/files?limit=2')
+    etag = response.headers['ETag']
+    assert client.get('/api/files?limit=2', headers={'If-None-Match': etag}).status_code == 304
+    # Another query, or any write, is a different list
+    assert client.get('/api/files?limit=3', headers={'If-None-Match': etag}).status_code == 200
+    client.delete(f'/api/delete/{papers[0]}')
+    assert client.get('/api/files?limit=2', headers={'If-None-Match': etag}).status_code == 200
+
+def test_etags_differ_between_databases(service, tmp_path):
+    # A database rebuilt or restored elsewhere restarts at the same version
+    first, second = MetadataStore(str(tmp_path / 'first.db')), MetadataStore(str(tmp_path / 'second.db'))
+    assert first.version() == second.version()
+
+    service._metadata_store = first
+    etag = service.list_etag('')
+    assert service.list_etag('') == etag
+    service._metadata_store = second
+    assert service.list_etag('') != etag
@@ -0,0 +1,98 @@
+import io
+import os
+import sqlite3
+import time
+from app import create_app
+from encryption import encrypt_stream
+from metadata_store import MetadataStore, MIGRATIONS, REBUILD_MIN_AGE_SECONDS
+from storage import BLOB_SUFFIX
+
+def write_baseline_database(settings, content: bytes):
+    """A database and storage folder as the first SQLite release left them: one paper, its blob flat"""
+    os.makedirs(settings['STORAGE_FOLDER'])
+    encrypted_path = os.path.join(settings['STORAGE_FOLDER'], 'old_paper' + BLOB_SUFFIX)
+    with open(encrypted_path, 'wb') as f:
+        f.writelines(encrypt_stream(io.BytesIO(content), 'pw'))
+
+    conn = sqlite3.connect(settings['METADATA_DB_PATH'])
+    conn.executescript(MIGRATIONS[0])
+    conn.execute('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+        'old_paper', 'paper.pdf', 'old_paper', 'Maths', '2020-01-01', '2020-01-01T00:00:00',
+        len(content), None, encrypted_path
+    ))
+    conn.execute('PRAGMA user_version = 1')
+    conn.commit()
+    conn.close()
+
+def test_baseline_database_is_migrated(settings):
+    content = os.urandom(3000)
+    write_baseline_database(settings, content)
+
+    store = MetadataStore(settings['METADATA_DB_PATH'])
+    conn = store._connection()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+    record = store.get('old_paper')
+    assert record['blob_id'] == 'old_paper'
+    assert record['release_time'] is None
+    assert store.get_blob('old_paper')['ref_count'] == 1
+    assert store.key_slots('old_paper') == []
+    assert store.epoch() is not None
+
+    # Reopening applies nothing twice: the epoch drawn by the last migration stays
+    reopened = MetadataStore(settings['METADATA_DB_PATH'])
+    assert reopened.epoch() == store.epoch()
+    assert reopened.count() == 1
+
+def test_baseline_paper_downloads_after_migration(settings):
+    content = os.urandom(3000)
+    write_baseline_database(settings, content)
+    client = create_app(settings).test_client()
+
+    response = client.post('/api/download/old_paper', json={'password': 'pw'})
+    assert response.status_code == 200
+    assert response.get_data() == content
+    assert client.post('/api/download/old_paper', json={'password': 'wrong'}).status_code == 401
+
+def test_rebuild_adopts_blobs_without_records(service, upload, tmp_path):
+    contents = [os.urandom(3000), os.urandom(5000)]
+    file_ids = [upload(content, 'pw') for content in contents]
+
+    # The metadata database is lost
+    rebuilt = MetadataStore(str(tmp_path / 'rebuilt.db'))
+    assert rebuilt.rebuild_from_storage(service.blob_store, batch_size=1, min_age=0) == {
+        'added': 2, 'removed': 0, 'unrecoverable': 0
+    }
+    for file_id, content in zip(file_ids, contents):
+        blob_id = service.metadata_store.get(file_id)['blob_id']
+        record = rebuilt.get(blob_id)
+        assert record['subject'] == 'Unknown'
+        assert record['file_size'] == len(content)
+        assert len(rebuilt.key_slots(blob_id)) == 1
+
+    # A second pass finds nothing new
+    assert rebuilt.rebuild_from_storage(service.blob_store, min_age=0)['added'] == 0
+
+def test_rebuild_drops_records_whose_blob_is_gone(service, upload):
+    kept = upload(os.urandom(3000), 'pw')
+    lost = upload(os.urandom(3000), 'pw')
+    os.remove(service.blob_store.location(service.metadata_store.get(lost)['blob_id']))
+
+    assert service.metadata_store.rebuild_from_storage(service.blob_store, min_age=0) == {
+        'added': 0, 'removed': 1, 'unrecoverable': 0
+    }
+    assert service.metadata_store.get(lost) is None
+    assert service.metadata_store.get(kept) is not None
+
+def test_rebuild_skips_blobs_still_committing(service, upload, tmp_path):
+    file_id = upload(os.urandom(3000), 'pw')
+    blob_id = service.metadata_store.get(file_id)['blob_id']
+
+    # Just stored: its upload may be about to write the record
+    rebuilt = MetadataStore(str(tmp_path / 'rebuilt.db'))
+    assert rebuilt.rebuild_from_storage(service.blob_store)['added'] == 0
+    assert rebuilt.get(blob_id) is None
+
+    stored_at = time.time() - REBUILD_MIN_AGE_SECONDS - 1
+    os.utime(service.blob_store.location(blob_id), (stored_at, stored_at))
+    assert rebuilt.rebuild_from_storage(service.blob_store)['added'] == 1
+    assert rebuilt.get(blob_id) is not None
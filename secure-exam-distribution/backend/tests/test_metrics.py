@@ -0,0 +1,122 @@
+import os
+import re
+from metrics import CONTENT_TYPE, Counter, Gauge, Histogram, render_metrics
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+def parse(text: str) -> dict:
+    """Samples of a text exposition, {(name, sorted label pairs): value}, checking its layout on the way"""
+    assert text.endswith('\n')
+    samples = {}
+    typed = set()
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            name, kind = line[len('# TYPE '):].split(' ')
+            assert kind in ('counter', 'gauge', 'histogram')
+            typed.add(name)
+            continue
+        match = SAMPLE.match(line)
+        assert match, line
+        name, labels, value = match.groups()
+        # Every sample belongs to a family declared before it
+        assert re.sub(r'_(bucket|sum|count)$', '', name) in typed or name in typed, line
+        labels = tuple(sorted(LABEL.findall(labels or '')))
+        samples[(name, labels)] = float(value)
+    return samples
+
+def value(samples: dict, name: str, **labels) -> float:
+    return samples.get((name, tuple(sorted(labels.items()))), 0)
+
+def test_counter_and_gauge_exposition():
+    counter = Counter('test_total', 'A counter', ('kind',))
+    counter.inc('a')
+    counter.inc('a', amount=2)
+    counter.inc('say "hi"\n')
+    gauge = Gauge('test_level', 'A gauge')
+    gauge.set(1.5)
+
+    assert counter.render() == [
+        '# HELP test_total A counter',
+        '# TYPE test_total counter',
+        'test_total{kind="a"} 3',
+        'test_total{kind="say \\"hi\\"\\n"} 1',
+    ]
+    assert gauge.render()[2:] == ['test_level 1.5']
+    gauge.dec()
+    assert gauge.render()[2:] == ['test_level 0.5']
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_seconds', 'A histogram', ('op',), buckets=(0.1, 1))
+    for seconds in (0.05, 0.1, 0.5, 3):
+        histogram.observe(seconds, 'read')
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{op="read",le="0.1"} 2',
+        'test_seconds_bucket{op="read",le="1"} 3',
+        'test_seconds_bucket{op="read",le="+Inf"} 4',
+        'test_seconds_sum{op="read"} 3.65',
+        'test_seconds_count{op="read"} 4',
+    ]
+
+def test_families_are_rendered_after_the_registry():
+    text = render_metrics([('test_open', 'gauge', 'Open things', [({'kind': 'file'}, 2), ({}, True)])])
+    assert text.endswith('# HELP test_open Open things\n# TYPE test_open gauge\ntest_open{kind="file"} 2\ntest_open 1\n')
+    parse(text)
+
+def test_endpoint_counts_requests_and_bytes(client, upload):
+    content = os.urandom(5000)
+    file_id = upload(content, 'pw')
+    before = parse(client.get('/api/metrics').get_data(as_text=True))
+
+    response = client.post(f'/api/download/{file_id}', json={'password': 'pw'})
+    assert response.get_data() == content
+    response.close()
+    response = client.post(f'/api/download/{file_id}', json={'password': 'wrong'})
+    assert response.status_code == 401
+    # Requests are counted once their response is closed
+    response.close()
+    response = client.get('/api/metrics')
+    assert response.headers['Content-Type'] == CONTENT_TYPE
+    after = parse(response.get_data(as_text=True))
+
+    def delta(name, **labels):
+        return value(after, name, **labels) - value(before, name, **labels)
+
+    route = '/api/download/<file_id>'
+    assert delta('exam_http_requests_total', route=route, method='POST', status='200') == 1
+    assert delta('exam_http_requests_total', route=route, method='POST', status='401') == 1
+    assert delta('exam_http_request_duration_seconds_count', route=route, method='POST') == 2
+    assert delta('exam_http_response_bytes_total', route=route) >= len(content)
+    assert delta('exam_http_request_bytes_total', route=route) > 0
+    assert delta('exam_http_requests_in_flight', route=route) == 0
+    assert delta('exam_stage_duration_seconds_count', operation='decrypt', stage='disk_read') == 1
+    # Scrape-time families are there too
+    assert ('exam_audit_records_total', (('outcome', 'written'),)) in after
+    assert ('exam_crypto_jobs_rejected_total', ()) in after
+
+def test_cache_counters(client, upload):
+    file_id = upload(os.urandom(3000), 'pw')
+    before = parse(client.get('/api/metrics').get_data(as_text=True))
+    for _ in range(2):
+        assert client.post(f'/api/verify/{file_id}', json={'password': 'pw'}).status_code == 200
+    after = parse(client.get('/api/metrics').get_data(as_text=True))
+
+    lookups = sum(value(after, 'exam_cache_lookups_total', cache='kdf', result=result)
+                  - value(before, 'exam_cache_lookups_total', cache='kdf', result=result)
+                  for result in ('hit', 'miss'))
+    assert lookups >= 2
+    assert 0 <= value(after, 'exam_cache_hit_ratio', cache='kdf') <= 1
+
+def test_unmatched_routes_share_one_label(client):
+    before = parse(client.get('/api/metrics').get_data(as_text=True))
+    for path in ('/api/nothing/1', '/api/nothing/2'):
+        response = client.get(path)
+        assert response.status_code == 404
+        response.close()
+    after = parse(client.get('/api/metrics').get_data(as_text=True))
+    assert (value(after, 'exam_http_requests_total', route='unmatched', method='GET', status='404')
+            - value(before, 'exam_http_requests_total', route='unmatched', method='GET', status='404')) == 2
+    assert not any('/api/nothing' in str(labels) for _, labels in after)
@@ -0,0 +1,113 @@
+import io
+import os
+from datetime import datetime, timedelta
+import pytest
+from encryption import encrypt_stream, read_header
+from plaintext_cache import PlaintextCache
+
+WINDOW = 600
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def paper(tmp_path):
+    """(path, header, content) of a paper encrypted with 'pw'"""
+    content = os.urandom(200000)
+    path = tmp_path / 'paper.enc'
+    path.write_bytes(b''.join(encrypt_stream(io.BytesIO(content), 'pw')))
+    with open(path, 'rb') as f:
+        return str(path), read_header(f), content
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+@pytest.fixture
+def cache(clock):
+    cache = PlaintextCache(max_bytes=1 << 20, ttl_seconds=WINDOW)
+    cache._cache._clock = clock
+    return cache
+
+def read(cache, paper, password='pw', start=0, stop=None, ttl=None) -> bytes:
+    path, header, content = paper
+    return b''.join(cache.open('blob', header, len(content), lambda: open(path, 'rb'), password, start, stop, ttl))
+
+def test_second_open_is_a_hit(cache, paper):
+    content = paper[2]
+    assert read(cache, paper) == content
+    assert read(cache, paper, start=10, stop=5000) == content[10:5000]
+    assert (cache.stats()['misses'], cache.stats()['hits']) == (1, 1)
+
+def test_wrong_password_is_refused_before_the_cache(cache, paper):
+    read(cache, paper)
+    with pytest.raises(ValueError):
+        read(cache, paper, password='wrong')
+    assert cache.stats()['hits'] == 0
+
+def test_invalidate_drops_the_blob(cache, paper):
+    read(cache, paper)
+    cache.invalidate('blob')
+    assert cache.stats()['size'] == 0
+    assert read(cache, paper) == paper[2]
+    assert cache.stats()['misses'] == 2
+
+def test_entries_expire_after_their_ttl(cache, clock, paper):
+    read(cache, paper, ttl=60)
+    clock.now += 59
+    read(cache, paper)
+    clock.now += 2
+    read(cache, paper)
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['misses'] == 2
+
+def test_expiry_waits_for_readers_still_streaming(cache, clock, paper):
+    path, header, content = paper
+    chunks = cache.open('blob', header, len(content), lambda: open(path, 'rb'), 'pw')
+    first = next(chunks)
+    clock.now += WINDOW + 1
+    read(cache, paper)
+
+    # The reader streaming when it expired still gets the paper
+    assert first + b''.join(chunks) == content
+
+@pytest.fixture
+def app(settings):
+    from app import create_app
+    return create_app(dict(settings, PLAINTEXT_CACHE_ENABLED=True, PLAINTEXT_CACHE_TTL_SECONDS=WINDOW))
+
+def test_downloads_share_the_cached_paper(service, upload, download):
+    content = os.urandom(5000)
+    file_id = upload(content, 'pw')
+    assert download(file_id, 'pw') == (200, content)
+    assert download(file_id, 'pw') == (200, content)
+    assert download(file_id, 'wrong')[0] == 401
+    assert service.plaintext_cache.stats()['hits'] == 1
+
+def test_delete_invalidates_the_cached_paper(service, client, upload, download):
+    file_id = upload(os.urandom(5000), 'pw')
+    download(file_id, 'pw')
+    assert service.plaintext_cache.stats()['size'] == 1
+
+    assert client.delete(f'/api/delete/{file_id}').status_code == 200
+    assert service.plaintext_cache.stats()['size'] == 0
+
+@pytest.mark.parametrize('released_ago, ttl', [(None, WINDOW), (60, WINDOW - 60), (WINDOW + 60, 0)])
+def test_ttl_runs_to_the_end_of_the_release_window(service, released_ago, ttl):
+    release_time = None
+    if released_ago is not None:
+        release_time = (datetime.now() - timedelta(seconds=released_ago)).isoformat(timespec='seconds')
+    assert service._plaintext_ttl({'release_time': release_time}) == pytest.approx(ttl, abs=2)
+
+def test_papers_past_their_window_are_not_cached(service, upload, download):
+    content = os.urandom(5000)
+    file_id = upload(content, 'pw')
+    long_ago = (datetime.now() - timedelta(seconds=WINDOW + 60)).isoformat(timespec='seconds')
+    service.metadata_store.set_release_time(file_id, long_ago)
+
+    assert download(file_id, 'pw') == (200, content)
+    assert service.plaintext_cache.stats()['size'] == 0
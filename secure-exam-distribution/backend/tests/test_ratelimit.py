@@ -0,0 +1,114 @@
+import asyncio
+import pytest
+import ratelimit
+from ratelimit import MemoryRateLimiter, SQLiteRateLimiter
+from utils import parse_networks, client_address
+
+class Clock:
+    """Stands in for the time module, moved on by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+    monotonic = time
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def limiter(request, tmp_path, clock):
+    if request.param == 'memory':
+        return MemoryRateLimiter()
+    return SQLiteRateLimiter(str(tmp_path / 'ratelimit.db'))
+
+def test_bucket_runs_out(limiter):
+    assert [limiter.take('client', 3) for _ in range(3)] == [(True, 0)] * 3
+    # Empty: one token back takes a third of a minute
+    assert limiter.take('client', 3) == (False, 20)
+    assert limiter.take('other', 3) == (True, 0)
+
+def test_bucket_refills_over_time(limiter, clock):
+    for _ in range(6):
+        limiter.take('client', 6)
+    assert limiter.take('client', 6)[0] is False
+
+    clock.now += 10
+    assert limiter.take('client', 6) == (True, 0)
+    assert limiter.take('client', 6)[0] is False
+
+    # Never above limit, however long it sat
+    clock.now += 3600
+    assert [limiter.take('client', 6)[0] for _ in range(7)] == [True] * 6 + [False]
+
+def test_retry_after_counts_down(limiter, clock):
+    limiter.take('client', 1)
+    assert limiter.take('client', 1) == (False, 60)
+    clock.now += 45
+    assert limiter.take('client', 1) == (False, 15)
+
+def test_sqlite_buckets_are_shared(tmp_path, clock):
+    path = str(tmp_path / 'ratelimit.db')
+    first, second = SQLiteRateLimiter(path), SQLiteRateLimiter(path)
+    assert first.take('client', 2)[0] and second.take('client', 2)[0]
+    assert first.take('client', 2)[0] is False
+    assert second.take('client', 2)[0] is False
+
+def test_limited_request_gets_429_with_retry_after(settings):
+    from app import create_app
+    client = create_app(dict(settings, RATE_LIMIT_BACKEND='memory', RATE_LIMIT_GENERAL=2)).test_client()
+
+    assert [client.get('/api/files').status_code for _ in range(2)] == [200, 200]
+    response = client.get('/api/files')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) == 30
+    assert 'Rate limit exceeded' in response.json['error']
+
+def test_services_share_a_sqlite_limit(settings):
+    from app import create_app
+    settings = dict(settings, RATE_LIMIT_BACKEND='sqlite', RATE_LIMIT_GENERAL=3)
+    first, second = create_app(settings).test_client(), create_app(settings).test_client()
+
+    statuses = [client.get('/api/files').status_code for client in (first, second, first, second)]
+    assert statuses == [200, 200, 200, 429]
+    assert first.get('/api/files').status_code == 429
+
+def test_client_address_reads_forwarded_for_from_trusted_proxies():
+    proxies = parse_networks('10.0.0.0/8, 192.168.1.5')
+
+    # A forged entry on the left is not believed
+    assert client_address('10.0.0.2', '6.6.6.6, 1.2.3.4, 192.168.1.5', proxies) == '1.2.3.4'
+    assert client_address('10.0.0.2', None, proxies) == '10.0.0.2'
+    assert client_address('10.0.0.2', '10.0.0.3', proxies) == '10.0.0.3'
+    # From anyone else the header is ignored
+    assert client_address('1.2.3.4', '5.6.7.8', proxies) == '1.2.3.4'
+    assert client_address('10.0.0.2', '5.6.7.8', ()) == '10.0.0.2'
+
+def test_flask_limits_each_forwarded_client(settings):
+    from app import create_app
+    settings = dict(settings, RATE_LIMIT_BACKEND='memory', RATE_LIMIT_GENERAL=1)
+    behind_proxy = create_app(dict(settings, TRUSTED_PROXIES='127.0.0.1')).test_client()
+    direct = create_app(settings).test_client()
+
+    for client, statuses in ((behind_proxy, [200, 200, 429]), (direct, [200, 429, 429])):
+        assert [client.get('/api/files', headers={'X-Forwarded-For': forwarded}).status_code
+                for forwarded in ('1.1.1.1', '2.2.2.2', '1.1.1.1')] == statuses
+
+def test_asgi_limits_each_forwarded_client(settings):
+    httpx = pytest.importorskip('httpx')
+    from asgi import create_app
+
+    async def statuses():
+        app = create_app(dict(settings, RATE_LIMIT_BACKEND='memory', RATE_LIMIT_GENERAL=1,
+                              TRUSTED_PROXIES='10.0.0.0/8'))
+        transport = httpx.ASGITransport(app=app, client=('10.0.0.2', 4000))
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            return [(await client.get('/api/files', headers={'X-Forwarded-For': forwarded})).status_code
+                    for forwarded in ('1.1.1.1', '2.2.2.2', '1.1.1.1')]
+
+    assert asyncio.run(statuses()) == [200, 200, 429]
@@ -0,0 +1,73 @@
+import io
+import os
+from datetime import datetime, timedelta
+import pytest
+
+ADMIN_TOKEN = 'admin-token'
+
+def in_minutes(minutes: int) -> str:
+    return (datetime.now() + timedelta(minutes=minutes)).isoformat(timespec='seconds')
+
+@pytest.fixture
+def app(settings):
+    from app import create_app
+    return create_app(dict(settings, RELEASE_ADMIN_TOKEN=ADMIN_TOKEN))
+
+@pytest.fixture
+def scheduled(client):
+    """Upload a paper released in 30 minutes, returning (file_id, content)"""
+    content = os.urandom(5000)
+    response = client.post('/api/upload', data={
+        'password': 'pw', 'release_time': in_minutes(30), 'file': (io.BytesIO(content), 'paper.pdf')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 201, response.json
+    return response.json['file_id'], content
+
+def reschedule(client, file_id: str, release_time, password: str = None, token: str = None):
+    headers = {'X-Admin-Token': token} if token else {}
+    return client.put(f'/api/release/{file_id}', json={'release_time': release_time, 'password': password},
+                      headers=headers)
+
+def test_papers_are_refused_before_release(client, scheduled, download):
+    file_id, _ = scheduled
+    assert download(file_id, 'pw')[0] == 403
+    response = client.post(f'/api/verify/{file_id}', json={'password': 'pw'})
+    assert response.status_code == 403
+    assert response.json['release_time']
+    assert client.post('/api/bundle', json={'file_ids': [file_id], 'password': 'pw'}).status_code == 403
+
+def test_reschedule_needs_a_credential(client, scheduled):
+    file_id, _ = scheduled
+    assert reschedule(client, file_id, None).status_code == 400
+    assert reschedule(client, file_id, None, password='wrong').status_code == 401
+    assert reschedule(client, file_id, None, token='wrong').status_code == 400
+    assert reschedule(client, 'missing', None, token=ADMIN_TOKEN).status_code == 404
+
+def test_password_only_postpones(client, scheduled, download):
+    file_id, _ = scheduled
+
+    for release_time in (None, in_minutes(5)):
+        response = reschedule(client, file_id, release_time, password='pw')
+        assert response.status_code == 403
+        assert 'administrator' in response.json['error']
+    assert download(file_id, 'pw')[0] == 403
+
+    later = in_minutes(60)
+    response = reschedule(client, file_id, later, password='pw')
+    assert response.status_code == 200
+    assert response.json['release_time'] == later
+
+def test_admin_token_releases_early(client, scheduled, download):
+    file_id, content = scheduled
+    response = reschedule(client, file_id, None, token=ADMIN_TOKEN)
+    assert response.status_code == 200
+    assert response.json['release_time'] is None
+    assert download(file_id, 'pw') == (200, content)
+
+def test_password_reschedules_a_released_paper(client, scheduled, download):
+    file_id, content = scheduled
+    reschedule(client, file_id, None, token=ADMIN_TOKEN)
+
+    # Nothing pending, so the holder of the password may set a new time
+    assert reschedule(client, file_id, in_minutes(10), password='pw').status_code == 200
+    assert download(file_id, 'pw')[0] == 403
@@ -0,0 +1,51 @@
+import os
+import pytest
+
+BOUNDARY = 'paper-boundary'
+
+def multipart(*parts) -> bytes:
+    """A multipart/form-data body of (name, value) fields and (name, filename, content) files, in order"""
+    body = b''
+    for part in parts:
+        if len(part) == 2:
+            name, value = part
+            body += (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode()
+        else:
+            name, filename, content = part
+            body += (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/pdf\r\n\r\n').encode() + content + b'\r\n'
+    return body + f'--{BOUNDARY}--\r\n'.encode()
+
+def post(client, *parts):
+    return client.post('/api/upload', data=multipart(*parts),
+                       content_type=f'multipart/form-data; boundary={BOUNDARY}')
+
+def staged_files(service) -> list:
+    return [name for name in os.listdir(service.storage_folder)
+            if os.path.isfile(os.path.join(service.storage_folder, name))]
+
+@pytest.mark.parametrize('password_first', [True, False])
+def test_password_before_or_after_the_file(client, download, password_first):
+    content = os.urandom(5000)
+    password, paper = ('password', 'pw'), ('file', 'paper.pdf', content)
+    response = post(client, *((password, paper) if password_first else (paper, password)))
+    assert response.status_code == 201, response.json
+    assert download(response.json['file_id'], 'pw') == (200, content)
+
+@pytest.mark.parametrize('parts', [
+    [('password', 'pw'), ('file', 'paper.pdf', b'paper'), ('password', 'other')],
+    [('password', 'pw'), ('password', 'other'), ('file', 'paper.pdf', b'paper')],
+    [('file', 'paper.pdf', b'paper'), ('password', 'pw'), ('password', 'other')],
+])
+def test_second_password_is_refused(service, client, parts):
+    response = post(client, *parts)
+    assert response.status_code == 400
+    assert 'password once' in response.json['error']
+    assert service.metadata_store.count() == 0
+    assert staged_files(service) == []
+
+def test_missing_password_is_refused(service, client):
+    response = post(client, ('file', 'paper.pdf', b'paper'))
+    assert response.status_code == 400
+    assert response.json['error'] == 'Password is required'
+    assert staged_files(service) == []
@@ -1,9 +1,15 @@
 import os
 import uuid
 import re
+import json
+import time
 from datetime import datetime
 import hashlib
+import hmac
+import base64
+import ipaddress
 from pathlib import Path
+from audit import audit_log
 
 # Allowed file extensions for exam papers
 ALLOWED_EXTENSIONS = {'.pdf', '.doc', '.docx', '.txt', '.rtf'}
@@ -40,6 +46,41 @@ def validate_file_size(file_size: int) -> bool:
     """Validate if file size is within allowed limits"""
     return 0 < file_size <= MAX_FILE_SIZE
 
+class FileTooLargeError(ValueError):
+    """Raised when streamed content exceeds MAX_FILE_SIZE"""
+    status = 413
+
+class StreamMeter:
+    """
+    Count and hash bytes while they stream through, in the same pass
+    Raises FileTooLargeError as soon as the running size exceeds max_size
+    """
+
+    def __init__(self, max_size: int = MAX_FILE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self._digest = hashlib.sha256()
+
+    def wrap(self, chunks):
+        for chunk in chunks:
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise FileTooLargeError("File size exceeds maximum allowed limit")
+            self._digest.update(chunk)
+            yield chunk
+
+    def content_hash(self) -> str:
+        """SHA-256 of everything seen so far, encoded like generate_file_hash"""
+        return base64.b64encode(self._digest.digest()).decode('utf-8')
+
+def content_address(content_hash: str, dedup_key: str) -> str:
+    """
+    Deduplication key for a paper's content
+    Keyed with DEDUP_KEY so the stored address cannot be matched against the
+    hash of a known document.
+    """
+    return hmac.new(dedup_key.encode(), content_hash.encode(), hashlib.sha256).hexdigest()
+
 def sanitize_filename(filename: str) -> str:
     """
     Sanitize filename by removing dangerous characters
@@ -74,6 +115,21 @@ def generate_file_id(original_filename: str, content_hash: str = None) -> str:
     
     return file_id
 
+def encode_cursor(record: dict, sort: str) -> str:
+    """Opaque keyset pagination cursor pointing just after record"""
+    payload = json.dumps([sort, record[sort], record['file_id']])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """Inverse of encode_cursor, raises ValueError if it does not match sort"""
+    try:
+        cursor_sort, value, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort:
+        raise ValueError("Cursor does not match sort order")
+    return value, file_id
+
 def format_file_size(size_bytes: int) -> str:
     """Convert file size in bytes to human-readable format"""
     if size_bytes == 0:
@@ -117,29 +173,92 @@ def validate_password_strength(password: str) -> tuple:
     
     return True, "Password is strong"
 
-def clean_temp_files(temp_dir: str, max_age_hours: int = 24):
+def parse_release_time(value: str):
+    """
+    Normalise a release time to the stored form (local time, ISO 8601 to the
+    second); None or '' mean no scheduled release. Times with a UTC offset
+    are converted to local time. Raises ValueError for anything else.
+    """
+    if not value:
+        return None
+    release_time = datetime.fromisoformat(value)
+    if release_time.tzinfo is not None:
+        release_time = release_time.astimezone().replace(tzinfo=None)
+    return release_time.isoformat(timespec='seconds')
+
+def parse_networks(value) -> tuple:
+    """IP networks from a comma-separated string (or list) of addresses and CIDR ranges"""
+    if isinstance(value, str):
+        value = value.split(',')
+    return tuple(ipaddress.ip_network(item.strip(), strict=False) for item in value or () if item.strip())
+
+def client_address(remote_addr: str, forwarded_for: str, trusted_proxies: tuple) -> str:
+    """
+    The address a request came from. When remote_addr is one of
+    trusted_proxies, X-Forwarded-For is read from the right, skipping the
+    entries added by trusted proxies: anything left of the first other
+    address was sent by the client and can be forged.
+    """
+    if not forwarded_for or not _in_networks(remote_addr, trusted_proxies):
+        return remote_addr
+    client = remote_addr
+    for hop in reversed(forwarded_for.split(',')):
+        hop = hop.strip()
+        if not hop:
+            continue
+        client = hop
+        if not _in_networks(hop, trusted_proxies):
+            break
+    return client
+
+def _in_networks(address: str, networks: tuple) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except (TypeError, ValueError):
+        return False
+    return any(ip in network for network in networks)
+
+def clean_temp_files(temp_dir: str, max_age_hours: float = 24, limit: int = None, match=None,
+                     pause: float = 0) -> tuple:
     """
     Clean temporary files older than specified hours
+    At most limit files are removed, sleeping pause seconds after each, and
+    only those whose name passes match() when it is given. The directory is
+    scanned lazily, so a bounded pass over a huge directory stays cheap.
+    Returns (files removed, bytes reclaimed).
     """
+    removed = 0
+    reclaimed = 0
     try:
         if not os.path.exists(temp_dir):
-            return
+            return removed, reclaimed
         
         current_time = datetime.now().timestamp()
         max_age_seconds = max_age_hours * 3600
         
-        for filename in os.listdir(temp_dir):
-            file_path = os.path.join(temp_dir, filename)
-            
-            if os.path.isfile(file_path):
-                file_age = current_time - os.path.getmtime(file_path)
+        with os.scandir(temp_dir) as entries:
+            for entry in entries:
+                if limit is not None and removed >= limit:
+                    break
+                if match is not None and not match(entry.name):
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
                 
-                if file_age > max_age_seconds:
-                    os.remove(file_path)
-                    print(f"Cleaned temporary file: {filename}")
+                stat = entry.stat(follow_symlinks=False)
+                if current_time - stat.st_mtime > max_age_seconds:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    removed += 1
+                    reclaimed += stat.st_size
+                    if pause:
+                        time.sleep(pause)
     
     except Exception as e:
         print(f"Error cleaning temporary files: {str(e)}")
+    return removed, reclaimed
 
 def create_directory_structure(base_path: str, subdirs: list):
     """
@@ -162,31 +281,13 @@ def create_directory_structure(base_path: str, subdirs: list):
 def log_file_operation(operation: str, filename: str, success: bool, error_msg: str = None):
     """
     Log file operations for audit trail
-    In production, this should write to a proper logging system
+    Queues a record on the JSON-lines audit log (see audit.py) rather than
+    writing it from the calling thread.
     """
-    timestamp = datetime.now().isoformat()
-    status = "SUCCESS" if success else "FAILED"
-    
-    log_entry = f"[{timestamp}] {operation} - {filename} - {status}"
-    
+    fields = {'filename': filename, 'success': success}
     if not success and error_msg:
-        log_entry += f" - Error: {error_msg}"
-    
-    # For now, print to console. In production, use proper logging
-    print(log_entry)
-    
-    # Optionally write to log file
-    try:
-        log_dir = "logs"
-        os.makedirs(log_dir, exist_ok=True)
-        
-        log_file = os.path.join(log_dir, f"file_operations_{datetime.now().strftime('%Y-%m-%d')}.log")
-        
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(log_entry + '\n')
-    
-    except Exception as e:
-        print(f"Failed to write to log file: {str(e)}")
+        fields['error'] = error_msg
+    audit_log(operation.lower(), **fields)
 
 def get_file_mime_type(filename: str) -> str:
     """
@@ -85,10 +85,43 @@ export const apiService = {
     }
   },
 
-  // Get list of all files
-  getFiles: async () => {
+  // Upload many files (or zip archives) in one request. formData holds the
+  // password/subject/exam_date fields and an optional JSON `metadata` field
+  // of per-file overrides, then the files. onEvent gets each NDJSON progress
+  // event; the final summary event is returned.
+  uploadBatch: async (formData, onEvent = null) => {
+    const response = await fetch(`${BASE_URL}/upload/batch`, {
+      method: 'POST',
+      body: formData,
+    });
+    if (!response.ok) {
+      const data = await response.json().catch(() => null);
+      throw new Error(data?.error || `Server error: ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = '';
+    let summary = null;
+    for (;;) {
+      const { done, value } = await reader.read();
+      buffered += decoder.decode(value || new Uint8Array(), { stream: !done });
+      const lines = buffered.split('\n');
+      buffered = done ? '' : lines.pop();
+      for (const line of lines.filter(Boolean)) {
+        const event = JSON.parse(line);
+        if (event.event === 'summary') summary = event;
+        if (onEvent) onEvent(event);
+      }
+      if (done) return summary;
+    }
+  },
+
+  // Get a page of files; params may include filters, sort, order, limit,
+  // cursor (next_cursor from the previous page) and fields
+  getFiles: async (params = {}) => {
     try {
-      const response = await api.get('/files');
+      const response = await api.get('/files', { params });
       return response.data;
     } catch (error) {
       throw error;
@@ -122,6 +155,66 @@ export const apiService = {
     }
   },
 
+  // Schedule when a paper can be downloaded (ISO 8601 date and time);
+  // null releases it now. Before then downloads get a 403. With the paper's
+  // password a pending release can only be postponed; bringing it forward
+  // needs the administrator token.
+  setReleaseTime: async (fileId, releaseTime, password, adminToken = null) => {
+    try {
+      const headers = adminToken ? { 'X-Admin-Token': adminToken } : {};
+      const response = await api.put(`/release/${fileId}`,
+        { release_time: releaseTime, password },
+        { headers });
+      return response.data;
+    } catch (error) {
+      throw error;
+    }
+  },
+
+  // List the passwords (key slots) that open a paper
+  listPasswords: async (fileId) => {
+    try {
+      const response = await api.get(`/passwords/${fileId}`);
+      return response.data;
+    } catch (error) {
+      throw error;
+    }
+  },
+
+  // Let newPassword open a paper too; password must open it already
+  addPassword: async (fileId, password, newPassword, label = null) => {
+    try {
+      const response = await api.post(`/passwords/${fileId}`, {
+        password, new_password: newPassword, label,
+      });
+      return response.data;
+    } catch (error) {
+      throw error;
+    }
+  },
+
+  // Replace password with newPassword; the paper is not re-encrypted
+  changePassword: async (fileId, password, newPassword) => {
+    try {
+      const response = await api.put(`/passwords/${fileId}`, {
+        password, new_password: newPassword,
+      });
+      return response.data;
+    } catch (error) {
+      throw error;
+    }
+  },
+
+  // Revoke one of a paper's passwords, proving access with any of them
+  revokePassword: async (fileId, slotId, password) => {
+    try {
+      const response = await api.delete(`/passwords/${fileId}/${slotId}`, { data: { password } });
+      return response.data;
+    } catch (error) {
+      throw error;
+    }
+  },
+
   // Delete encrypted file
   deleteFile: async (fileId) => {
     try {
@@ -133,11 +133,12 @@ const UploadForm = ({ onUploadSuccess, showNotification }) => {
       setUploading(true);
       setUploadProgress(0);
 
+      // Fields go before the file so the server can encrypt it as it streams in
       const formData = new FormData();
-      formData.append('file', file);
       formData.append('password', password);
       formData.append('subject', subject);
       formData.append('exam_date', examDate || new Date().toISOString().split('T')[0]);
+      formData.append('file', file);
 
       const response = await apiService.uploadFile(formData, setUploadProgress);
       